@@ -11,6 +11,7 @@
 #-----------------------------------------------------------------------------
 
 import time
+import weakref
 
 from zmq import MessageTracker
 
@@ -57,6 +58,7 @@ class AsyncResult(object):
         self._tracker = tracker
         self._ready = False
         self._success = None
+        client._hold(self)
         if len(msg_ids) == 1:
             self._single_result = not isinstance(targets, (list, tuple))
         else:
@@ -114,25 +116,35 @@ class AsyncResult(object):
             return
         self._ready = self._client.wait(self.msg_ids, timeout)
         if self._ready:
-            try:
-                results = map(self._client.results.get, self.msg_ids)
-                self._result = results
-                if self._single_result:
-                    r = results[0]
-                    if isinstance(r, Exception):
-                        raise r
-                else:
-                    results = error.collect_exceptions(results, self._fname)
-                self._result = self._reconstruct_result(results)
-            except Exception, e:
-                self._exception = e
-                self._success = False
-            else:
-                self._success = True
-            finally:
-                self._metadata = map(self._client.metadata.get, self.msg_ids)
+            self._collect()
             
     
+    def _collect(self):
+        """Collect our results from the client, once they are all done."""
+        client = self._client
+        try:
+            missing = [ msg_id for msg_id in self.msg_ids if msg_id not in client.results ]
+            if missing:
+                # the client has let them go already, ask the Hub
+                client.result_status(missing, status_only=False)
+            results = map(client.results.get, self.msg_ids)
+            self._result = results
+            if self._single_result:
+                r = results[0]
+                if isinstance(r, Exception):
+                    raise r
+            else:
+                results = error.collect_exceptions(results, self._fname)
+            self._result = self._reconstruct_result(results)
+        except Exception, e:
+            self._exception = e
+            self._success = False
+        else:
+            self._success = True
+        finally:
+            self._metadata = map(client.metadata.get, self.msg_ids)
+            client._collected(self.msg_ids)
+    
     def successful(self):
         """Return whether the call completed without raising an exception. 
         
@@ -256,12 +268,18 @@ class AsyncMapResult(AsyncResult):
     """Class for representing results of non-blocking gathers.
     
     This will properly reconstruct the gather.
+    
+    `starts` is the index in the sequences of the first element of each
+    chunk, when the chunks are contiguous, for iterating out of order.
     """
     
-    def __init__(self, client, msg_ids, mapObject, fname=''):
+    _starts = None
+    
+    def __init__(self, client, msg_ids, mapObject, fname='', starts=None):
         AsyncResult.__init__(self, client, msg_ids, fname=fname)
         self._mapObject = mapObject
         self._single_result = False
+        self._starts = starts
     
     def _reconstruct_result(self, res):
         """Perform the gather on the actual results."""
@@ -288,6 +306,105 @@ class AsyncMapResult(AsyncResult):
             # already done
             for r in rlist:
                 yield r
+    
+    def _more(self):
+        """Submit any more chunks that are due, returning whether there may be more."""
+        return False
+    
+    def _iter_unordered(self):
+        """Yield (index, result) for each element, as soon as its chunk is done."""
+        if self._starts is None:
+            raise ValueError("unordered iteration needs contiguous chunks")
+        client = self._client
+        position = {}
+        pending = set()
+        seen = -1
+        while True:
+            more = self._more()
+            new = self.msg_ids[len(position):]
+            for msg_id in new:
+                position[msg_id] = len(position)
+            pending.update(new)
+            if seen != client._finish_count:
+                # someone else spun while we were yielding
+                new = pending
+            done = [ msg_id for msg_id in new if msg_id not in client.outstanding ]
+            pending.difference_update(done)
+            if not done:
+                if not pending and not more:
+                    break
+                done = client._wait_for(pending, first=True)
+            seen = client._finish_count
+            for msg_id in done:
+                start = self._starts[position[msg_id]]
+                rlist = AsyncResult(client, msg_id, self._fname).get()
+                for i, r in enumerate(rlist):
+                    yield start+i, r
+
+
+class AsyncAdaptiveMapResult(AsyncMapResult):
+    """An AsyncMapResult whose chunks are still being submitted.
+    
+    `msg_ids` grows as the `feeder` submits chunks, which it does whenever
+    the Client spins, so waiting on this also keeps the map going.
+    """
+    
+    def __init__(self, client, feeder, mapObject, fname=''):
+        self._feeder = feeder
+        feeder.feed()
+        AsyncMapResult.__init__(self, client, feeder.msg_ids, mapObject, fname=fname,
+                                starts=feeder.starts)
+        feeder.result = weakref.ref(self)
+    
+    def _more(self):
+        self._feeder.feed()
+        return not self._feeder.done
+    
+    def wait(self, timeout=-1):
+        """Wait until the result is available or until `timeout` seconds pass.
+        
+        This method always returns None.
+        """
+        if self._ready:
+            return
+        feeder = self._feeder
+        tic = time.time()
+        remaining = timeout
+        while True:
+            feeder.feed()
+            if feeder.done:
+                break
+            feeder.wait_any(remaining)
+            if timeout >= 0:
+                remaining = tic + timeout - time.time()
+                if remaining <= 0:
+                    feeder.feed()
+                    if not feeder.done:
+                        return
+                    remaining = 0
+                    break
+        self._ready = self._client.wait(self.msg_ids, remaining)
+        if self._ready:
+            self._collect()
+    
+    def __iter__(self):
+        try:
+            rlist = self.get(0)
+        except error.TimeoutError:
+            # wait for each chunk in turn, submitting more as we go
+            i = 0
+            while i < len(self.msg_ids) or not self._feeder.done:
+                if i == len(self.msg_ids):
+                    self._feeder.feed()
+                    self._feeder.wait_any()
+                    continue
+                ar = AsyncResult(self._client, self.msg_ids[i], self._fname)
+                i += 1
+                for r in ar.get():
+                    yield r
+        else:
+            for r in rlist:
+                yield r
 
 
 class AsyncHubResult(AsyncResult):
@@ -319,22 +436,24 @@ class AsyncHubResult(AsyncResult):
                 if not pending:
                     self._ready = True
         if self._ready:
-            try:
-                results = map(self._client.results.get, self.msg_ids)
-                self._result = results
-                if self._single_result:
-                    r = results[0]
-                    if isinstance(r, Exception):
-                        raise r
-                else:
-                    results = error.collect_exceptions(results, self._fname)
-                self._result = self._reconstruct_result(results)
-            except Exception, e:
-                self._exception = e
-                self._success = False
-            else:
-                self._success = True
-            finally:
-                self._metadata = map(self._client.metadata.get, self.msg_ids)
-        
-__all__ = ['AsyncResult', 'AsyncMapResult', 'AsyncHubResult']
\ No newline at end of file
+            self._collect()
+
+
+class ObjectRef(AsyncHubResult):
+    """A handle to an object stored in the Hub by `Client.put`.
+    
+    Pass it to tasks in place of the object, as with any AsyncResult.
+    Engines fetch the object from the Hub the first time they need it, and
+    keep it for later tasks while it fits in their `store_limit`.
+    
+    The Hub keeps the object until this ObjectRef, and every task that was
+    given it, are gone.  `nbytes` is its size, serialized.
+    """
+    
+    def __init__(self, client, msg_id, nbytes=0):
+        AsyncHubResult.__init__(self, client, msg_id)
+        self.nbytes = nbytes
+        client._hold_object(self)
+
+__all__ = ['AsyncResult', 'AsyncMapResult', 'AsyncAdaptiveMapResult', 'AsyncHubResult',
+            'ObjectRef']
\ No newline at end of file
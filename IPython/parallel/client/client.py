@@ -14,9 +14,14 @@ import os
 import json
 import time
 import warnings
+import weakref
+from collections import deque
+from UserDict import DictMixin
 from datetime import datetime
+from itertools import chain
 from getpass import getpass
 from pprint import pprint
+from types import FunctionType
 
 pjoin = os.path.join
 
@@ -24,16 +29,18 @@ import zmq
 # from zmq.eventloop import ioloop, zmqstream
 
 from IPython.utils.path import get_ipython_dir
+from IPython.utils.pickleutil import allPrimitive
 from IPython.utils.traitlets import (HasTraits, Int, Instance, CUnicode, 
-                                    Dict, List, Bool, Str, Set)
+                                    Dict, List, Bool, Str, Set, Enum)
 from IPython.external.decorator import decorator
 from IPython.external.ssh import tunnel
 
 from IPython.parallel import error
 from IPython.parallel import streamsession as ss
 from IPython.parallel import util
+from IPython.parallel.controller.dependency import Dependency
 
-from .asyncresult import AsyncResult, AsyncHubResult
+from .asyncresult import AsyncResult, AsyncAdaptiveMapResult, AsyncHubResult, ObjectRef
 from IPython.parallel.apps.clusterdir import ClusterDir, ClusterDirError
 from .view import DirectView, LoadBalancedView
 
@@ -58,51 +65,157 @@ class Metadata(dict):
     Attribute access works on keys.
     
     These objects have a strict set of keys - errors will raise if you try
-    to add new keys.
+    to add new keys with item or attribute assignment.  `update` accepts
+    other keys (such as unusual iopub message types).
+    
+    A Metadata taken from a MetadataStore writes its changes back to it.
     """
+    _keys = ('msg_id', 'submitted', 'started', 'completed', 'received',
+             'engine_uuid', 'engine_id', 'follow', 'after', 'status',
+             'pyin', 'pyout', 'pyerr', 'stdout', 'stderr')
+    # the (store, msg_id) we write back to, if any
+    _bound = None
+    
     def __init__(self, *args, **kwargs):
-        dict.__init__(self)
-        md = {'msg_id' : None,
-              'submitted' : None,
-              'started' : None,
-              'completed' : None,
-              'received' : None,
-              'engine_uuid' : None,
-              'engine_id' : None,
-              'follow' : None,
-              'after' : None,
-              'status' : None,
-
-              'pyin' : None,
-              'pyout' : None,
-              'pyerr' : None,
-              'stdout' : '',
-              'stderr' : '',
-            }
-        self.update(md)
-        self.update(dict(*args, **kwargs))
+        dict.__init__(self, dict.fromkeys(self._keys))
+        self['stdout'] = self['stderr'] = ''
+        self.update(*args, **kwargs)
     
     def __getattr__(self, key):
         """getattr aliased to getitem"""
-        if key in self.iterkeys():
+        if key in self:
             return self[key]
         else:
             raise AttributeError(key)
 
     def __setattr__(self, key, value):
         """setattr aliased to setitem, with strict"""
-        if key in self.iterkeys():
+        if key in self:
             self[key] = value
         else:
             raise AttributeError(key)
     
     def __setitem__(self, key, value):
         """strict static key enforcement"""
-        if key in self.iterkeys():
+        if key in self:
             dict.__setitem__(self, key, value)
+            self._write_back()
         else:
             raise KeyError(key)
-        
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._write_back()
+    
+    def _write_back(self):
+        if self._bound is not None:
+            store, msg_id = self._bound
+            store._records[msg_id] = store._pack(self)
+    
+    def __reduce__(self):
+        # not item by item, which the strict keys would refuse
+        return (self.__class__, (), self.__getstate__())
+    
+    def __getstate__(self):
+        return dict(self)
+    
+    def __setstate__(self, state):
+        dict.update(self, state)
+
+
+class MetadataStore(DictMixin):
+    """A dict of Metadata, keyed by msg_id, that keeps each as a tuple.
+    
+    A Client may keep metadata for every task it has run, and a tuple of
+    the values is a fraction of the size of a dict.  The Metadata for a
+    msg_id is built when it is asked for, and is shared for as long as it
+    is in use, so changes made through it are seen by everyone holding it.
+    Like a defaultdict, asking for a msg_id we don't have adds an empty
+    record.
+    """
+    _keyset = frozenset(Metadata._keys)
+    
+    def __init__(self):
+        # msg_id : tuple of the values of Metadata._keys, then a dict of
+        # any other keys if there are some
+        self._records = {}
+        # msg_id : Metadata, for those in use
+        self._views = weakref.WeakValueDictionary()
+    
+    def _pack(self, md):
+        record = tuple(dict.get(md, key) for key in Metadata._keys)
+        extra = [ key for key in md if key not in self._keyset ]
+        if extra:
+            record += (dict((key, dict.get(md, key)) for key in extra),)
+        return record
+    
+    def __getitem__(self, msg_id):
+        md = self._views.get(msg_id)
+        if md is not None:
+            return md
+        record = self._records.get(msg_id)
+        md = Metadata.__new__(Metadata)
+        if record is None:
+            Metadata.__init__(md)
+            self._records[msg_id] = self._pack(md)
+        else:
+            dict.update(md, zip(Metadata._keys, record))
+            if len(record) > len(Metadata._keys):
+                dict.update(md, record[-1])
+        self._bind(msg_id, md)
+        return md
+    
+    def _bind(self, msg_id, md):
+        md.__dict__['_bound'] = (self, msg_id)
+        self._views[msg_id] = md
+    
+    def _unbind(self, msg_id):
+        md = self._views.pop(msg_id, None)
+        if md is not None:
+            md.__dict__.pop('_bound', None)
+    
+    def __setitem__(self, msg_id, md):
+        if self._views.get(msg_id) is md:
+            md._write_back()
+            return
+        self._unbind(msg_id)
+        if isinstance(md, Metadata) and md._bound is None:
+            self._bind(msg_id, md)
+        self._records[msg_id] = self._pack(md)
+    
+    def __delitem__(self, msg_id):
+        del self._records[msg_id]
+        self._unbind(msg_id)
+    
+    def get(self, msg_id, default=None):
+        if msg_id in self._records:
+            return self[msg_id]
+        return default
+    
+    def __contains__(self, msg_id):
+        return msg_id in self._records
+    
+    has_key = __contains__
+    
+    def __iter__(self):
+        return iter(self._records)
+    
+    iterkeys = __iter__
+    
+    def keys(self):
+        return self._records.keys()
+    
+    def __len__(self):
+        return len(self._records)
+    
+    def clear(self):
+        for msg_id in self._views.keys():
+            self._unbind(msg_id)
+        self._records.clear()
+    
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
 
 class Client(HasTraits):
     """A semi-synchronous client to the IPython ZMQ cluster
@@ -168,14 +281,34 @@ class Client(HasTraits):
     
     history : list of msg_ids
         a list of msg_ids, keeping track of all the execution
-        messages you have submitted in order.
+        messages you have submitted in order.  Kept in full whatever
+        the `retention`, since its indices can be used to fetch results.
     
     outstanding : set of msg_ids
         a set of msg_ids that have been submitted, but whose
         results have not yet been received.
     
     results : dict
-        a dict of all our results, keyed by msg_id
+        a dict of our results, keyed by msg_id.  Which results are kept
+        depends on `retention`.
+    
+    metadata : MetadataStore
+        a dict of Metadata for our tasks, keyed by msg_id.  Kept for as
+        long as the result, in a compact form.
+    
+    retention : str
+        which results (and metadata) are kept once they arrive:
+        
+        'all'  : every result, for the life of the Client [default]
+        'lru'  : the most recently used results, up to `results_limit` bytes
+        'get'  : each result until an AsyncResult has collected it
+        'weak' : each result for as long as an AsyncResult for it exists
+        
+        Results that have been let go are requested from the Hub again
+        if they are asked for.
+    
+    results_limit : int
+        the size in bytes of the results kept with retention='lru'. [Default: 256MB]
     
     block : bool
         determines default behavior when block not specified
@@ -210,8 +343,10 @@ class Client(HasTraits):
     block = Bool(False)
     outstanding = Set()
     results = Instance('collections.defaultdict', (dict,))
-    metadata = Instance('collections.defaultdict', (Metadata,))
+    metadata = Instance(MetadataStore, ())
     history = List()
+    retention = Enum(('all', 'lru', 'get', 'weak'), 'all', allow_none=False)
+    results_limit = Int(1<<28)
     debug = Bool(False)
     profile=CUnicode('default')
     
@@ -230,16 +365,52 @@ class Client(HasTraits):
     _mux_socket=Instance('zmq.Socket')
     _task_socket=Instance('zmq.Socket')
     _task_scheme=Str()
+    _poller = Instance('zmq.Poller')
+    # msg_ids that finished while we are in wait(), or None when not waiting
+    _finished = None
+    # how many msg_ids have ever finished, so that waiters can tell whether
+    # any finished while they weren't looking
+    _finish_count = 0
     _closed = False
     _ignored_control_replies=Int(0)
     _ignored_hub_replies=Int(0)
+    # retention bookkeeping:
+    # 'lru': estimated bytes of each result, their total, and use order
+    _result_sizes = Dict()
+    _results_size = Int(0)
+    _result_stamps = Dict()
+    _result_uses = Instance(deque, ())
+    _result_clock = Int(0)
+    # 'weak': the number of live AsyncResults for each msg_id
+    _holders = Dict()
+    _holder_refs = Dict()
+    # ChunkFeeders of adaptive maps that are still submitting
+    _feeders = List()
+    # functions sent by digest, see util.pack_function:
+    # the packed buffers of each function, by (code, defaults, module, name)
+    _functions = Dict()
+    # the digests each engine should have, by engine uuid
+    _engine_functions = Instance('collections.defaultdict', (set,))
+    # the digest of each pending msg_id that sent a function, and the
+    # message to send again in full if it was sent by digest
+    _function_sends = Dict()
+    # the number of live ObjectRefs for each object put in the Hub,
+    # and the objects the Hub can forget
+    _object_counts = Dict()
+    _object_refs = Dict()
+    _released = List()
+    # the AsyncResults passed to each pending task, kept until it is done
+    _task_refs = Dict()
+    # the outstanding msg_ids sent to the task scheduler
+    _outstanding_tasks = Set()
     
     def __init__(self, url_or_file=None, profile='default', cluster_dir=None, ipython_dir=None,
             context=None, username=None, debug=False, exec_key=None,
             sshserver=None, sshkey=None, password=None, paramiko=None,
-            timeout=10
+            timeout=10, retention='all', results_limit=1<<28
             ):
-        super(Client, self).__init__(debug=debug, profile=profile)
+        super(Client, self).__init__(debug=debug, profile=profile,
+                        retention=retention, results_limit=results_limit)
         if context is None:
             context = zmq.Context.instance()
         self._context = context
@@ -450,6 +621,14 @@ class Client(HasTraits):
         else:
             self._connected = False
             raise Exception("Failed to connect!")
+        
+        # the sockets whose messages spin() always drains, for wait() to block on.
+        # (control replies are only drained when ignored, so it is left out)
+        self._poller = zmq.Poller()
+        for socket in (self._mux_socket, self._task_socket, self._notification_socket,
+                        self._iopub_socket, self._query_socket):
+            if socket:
+                self._poller.register(socket, zmq.POLLIN)
     
     #--------------------------------------------------------------------------
     # handlers and callbacks for incoming messages
@@ -485,6 +664,110 @@ class Client(HasTraits):
             md['completed'] = datetime.strptime(header['date'], util.ISO8601)
         return md
     
+    #--------------------------------------------------------------------------
+    # retention of results
+    #--------------------------------------------------------------------------
+    
+    def _store_result(self, msg_id, result, buffers=()):
+        """Save a result that has arrived, as `retention` allows.
+        
+        `buffers` are the buffers the result was sent in, which give
+        its size for retention='lru'.
+        """
+        if self.retention == 'weak' and not self._holders.get(msg_id):
+            # nobody is waiting for it
+            self._forget_result(msg_id)
+            return
+        self.results[msg_id] = result
+        if self.retention == 'lru':
+            # count the metadata and bookkeeping, as well as the data
+            size = 256 + sum(map(len, buffers))
+            self._results_size += size - self._result_sizes.get(msg_id, 0)
+            self._result_sizes[msg_id] = size
+            self._use_result(msg_id)
+            self._cull_results()
+    
+    def _forget_result(self, msg_id):
+        """Let go of the result and metadata of msg_id."""
+        self.results.pop(msg_id, None)
+        self.metadata.pop(msg_id, None)
+        self._results_size -= self._result_sizes.pop(msg_id, 0)
+        self._result_stamps.pop(msg_id, None)
+    
+    def _use_result(self, msg_id):
+        """Mark msg_id as the most recently used, for retention='lru'."""
+        self._result_clock += 1
+        self._result_stamps[msg_id] = self._result_clock
+        self._result_uses.append((self._result_clock, msg_id))
+    
+    def _cull_results(self):
+        """Forget the least recently used results, until we are within results_limit."""
+        uses = self._result_uses
+        stamps = self._result_stamps
+        while uses and self._results_size > self.results_limit:
+            stamp, msg_id = uses.popleft()
+            if stamps.get(msg_id) == stamp:
+                self._forget_result(msg_id)
+        if len(uses) > 2*len(stamps) + 64:
+            # drop the stale entries
+            self._result_uses = deque(sorted( (stamp, msg_id) for msg_id, stamp in stamps.iteritems() ))
+    
+    def _collected(self, msg_ids):
+        """Called when an AsyncResult has collected the results of msg_ids."""
+        if self.retention == 'get':
+            map(self._forget_result, msg_ids)
+        elif self.retention == 'lru':
+            for msg_id in msg_ids:
+                if msg_id in self._result_stamps:
+                    self._use_result(msg_id)
+    
+    def _hold(self, ar, msg_ids=None):
+        """Keep the results of an AsyncResult for as long as it exists,
+        with retention='weak'.
+        
+        `msg_ids` are added to an AsyncResult after it was created."""
+        if self.retention != 'weak':
+            return
+        msg_ids = list(ar.msg_ids if msg_ids is None else msg_ids)
+        for msg_id in msg_ids:
+            self._holders[msg_id] = self._holders.get(msg_id, 0) + 1
+        def release(ref):
+            del self._holder_refs[id(ref)]
+            for msg_id in msg_ids:
+                count = self._holders.pop(msg_id) - 1
+                if count:
+                    self._holders[msg_id] = count
+                else:
+                    self._forget_result(msg_id)
+        ref = weakref.ref(ar, release)
+        self._holder_refs[id(ref)] = ref
+    
+    def _hold_object(self, ref):
+        """Count ObjectRef `ref`, so that the Hub forgets its object once
+        no ObjectRef to it is left."""
+        msg_id = ref.msg_ids[0]
+        self._object_counts[msg_id] = self._object_counts.get(msg_id, 0) + 1
+        def release(wref):
+            del self._object_refs[id(wref)]
+            count = self._object_counts.pop(msg_id) - 1
+            if count:
+                self._object_counts[msg_id] = count
+            else:
+                self._forget_result(msg_id)
+                # the next spin tells the Hub
+                self._released.append(msg_id)
+        wref = weakref.ref(ref, release)
+        self._object_refs[id(wref)] = wref
+    
+    def _release_objects(self):
+        """Tell the Hub to forget the objects that no ObjectRef refers to."""
+        msg_ids, self._released = self._released, []
+        content = dict(targets=[], msg_ids=msg_ids)
+        self.session.send(self._query_socket, "purge_request", content=content)
+        idents, msg = self.session.recv(self._query_socket, 0)
+        if self.debug:
+            pprint(msg)
+    
     def _register_engine(self, msg):
         """Register a new engine, and update our connection info."""
         content = msg['content']
@@ -499,6 +782,7 @@ class Client(HasTraits):
         if eid in self._ids:
             self._ids.remove(eid)
             uuid = self._engines.pop(eid)
+            self._engine_functions.pop(uuid, None)
             
             self._handle_stranded_msgs(eid, uuid)
                 
@@ -532,6 +816,14 @@ class Client(HasTraits):
             msg = dict(parent_header=parent, header=header, content=content)
             self._handle_apply_reply(msg)
     
+    def _finish(self, msg_id):
+        """msg_id is no longer outstanding"""
+        self.outstanding.remove(msg_id)
+        self._outstanding_tasks.discard(msg_id)
+        self._finish_count += 1
+        if self._finished is not None:
+            self._finished.append(msg_id)
+    
     def _handle_execute_reply(self, msg):
         """Save the reply to an execute_request into our results.
         
@@ -546,22 +838,44 @@ class Client(HasTraits):
             else:
                 print ("got unknown result: %s"%msg_id)
         else:
-            self.outstanding.remove(msg_id)
-        self.results[msg_id] = self._unwrap_exception(msg['content'])
+            self._finish(msg_id)
+        self._store_result(msg_id, self._unwrap_exception(msg['content']))
+    
+    def _function_missed(self, msg):
+        """If `msg` says an engine didn't have the function we sent by
+        digest, forget that it had it, and send the request again in full,
+        under the same msg_id.
+        
+        Returns whether the request was sent again."""
+        if msg['header'].get('function_cached', True):
+            return False
+        msg_id = msg['parent_header']['msg_id']
+        digest, resend = self._function_sends.get(msg_id, (None, None))
+        if resend is None:
+            return False
+        engine = msg['header'].get('engine', None)
+        if engine in self._engine_functions:
+            self._engine_functions[engine].discard(digest)
+        socket, request, bufs, ident = resend
+        self.session.send(socket, request, buffers=bufs, ident=ident)
+        self._function_sends[msg_id] = (digest, None)
+        return True
     
     def _handle_apply_reply(self, msg):
         """Save the reply to an apply_request into our results."""
         parent = msg['parent_header']
         msg_id = parent['msg_id']
+        if self._function_missed(msg):
+            return
         if msg_id not in self.outstanding:
             if msg_id in self.history:
                 print ("got stale result: %s"%msg_id)
-                print self.results[msg_id]
+                print self.results.get(msg_id)
                 print msg
             else:
                 print ("got unknown result: %s"%msg_id)
         else:
-            self.outstanding.remove(msg_id)
+            self._finish(msg_id)
         content = msg['content']
         header = msg['header']
         
@@ -575,16 +889,23 @@ class Client(HasTraits):
         if msg_id in e_outstanding:
             e_outstanding.remove(msg_id)
         
+        self._task_refs.pop(msg_id, None)
+        sent = self._function_sends.pop(msg_id, None)
+        if sent is not None and content['status'] == 'ok':
+            # now we know the engine has the function
+            self._engine_functions[md['engine_uuid']].add(sent[0])
+        
         # construct result:
         if content['status'] == 'ok':
-            self.results[msg_id] = util.unserialize_object(msg['buffers'])[0]
+            self._store_result(msg_id, util.unserialize_object(msg['buffers'], copy=False)[0],
+                                msg['buffers'])
         elif content['status'] == 'aborted':
-            self.results[msg_id] = error.TaskAborted(msg_id)
+            self._store_result(msg_id, error.TaskAborted(msg_id))
         elif content['status'] == 'resubmitted':
             # TODO: handle resubmission
             pass
         else:
-            self.results[msg_id] = self._unwrap_exception(content)
+            self._store_result(msg_id, self._unwrap_exception(content))
     
     def _flush_notifications(self):
         """Flush notifications of engine registrations waiting
@@ -603,8 +924,11 @@ class Client(HasTraits):
             msg = self.session.recv(self._notification_socket, mode=zmq.NOBLOCK)
     
     def _flush_results(self, sock):
-        """Flush task or queue results waiting in ZMQ queue."""
-        msg = self.session.recv(sock, mode=zmq.NOBLOCK)
+        """Flush task or queue results waiting in ZMQ queue.
+        
+        Result buffers stay zmq Messages, so that arrays in results are
+        views of the received data rather than copies."""
+        msg = self.session.recv(sock, mode=zmq.NOBLOCK, copy=False)
         while msg is not None:
             if self.debug:
                 pprint(msg)
@@ -615,7 +939,7 @@ class Client(HasTraits):
                 raise Exception("Unhandled message type: %s"%msg.msg_type)
             else:
                 handler(msg)
-            msg = self.session.recv(sock, mode=zmq.NOBLOCK)
+            msg = self.session.recv(sock, mode=zmq.NOBLOCK, copy=False)
     
     def _flush_control(self, sock):
         """Flush replies from the control channel waiting
@@ -657,6 +981,12 @@ class Client(HasTraits):
             header = msg['header']
             msg_type = msg['msg_type']
             
+            if self.retention != 'all' and msg_id not in self.metadata \
+                    and msg_id not in self.outstanding:
+                # output for a result we have let go
+                msg = self.session.recv(sock, mode=zmq.NOBLOCK)
+                continue
+            
             # init metadata:
             md = self.metadata[msg_id]
             
@@ -729,6 +1059,10 @@ class Client(HasTraits):
             self._flush_iopub(self._iopub_socket)
         if self._query_socket:
             self._flush_ignored_hub_replies()
+            if self._released:
+                self._release_objects()
+        for feeder in list(self._feeders):
+            feeder.feed()
     
     def wait(self, jobs=None, timeout=-1):
         """waits on one or more `jobs`, for up to `timeout` seconds.
@@ -750,7 +1084,6 @@ class Client(HasTraits):
         True : when all msg_ids are done
         False : timeout reached, some msg_ids still outstanding
         """
-        tic = time.time()
         if jobs is None:
             theids = self.outstanding
         else:
@@ -765,15 +1098,104 @@ class Client(HasTraits):
                     map(theids.add, job.msg_ids)
                     continue
                 theids.add(job)
-        if not theids.intersection(self.outstanding):
+        pending = theids.intersection(self.outstanding)
+        if not pending:
             return True
-        self.spin()
-        while theids.intersection(self.outstanding):
-            if timeout >= 0 and ( time.time()-tic ) > timeout:
-                break
-            time.sleep(1e-3)
+        self._wait_for(pending, timeout)
+        return not pending
+    
+    def _wait_for(self, pending, timeout=-1, first=False):
+        """Spin until the msg_ids in the set `pending` are done, or `timeout`
+        seconds pass.  With `first`, return as soon as any of them is done.
+        
+        Done msg_ids are removed from `pending`, and returned in the order
+        they finished.
+        """
+        tic = time.time()
+        done = []
+        # rather than intersecting with outstanding on every pass,
+        # _finish tells us which msg_ids are done
+        self._finished = finished = []
+        try:
             self.spin()
-        return len(theids.intersection(self.outstanding)) == 0
+            while True:
+                for msg_id in finished:
+                    if msg_id in pending:
+                        pending.remove(msg_id)
+                        done.append(msg_id)
+                del finished[:]
+                if not pending or (first and done):
+                    break
+                if timeout >= 0:
+                    remaining = timeout - (time.time()-tic)
+                    if remaining <= 0:
+                        break
+                    self._poller.poll(1000*remaining)
+                else:
+                    self._poller.poll()
+                self.spin()
+        finally:
+            self._finished = None
+        return done
+    
+    def as_completed(self, jobs, timeout=-1):
+        """Iterate over `jobs` as they finish, rather than in order.
+        
+        Yields ``(index, AsyncResult)`` pairs as soon as each job is done,
+        where `index` is its position in `jobs`.  Jobs that are already done
+        come first.  An AsyncResult of several msg_ids is done when all of
+        them are.
+        
+        Parameters
+        ----------
+        
+        jobs : list of AsyncResult objects, ints, or strs
+                ints are indices to self.history
+                strs are msg_ids
+        timeout : float
+                a time in seconds, after which to give up and raise
+                TimeoutError.  default is -1, which means no timeout
+        """
+        tic = time.time()
+        ars = []
+        for job in jobs:
+            if not isinstance(job, AsyncResult):
+                job = self.get_result(job, block=False)
+            ars.append(job)
+        # the jobs waiting on each msg_id, and how many each job still waits on
+        waiting = {}
+        counts = []
+        for index, ar in enumerate(ars):
+            count = 0
+            for msg_id in ar.msg_ids:
+                if msg_id in self.outstanding:
+                    waiting.setdefault(msg_id, []).append(index)
+                    count += 1
+            counts.append(count)
+        seen = self._finish_count
+        for index, count in enumerate(counts):
+            if not count:
+                yield index, ars[index]
+        pending = set(waiting)
+        while pending:
+            done = []
+            if seen != self._finish_count:
+                # someone else spun while we were yielding
+                done = [ msg_id for msg_id in pending if msg_id not in self.outstanding ]
+                pending.difference_update(done)
+            if not done:
+                remaining = timeout
+                if timeout >= 0:
+                    remaining = max(0, timeout - (time.time()-tic))
+                done = self._wait_for(pending, remaining, first=True)
+                if not done:
+                    raise error.TimeoutError("%i jobs still pending"%len([c for c in counts if c]))
+            seen = self._finish_count
+            for msg_id in done:
+                for index in waiting.pop(msg_id):
+                    counts[index] -= 1
+                    if not counts[index]:
+                        yield index, ars[index]
     
     #--------------------------------------------------------------------------
     # Control methods
@@ -786,6 +1208,8 @@ class Client(HasTraits):
         targets = self._build_targets(targets)[0]
         for t in targets:
             self.session.send(self._control_socket, 'clear_request', content={}, ident=t)
+            # engines forget their functions with their namespace
+            self._engine_functions.pop(t, None)
         error = False
         if block:
             self._flush_ignored_control()
@@ -892,19 +1316,89 @@ class Client(HasTraits):
         
         return result
     
-    def send_apply_message(self, socket, f, args=None, kwargs=None, subheader=None, track=False,
-                            ident=None):
-        """construct and send an apply message via a socket.
-        
-        This is the principal method with which all engine execution is performed by views.
+    def _pack_function(self, f):
+        """util.pack_function(f), remembered for plain functions whose
+        defaults can't change under us."""
+        if not isinstance(f, FunctionType) or not allPrimitive(f.func_defaults or ()):
+            return util.pack_function(f)
+        key = (f.func_code, f.func_defaults, f.__module__, f.__name__)
+        packed = self._functions.get(key)
+        if packed is None:
+            if len(self._functions) >= 1024:
+                self._functions.clear()
+            packed = self._functions[key] = util.pack_function(f)
+        return packed
+    
+    def _has_function(self, digest, engine, subheader):
+        """Whether the function `digest` should be on `engine`, or for a
+        task, on every engine it may run on."""
+        ef = self._engine_functions
+        if engine is not None:
+            return digest in ef.get(engine, ())
+        targets = subheader.get('targets') or self._engines.values()
+        for t in targets:
+            if digest not in ef.get(t, ()):
+                return False
+        return bool(targets)
+    
+    def _find_results(self, args, kwargs):
+        """The AsyncResults in `args` and `kwargs`, or in lists and tuples
+        in them, which tasks get the results of."""
+        refs = []
+        for arg in chain(args, kwargs.itervalues()):
+            if isinstance(arg, AsyncResult):
+                refs.append(arg)
+            elif isinstance(arg, (list, tuple)) and not allPrimitive(arg):
+                refs.extend( a for a in arg if isinstance(a, AsyncResult) )
+        for ar in refs:
+            if isinstance(ar, AsyncAdaptiveMapResult):
+                # all of its chunks have to be submitted to refer to them
+                while not ar._feeder.done:
+                    ar._feeder.feed()
+                    ar._feeder.wait_any()
+        return refs
+    
+    def _affinity(self, refs):
+        """The msg_ids of the AsyncResults `refs`, as a dict of the sizes of
+        their results, where they are known."""
+        affinity = {}
+        for ar in refs:
+            nbytes = ar.nbytes if isinstance(ar, ObjectRef) else 0
+            for msg_id in ar.msg_ids:
+                affinity[msg_id] = nbytes
+        return affinity
+    
+    def _after_results(self, after, refs):
+        """The dependency `after`, with the pending tasks of the AsyncResults
+        `refs` added, so the scheduler waits for them, rather than the engine
+        it picks."""
+        pending = [ m for ar in refs for m in ar.msg_ids if m in self._outstanding_tasks ]
+        if not pending:
+            return after
+        if not after:
+            # failed inputs are raised by the engine
+            return Dependency(pending, failure=True).as_dict()
+        if isinstance(after, dict):
+            if not (after['all'] and after['success']):
+                # the inputs can't be added, so the engine waits for them
+                return after
+            return dict(after, dependencies=after['dependencies'] + pending)
+        return list(after) + pending
+    
+    def _pack_apply_message(self, f, args, kwargs, subheader):
+        """validate and pack the arguments of an apply request.
+
+        Returns (bufs, subheader, function, refs), ready to be passed to
+        `_send_packed_apply`.  `function` is the digest of `f` and the buffer
+        to send it by digest alone, or None if `f` isn't sent that way.
+        `refs` are the AsyncResults in the arguments.
         """
-                            
         assert not self._closed, "cannot use me anymore, I'm closed!"
         # defaults:
         args = args if args is not None else []
         kwargs = kwargs if kwargs is not None else {}
         subheader = subheader if subheader is not None else {}
-        
+
         # validate arguments
         if not callable(f):
             raise TypeError("f must be callable, not %s"%type(f))
@@ -914,21 +1408,82 @@ class Client(HasTraits):
             raise TypeError("kwargs must be dict, not %s"%type(kwargs))
         if not isinstance(subheader, dict):
             raise TypeError("subheader must be dict, not %s"%type(subheader))
-        
-        bufs = util.pack_apply_message(f,args,kwargs)
-        
+
+        refs = self._find_results(args, kwargs)
+        if refs and 'affinity' in subheader:
+            # tasks use the data they are given
+            affinity = self._affinity(refs)
+            affinity.update(subheader['affinity'])
+            subheader = dict(subheader, affinity=affinity)
+        if refs and 'after' in subheader:
+            subheader = dict(subheader, after=self._after_results(subheader['after'], refs))
+        fbuf, digest, digest_buf = self._pack_function(f)
+        bufs = util.pack_apply_message(f,args,kwargs, fbuf=fbuf)
+        function = None if digest is None else (digest, digest_buf)
+        return bufs, subheader, function, refs
+
+    def send_apply_message(self, socket, f, args=None, kwargs=None, subheader=None, track=False,
+                            ident=None):
+        """construct and send an apply message via a socket.
+
+        This is the principal method with which all engine execution is performed by views.
+        """
+        bufs, subheader, function, refs = self._pack_apply_message(f, args, kwargs, subheader)
+        return self._send_packed_apply(socket, bufs, subheader, track, ident, function, refs)
+
+    def broadcast_apply_message(self, socket, f, args=None, kwargs=None, subheader=None,
+                            track=False, idents=None):
+        """construct an apply message once, and send it to each of `idents`.
+
+        `f`, `args` and `kwargs` are canned and serialized a single time, and the
+        resulting buffers are sent without copying to every destination, so the
+        cost of packing does not grow with the number of engines.
+
+        Returns a list of messages, one per ident, as `send_apply_message` would.
+        """
+        idents = [] if idents is None else idents
+        bufs, subheader, function, refs = self._pack_apply_message(f, args, kwargs, subheader)
+        return [ self._send_packed_apply(socket, bufs, subheader, track, ident, function, refs)
+                    for ident in idents ]
+
+    def _send_packed_apply(self, socket, bufs, subheader, track, ident, function=None,
+                            refs=()):
+        """send an apply_request with already-packed buffers, and track its msg_id.
+        
+        The function is sent by digest alone if `function` is given, and
+        the engine(s) should have it.  The AsyncResults `refs` are kept
+        until the request is done."""
+        engine = None
+        if ident:
+            # possibly routed to a specific engine
+            engine = ident[-1] if isinstance(ident, list) else ident
+            if engine not in self._engines.values():
+                engine = None
+        full = None
+        if function is not None:
+            digest, digest_buf = function
+            if self._has_function(digest, engine, subheader):
+                full = bufs
+                bufs = [digest_buf] + bufs[1:]
+            elif engine is not None:
+                # engines get their requests in order, so later ones can
+                # send it by digest
+                self._engine_functions[engine].add(digest)
         msg = self.session.send(socket, "apply_request", buffers=bufs, ident=ident,
                             subheader=subheader, track=track)
-        
+
         msg_id = msg['msg_id']
         self.outstanding.add(msg_id)
-        if ident:
-            # possibly routed to a specific engine
-            if isinstance(ident, list):
-                ident = ident[-1]
-            if ident in self._engines.values():
-                # save for later, in case of engine death
-                self._outstanding_dict[ident].add(msg_id)
+        if socket is self._task_socket:
+            self._outstanding_tasks.add(msg_id)
+        if function is not None:
+            resend = None if full is None else (socket, msg, full, ident)
+            self._function_sends[msg_id] = (digest, resend)
+        if refs:
+            self._task_refs[msg_id] = refs
+        if engine is not None:
+            # save for later, in case of engine death
+            self._outstanding_dict[engine].add(msg_id)
         self.history.append(msg_id)
         self.metadata[msg_id]['submitted'] = datetime.now()
         
@@ -1029,7 +1584,7 @@ class Client(HasTraits):
                 raise TypeError("indices must be str or int, not %r"%id)
             theids.append(id)
         
-        local_ids = filter(lambda msg_id: msg_id in self.history or msg_id in self.results, theids)
+        local_ids = filter(lambda msg_id: msg_id in self.outstanding or msg_id in self.results, theids)
         remote_ids = filter(lambda msg_id: msg_id not in local_ids, theids)
         
         if remote_ids:
@@ -1079,13 +1634,16 @@ class Client(HasTraits):
                 raise TypeError("indices must be str or int, not %r"%id)
             theids.append(id)
 
+        # the Hub waits for the results we have, which it may not have yet
+        finished = [ m for m in theids if m in self.history and m not in self.outstanding ]
         for msg_id in theids:
             self.outstanding.discard(msg_id)
+            self._outstanding_tasks.discard(msg_id)
             if msg_id in self.history:
                 self.history.remove(msg_id)
             self.results.pop(msg_id, None)
             self.metadata.pop(msg_id, None)
-        content = dict(msg_ids = theids)
+        content = dict(msg_ids = theids, finished = finished)
 
         self.session.send(self._query_socket, 'resubmit_request', content)
 
@@ -1188,13 +1746,17 @@ class Client(HasTraits):
                 md.update(iodict)
                 
                 if rcontent['status'] == 'ok':
-                    res,buffers = util.unserialize_object(buffers)
+                    nbufs = len(buffers)
+                    res,rest = util.unserialize_object(buffers)
+                    used = buffers[:nbufs-len(rest)]
+                    buffers = rest
                 else:
                     print rcontent
                     res = self._unwrap_exception(rcontent)
                     failures.append(res)
+                    used = ()
                 
-                self.results[msg_id] = res
+                self._store_result(msg_id, res, used)
                 content[msg_id] = res
         
         if len(theids) == 1 and failures:
@@ -1231,7 +1793,47 @@ class Client(HasTraits):
             return content[targets]
         else:
             return content
-        
+
+    @spin_first
+    def put(self, obj):
+        """Store an object in the Hub, for tasks to use by reference.
+
+        Returns an ObjectRef, which can be passed to tasks in place of `obj`,
+        so that `obj` is sent to the Hub once, and to each engine at most once.
+        Any AsyncResult can be passed to tasks in the same way, as an argument
+        or in a list or tuple argument, and engines get its results straight
+        from the Hub.  A LoadBalancedView has the scheduler wait for those
+        of its own tasks that are still pending.  An engine given any other
+        pending result waits for it, handling nothing else, and raises a
+        TimeoutError if it is not done within the engine's `store_timeout`.
+
+        Engines share what they fetch between tasks, so arrays in it are
+        read-only.
+
+        Parameters
+        ----------
+
+        obj : object
+            the object to store
+
+        Returns
+        -------
+
+        An ObjectRef.  The Hub forgets `obj` once there is no ObjectRef to
+        it, and no pending task was given one.
+        """
+        pmd, bufs = util.serialize_object(obj)
+        self.session.send(self._query_socket, "put_request", content={},
+                        buffers=[pmd]+bufs)
+        idents, msg = self.session.recv(self._query_socket, 0)
+        if self.debug:
+            pprint(msg)
+        content = msg['content']
+        if content['status'] != 'ok':
+            raise self._unwrap_exception(content)
+        nbytes = len(pmd) + sum(map(len, bufs))
+        return ObjectRef(self, content['msg_id'], nbytes)
+
     @spin_first
     def purge_results(self, jobs=[], targets=[]):
         """Tell the Hub to forget results.
@@ -37,7 +37,7 @@ else:
 try:
     import numpy
 except ImportError:
-    pass
+    numpy = None
 else:
     arrayModules.append({'module':numpy, 'type':numpy.ndarray})
 try:
@@ -50,37 +50,60 @@ else:
 
 class Map:
     """A class for partitioning a sequence using a map."""
-            
+    
+    def bounds(self, n, p, q):
+        """The (lo, hi) of the pth partition of q partitions of n items."""
+        basesize, remainder = divmod(n, q)
+        lo = p*basesize + min(p, remainder)
+        hi = lo + basesize + (p < remainder)
+        return lo, hi
+    
     def getPartition(self, seq, p, q):
-        """Returns the pth partition of q partitions of seq."""
+        """Returns the pth partition of q partitions of seq.
+        
+        Partitions of arrays are views, not copies.
+        """
         
         # Test for error conditions here
         if p<0 or p>=q:
           print "No partition exists."
           return
-          
-        remainder = len(seq)%q
-        basesize = len(seq)/q
-        hi = []
-        lo = []
-        for n in range(q):
-            if n < remainder:
-                lo.append(n * (basesize + 1))
-                hi.append(lo[-1] + basesize + 1)
-            else:
-                lo.append(n*basesize + remainder)
-                hi.append(lo[-1] + basesize)
-
         
-        result = seq[lo[p]:hi[p]]
-        return result
-           
+        lo, hi = self.bounds(len(seq), p, q)
+        return seq[lo:hi]
+    
+    def slot(self, p, q, n, lo):
+        """Where the pth of q partitions goes in the joined sequence of n items,
+        when the partitions before it have lo items."""
+        return slice(lo, None)
+    
     def joinPartitions(self, listOfPartitions):
         return self.concatenate(listOfPartitions)
-                    
+    
+    def join_arrays(self, listOfPartitions):
+        """Join numpy array partitions into one array, allocated once,
+        with the dtype they all fit in."""
+        test = listOfPartitions[0]
+        for part in listOfPartitions:
+            if part.ndim == 0 or part.shape[1:] != test.shape[1:]:
+                # let numpy raise its own error
+                return numpy.concatenate(listOfPartitions)
+        dtype = reduce(numpy.promote_types, [ part.dtype for part in listOfPartitions ])
+        shape = list(test.shape)
+        n = shape[0] = sum([ len(part) for part in listOfPartitions ])
+        A = numpy.empty(shape, dtype)
+        q = len(listOfPartitions)
+        lo = 0
+        for p,part in enumerate(listOfPartitions):
+            A[self.slot(p, q, n, lo)][:len(part)] = part
+            lo += len(part)
+        return A
+    
     def concatenate(self, listOfPartitions):
         testObject = listOfPartitions[0]
         # First see if we have a known array type
+        if numpy is not None and isinstance(testObject, numpy.ndarray):
+            return self.join_arrays(listOfPartitions)
         for m in arrayModules:
             #print m
             if isinstance(testObject, m['type']):
@@ -92,9 +115,9 @@ class Map:
         return listOfPartitions
 
 class RoundRobinMap(Map):
-    """Partitions a sequence in a roun robin fashion.
+    """Partitions a sequence in a round robin fashion.
     
-    This currently does not work!
+    Partitions of arrays are strided views, not copies.
     """
 
     def getPartition(self, seq, p, q):
@@ -105,10 +128,15 @@ class RoundRobinMap(Map):
         #for i in range(p,len(seq),q):
         #    result.append(seq[i])
         #return result
+    
+    def slot(self, p, q, n, lo):
+        return slice(p, n, q)
 
     def joinPartitions(self, listOfPartitions):
         testObject = listOfPartitions[0]
         # First see if we have a known array type
+        if numpy is not None and isinstance(testObject, numpy.ndarray):
+            return self.join_arrays(listOfPartitions)
         for m in arrayModules:
             #print m
             if isinstance(testObject, m['type']):
@@ -154,5 +182,105 @@ def mappable(obj):
 
 dists = {'b':Map,'r':RoundRobinMap}
 
+#-------------------------------------------------------------------------------
+# Chunk schedules for load-balanced maps
+#-------------------------------------------------------------------------------
+
+class GuidedChunks(object):
+    """Chunk sizes that shrink toward the end of a sequence.
+    
+    Each chunk is a share of the remaining items, (remaining/(factor*nengines)),
+    so the first chunks are large, to keep per-task overhead down, and the
+    last are small, so engines finish at about the same time.
+    """
+    
+    # no feedback is needed, so every chunk is submitted at once
+    adaptive = False
+    
+    def __init__(self, factor=2, minimum=1):
+        self.factor = factor
+        self.minimum = minimum
+        self.nengines = 1
+    
+    def start(self, nitems, nengines):
+        """Begin a new map of `nitems` items over `nengines` engines."""
+        self.nengines = max(1, nengines)
+    
+    def guided(self, remaining):
+        """The guided chunk size for `remaining` items."""
+        share = -(-remaining // (self.factor*self.nengines))
+        return max(self.minimum, share)
+    
+    def next_chunk(self, remaining):
+        """The size of the next chunk, with `remaining` items left."""
+        return min(remaining, self.guided(remaining))
+    
+    def record(self, n, elapsed, overhead):
+        """A chunk of `n` items took `elapsed` seconds to run on its engine,
+        and `overhead` seconds more for the round trip."""
+        pass
+    
+    def sizes(self, nitems):
+        """All chunk sizes for `nitems` items."""
+        sizes = []
+        remaining = nitems
+        while remaining > 0:
+            n = self.next_chunk(remaining)
+            sizes.append(n)
+            remaining -= n
+        return sizes
+
+
+class AdaptiveChunks(GuidedChunks):
+    """Chunk sizes that adapt to measured run times.
+    
+    Chunks start at `initial` items.  As results arrive, the time per item
+    and the round-trip overhead per task are averaged, and chunks are sized
+    to run for about `target` seconds, or ten times the overhead, whichever
+    is longer.  Chunks grow by at most `growth` at a time, and near the end
+    of the sequence they shrink as in GuidedChunks.
+    """
+    
+    adaptive = True
+    # the weight of each new measurement in the running averages
+    smoothing = 0.3
+    
+    def __init__(self, target=0.1, initial=1, growth=4, factor=2, minimum=1):
+        super(AdaptiveChunks, self).__init__(factor=factor, minimum=minimum)
+        self.target = target
+        self.initial = initial
+        self.growth = growth
+        self.per_item = None
+        self.overhead = None
+        self.largest = initial
+    
+    def start(self, nitems, nengines):
+        super(AdaptiveChunks, self).start(nitems, nengines)
+        self.per_item = self.overhead = None
+        self.largest = self.initial
+    
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.smoothing*(new-old)
+    
+    def record(self, n, elapsed, overhead):
+        self.per_item = self._average(self.per_item, max(elapsed, 0.)/max(n, 1))
+        self.overhead = self._average(self.overhead, max(overhead, 0.))
+    
+    def next_chunk(self, remaining):
+        if self.per_item is None:
+            n = self.initial
+        else:
+            target = max(self.target, 10*self.overhead)
+            n = int(target/max(self.per_item, 1e-9))
+            n = min(n, self.growth*self.largest)
+            n = min(n, self.guided(remaining))
+        n = max(self.minimum, min(n, remaining))
+        self.largest = max(self.largest, n)
+        return n
+
+chunk_schedules = {'guided' : GuidedChunks, 'auto' : AdaptiveChunks}
+
     
     
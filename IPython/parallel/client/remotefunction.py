@@ -10,12 +10,15 @@
 # Imports
 #-----------------------------------------------------------------------------
 
+import sys
 import warnings
+from collections import deque
+from itertools import islice, izip
 
 from IPython.testing.skipdoctest import skip_doctest
 
 from . import map as Map
-from .asyncresult import AsyncMapResult
+from .asyncresult import AsyncResult, AsyncMapResult, AsyncAdaptiveMapResult
 
 #-----------------------------------------------------------------------------
 # Decorators
@@ -111,8 +114,11 @@ class ParallelFunction(RemoteFunction):
     block : bool [default: None]
         Whether to wait for results or not.  The default behavior is
         to use the current `block` attribute of `view`
-    chunksize : int or None
-        The size of chunk to use when breaking up sequences in a load-balanced manner
+    chunksize : int, str, chunk schedule, or None
+        The size of chunk to use when breaking up sequences in a load-balanced manner.
+        This may also be a chunk schedule from map.py, or the name of one:
+          * 'guided' : chunks that shrink toward the end of the sequences
+          * 'auto' : chunks sized from the measured run time of earlier chunks
     **flags : remaining kwargs are passed to View.temp_flags
     """
     
@@ -126,6 +132,42 @@ class ParallelFunction(RemoteFunction):
         mapClass = Map.dists[dist]
         self.mapObject = mapClass()
     
+    def _schedule(self):
+        """The chunk schedule object for our chunksize, or None for a fixed size."""
+        chunksize = self.chunksize
+        if isinstance(chunksize, basestring):
+            if chunksize not in Map.chunk_schedules:
+                raise ValueError("Unknown chunksize %r, expected int or one of %s"%(
+                            chunksize, Map.chunk_schedules.keys()))
+            return Map.chunk_schedules[chunksize]()
+        elif chunksize is None or isinstance(chunksize, (int, long)):
+            return None
+        else:
+            return chunksize
+    
+    def _nengines(self):
+        """The number of engines our view may use."""
+        targets = self.view.targets
+        if targets is None:
+            return len(self.view.client.ids)
+        elif isinstance(targets, (list, tuple)):
+            return len(targets)
+        else:
+            return 1
+    
+    def _applied(self):
+        """The function to apply to each part, and any leading arguments."""
+        if hasattr(self, '_map'):
+            return map, [self.func]
+        else:
+            return self.func, []
+    
+    def _submit(self, view, f, args):
+        """Submit one part of the call, returning its msg_id."""
+        with view.temp_flags(block=False, **self.flags):
+            ar = view.apply(f, *args)
+        return ar.msg_ids[0]
+    
     def __call__(self, *sequences):
         # check that the length of sequences match
         len_0 = len(sequences[0])
@@ -134,6 +176,36 @@ class ParallelFunction(RemoteFunction):
                 msg = 'all sequences must have equal length, but %i!=%i'%(len_0,len(s))
                 raise ValueError(msg)
         balanced = 'Balanced' in self.view.__class__.__name__
+        schedule = self._schedule() if balanced else None
+        if schedule is not None:
+            r = self._call_scheduled(schedule, sequences, len_0)
+        else:
+            r = self._call_partitioned(balanced, sequences, len_0)
+        
+        if self.block:
+            try:
+                return r.get()
+            except KeyboardInterrupt:
+                return r
+        else:
+            return r
+    
+    def _call_scheduled(self, schedule, sequences, len_0):
+        """Submit contiguous chunks of the sequences, sized by a chunk schedule."""
+        if self.mapObject.__class__ is not Map.Map:
+            raise ValueError("chunk schedules require contiguous ('b') distribution")
+        nengines = self._nengines()
+        schedule.start(len_0, nengines)
+        feeder = ChunkFeeder(self, sequences, schedule, nengines)
+        fname = self.func.__name__
+        if schedule.adaptive:
+            return AsyncAdaptiveMapResult(self.view.client, feeder, self.mapObject, fname=fname)
+        feeder.feed()
+        return AsyncMapResult(self.view.client, feeder.msg_ids, self.mapObject, fname=fname,
+                                starts=feeder.starts)
+    
+    def _call_partitioned(self, balanced, sequences, len_0):
+        """Submit the sequences as `nparts` partitions from our mapObject."""
         if balanced:
             if self.chunksize:
                 nparts = len_0/self.chunksize + int(len_0%self.chunksize > 0)
@@ -148,8 +220,12 @@ class ParallelFunction(RemoteFunction):
             nparts = len(targets)
         
         msg_ids = []
-        # my_f = lambda *a: map(self.func, *a)
         client = self.view.client
+        f, head = self._applied()
+        # where each chunk starts, if they are contiguous
+        contiguous = self.mapObject.__class__ is Map.Map
+        starts = [] if contiguous else None
+        start = 0
         for index, t in enumerate(targets):
             args = []
             for seq in sequences:
@@ -161,28 +237,14 @@ class ParallelFunction(RemoteFunction):
             if not args:
                 continue
             
-            # print (args)
-            if hasattr(self, '_map'):
-                f = map
-                args = [self.func]+args
-            else:
-                f=self.func
-            
             view = self.view if balanced else client[t]
-            with view.temp_flags(block=False, **self.flags):
-                ar = view.apply(f, *args)
-            
-            msg_ids.append(ar.msg_ids[0])
-        
-        r = AsyncMapResult(self.view.client, msg_ids, self.mapObject, fname=self.func.__name__)
+            msg_ids.append(self._submit(view, f, head+args))
+            if contiguous:
+                starts.append(start)
+                start += len(args[0])
         
-        if self.block:
-            try:
-                return r.get()
-            except KeyboardInterrupt:
-                return r
-        else:
-            return r
+        return AsyncMapResult(self.view.client, msg_ids, self.mapObject,
+                                fname=self.func.__name__, starts=starts)
     
     def map(self, *sequences):
         """call a function on each element of a sequence remotely. 
@@ -197,4 +259,234 @@ class ParallelFunction(RemoteFunction):
             del self._map
         return ret
 
-__all__ = ['remote', 'parallel', 'RemoteFunction', 'ParallelFunction']
+
+def _seconds(td):
+    """A timedelta in seconds (timedelta.total_seconds is new in 2.7)."""
+    return td.days*86400 + td.seconds + td.microseconds*1e-6
+
+def _record_times(schedule, n, md):
+    """Tell a chunk schedule how long a chunk of `n` items took, from its metadata."""
+    if md is None or None in (md['started'], md['completed'], md['submitted'], md['received']):
+        return
+    elapsed = _seconds(md['completed'] - md['started'])
+    overhead = _seconds(md['received'] - md['submitted']) - elapsed
+    schedule.record(n, elapsed, overhead)
+
+class ChunkFeeder(object):
+    """Submit contiguous chunks of a load-balanced map, as a chunk schedule says.
+    
+    With a schedule that needs no feedback, the first `feed` submits
+    everything.  Otherwise, about two chunks per engine are kept in flight,
+    and each `feed` reports the run times of finished chunks to the schedule
+    before submitting more.  The Client calls `feed` each time it spins, until
+    the whole map has been submitted.
+    """
+    
+    def __init__(self, pf, sequences, schedule, nengines):
+        self.pf = pf
+        self.sequences = sequences
+        self.schedule = schedule
+        self.client = pf.view.client
+        # ParallelFunction.map only sets _map during the call
+        self.f, self.head = pf._applied()
+        self.nitems = len(sequences[0])
+        self.window = 2*max(1, nengines)
+        self.offset = 0
+        self.msg_ids = []
+        # the index of the first item of each chunk
+        self.starts = []
+        # [msg_id, n] for chunks whose run time the schedule hasn't seen
+        self.inflight = []
+        # the AsyncAdaptiveMapResult, which holds the results of new chunks
+        self.result = None
+        self._feeding = False
+        if schedule.adaptive:
+            self.client._feeders.append(self)
+    
+    @property
+    def done(self):
+        """Whether every chunk has been submitted."""
+        return self.offset >= self.nitems
+    
+    def _measure(self):
+        """Tell the schedule about chunks that have finished."""
+        still = []
+        for msg_id, n in self.inflight:
+            if msg_id in self.client.outstanding:
+                still.append((msg_id, n))
+                continue
+            _record_times(self.schedule, n, self.client.metadata.get(msg_id))
+        self.inflight = still
+    
+    def feed(self):
+        """Submit as many chunks as we should have in flight."""
+        if self._feeding or self.done:
+            return
+        # submitting spins the client, which calls us again
+        self._feeding = True
+        first = len(self.msg_ids)
+        try:
+            if self.schedule.adaptive:
+                self._measure()
+                window = self.window
+            else:
+                window = self.nitems
+            while len(self.inflight) < window and not self.done:
+                n = self.schedule.next_chunk(self.nitems - self.offset)
+                lo, hi = self.offset, self.offset+n
+                args = self.head + [ seq[lo:hi] for seq in self.sequences ]
+                msg_id = self.pf._submit(self.pf.view, self.f, args)
+                self.msg_ids.append(msg_id)
+                self.starts.append(lo)
+                self.inflight.append((msg_id, n))
+                self.offset = hi
+        finally:
+            self._feeding = False
+        ar = self.result() if self.result is not None else None
+        if ar is not None and len(self.msg_ids) > first:
+            self.client._hold(ar, self.msg_ids[first:])
+        if self.done and self in self.client._feeders:
+            self.client._feeders.remove(self)
+    
+    def wait_any(self, timeout=-1):
+        """Wait for the oldest chunk in flight."""
+        if self.inflight:
+            self.client.wait([self.inflight[0][0]], timeout)
+
+
+class ChunkStream(object):
+    """Map a function over iterators, a chunk at a time.
+    
+    Unlike ParallelFunction, nothing is partitioned up front: chunks are read
+    from the iterators as they are submitted, and at most `window` chunks
+    are submitted but not yet consumed.  Results are yielded lazily, in
+    order or as they finish, and let go of once they have been yielded, so
+    the client's memory does not grow with the length of the input.
+    
+    Parameters
+    ----------
+    
+    view : LoadBalancedView
+        The view on which to submit chunks.
+    f : callable
+        The function to map.
+    iterables : list of iterables
+        The arguments, as for ``itertools.imap``.
+    chunksize : int or 'auto'
+        The number of items in each chunk, or 'auto' to size chunks from
+        their run times, as with AdaptiveChunks.
+    window : int
+        The most chunks to have submitted but not consumed
+        [default: twice the number of engines]
+    ordered : bool
+        Whether to yield results in order, or ``(index, result)`` pairs as
+        they finish.
+    """
+    
+    def __init__(self, view, f, iterables, chunksize=1, window=None, ordered=True):
+        self.view = view
+        self.client = view.client
+        self.f = f
+        self.items = izip(*iterables)
+        pf = ParallelFunction(view, f, chunksize=chunksize)
+        self.schedule = pf._schedule()
+        if self.schedule is not None and not self.schedule.adaptive:
+            raise ValueError("chunksize %r needs the length of the input"%chunksize)
+        self.chunksize = max(1, chunksize) if self.schedule is None else None
+        nengines = pf._nengines()
+        if self.schedule is not None:
+            self.schedule.start(None, nengines)
+        if window is None:
+            window = 2*max(1, nengines)
+        self.window = window
+        self.ordered = ordered
+        self.exhausted = False
+        self.offset = 0
+        # (msg_id, start, n) of each chunk submitted but not consumed
+        self.chunks = deque()
+        # (start, n) by msg_id of the chunks unordered iteration waits for,
+        # which also count against the window
+        self.pending = {}
+    
+    def _submit_chunk(self):
+        """Read and submit the next chunk, returning whether there was one."""
+        if self.schedule is None:
+            n = self.chunksize
+        else:
+            n = self.schedule.next_chunk(sys.maxint)
+        items = list(islice(self.items, n))
+        if len(items) < n:
+            self.exhausted = True
+        if not items:
+            return False
+        args = [self.f] + map(list, zip(*items))
+        with self.view.temp_flags(block=False):
+            ar = self.view.apply(map, *args)
+        self.chunks.append((ar.msg_ids[0], self.offset, len(items)))
+        self.offset += len(items)
+        return True
+    
+    def _fill(self):
+        """Submit chunks until the window is full."""
+        while not self.exhausted and len(self.chunks) + len(self.pending) < self.window:
+            if not self._submit_chunk():
+                break
+    
+    def _consume(self, msg_id, n):
+        """The result list of a finished chunk, which we then let go of."""
+        client = self.client
+        if self.schedule is not None:
+            _record_times(self.schedule, n, client.metadata.get(msg_id))
+        try:
+            return AsyncResult(client, msg_id, self.f.__name__).get()
+        finally:
+            client._forget_result(msg_id)
+            self.view.outstanding.discard(msg_id)
+            self.view.results.pop(msg_id, None)
+    
+    def __iter__(self):
+        if self.ordered:
+            return self._iter_ordered()
+        else:
+            return self._iter_unordered()
+    
+    def _iter_ordered(self):
+        client = self.client
+        while True:
+            self._fill()
+            if not self.chunks:
+                break
+            msg_id, start, n = self.chunks[0]
+            if msg_id in client.outstanding:
+                client._wait_for(set([msg_id]))
+            self.chunks.popleft()
+            for r in self._consume(msg_id, n):
+                yield r
+    
+    def _iter_unordered(self):
+        client = self.client
+        pending = self.pending
+        seen = -1
+        while True:
+            self._fill()
+            for msg_id, start, n in self.chunks:
+                pending[msg_id] = (start, n)
+            self.chunks.clear()
+            if not pending:
+                break
+            # anything could have finished while we were submitting or yielding
+            if seen != client._finish_count:
+                done = [ msg_id for msg_id in pending if msg_id not in client.outstanding ]
+            else:
+                done = []
+            if not done:
+                waiting = set(pending)
+                done = client._wait_for(waiting, first=True)
+            seen = client._finish_count
+            for msg_id in done:
+                start, n = pending.pop(msg_id)
+                for i, r in enumerate(self._consume(msg_id, n)):
+                    yield start+i, r
+
+
+__all__ = ['remote', 'parallel', 'RemoteFunction', 'ParallelFunction', 'ChunkStream']
@@ -12,6 +12,7 @@
 
 import imp
 import sys
+import uuid
 import warnings
 from contextlib import contextmanager
 from types import ModuleType
@@ -27,7 +28,7 @@ from IPython.parallel.controller.dependency import Dependency, dependent
 
 from . import map as Map
 from .asyncresult import AsyncResult, AsyncMapResult
-from .remotefunction import ParallelFunction, parallel, remote
+from .remotefunction import ParallelFunction, ChunkStream, parallel, remote
 
 #-----------------------------------------------------------------------------
 # Decorators
@@ -53,8 +54,10 @@ def sync_results(f, self, *args, **kwargs):
     delta = self.outstanding.difference(self.client.outstanding)
     completed = self.outstanding.intersection(delta)
     self.outstanding = self.outstanding.difference(completed)
-    for msg_id in completed:
-        self.results[msg_id] = self.client.results[msg_id]
+    if self.client.retention == 'all':
+        # otherwise, the client decides how long results are kept
+        for msg_id in completed:
+            self.results[msg_id] = self.client.results[msg_id]
     return ret
 
 @decorator
@@ -513,9 +516,10 @@ class DirectView(View):
         _idents = self.client._build_targets(targets)[0]
         msg_ids = []
         trackers = []
-        for ident in _idents:
-            msg = self.client.send_apply_message(self._socket, f, args, kwargs, track=track,
-                                    ident=ident)
+        # pack once, and send the same buffers to every engine
+        msgs = self.client.broadcast_apply_message(self._socket, f, args, kwargs,
+                                    track=track, idents=_idents)
+        for msg in msgs:
             if track:
                 trackers.append(msg['tracker'])
             msg_ids.append(msg['msg_id'])
@@ -637,7 +641,7 @@ class DirectView(View):
         # applier = self.apply_sync if block else self.apply_async
         if not isinstance(ns, dict):
             raise TypeError("Must be a dict, not %s"%type(ns))
-        return self._really_apply(util._push, (ns,), block=block, track=track, targets=targets)
+        return self._really_apply(util._push, kwargs=ns, block=block, track=track, targets=targets)
 
     def get(self, key_s):
         """get object(s) by `key_s` from remote namespace
@@ -666,28 +670,35 @@ class DirectView(View):
             raise TypeError("names must be strs, not %r"%names)
         return self._really_apply(util._pull, (names,), block=block, targets=targets)
     
+    @sync_results
+    @save_ids
     def scatter(self, key, seq, dist='b', flatten=False, targets=None, block=None, track=None):
         """
         Partition a Python sequence and send the partitions to a set of engines.
+        
+        Partitions of arrays are views of `seq`, and each is sent as soon as
+        it is packed, while the next one is packed.
         """
         block = block if block is not None else self.block
         track = track if track is not None else self.track
         targets = targets if targets is not None else self.targets
         
+        _idents, targets = self.client._build_targets(targets)
         mapObject = Map.dists[dist]()
-        nparts = len(targets)
+        nparts = len(_idents)
         msg_ids = []
         trackers = []
-        for index, engineid in enumerate(targets):
+        for index, ident in enumerate(_idents):
             partition = mapObject.getPartition(seq, index, nparts)
             if flatten and len(partition) == 1:
                 ns = {key: partition[0]}
             else:
                 ns = {key: partition}
-            r = self.push(ns, block=False, track=track, targets=engineid)
-            msg_ids.extend(r.msg_ids)
+            msg = self.client.send_apply_message(self._socket, util._push, kwargs=ns,
+                                                track=track, ident=ident)
+            msg_ids.append(msg['msg_id'])
             if track:
-                trackers.append(r._tracker)
+                trackers.append(msg['tracker'])
         
         if track:
             tracker = zmq.MessageTracker(*trackers)
@@ -723,6 +734,82 @@ class DirectView(View):
                 pass
         return r
     
+    @sync_results
+    @save_ids
+    def broadcast(self, key, obj, targets=None, block=None, track=None):
+        """
+        Send `obj` to a set of engines, as `key` in their namespaces.
+        
+        Only the first engine is sent `obj`.  The engines send it on to each
+        other over a binomial tree, so it reaches all of them in log2(n) steps.
+        
+        An engine waits for the others for up to its `peer_timeout`, and then
+        raises a TimeoutError.  Engines run requests in order, so collectives
+        from different clients over overlapping engines must not run at the
+        same time, or they can wait for each other until they time out.
+        """
+        block = block if block is not None else self.block
+        track = track if track is not None else self.track
+        targets = targets if targets is not None else self.targets
+        
+        _idents, targets = self.client._build_targets(targets)
+        tag = str(uuid.uuid4())
+        msgs = [ self.client.send_apply_message(self._socket, util._broadcast,
+                                        (key, targets, tag, obj), track=track, ident=_idents[0]) ]
+        msgs.extend(self.client.broadcast_apply_message(self._socket, util._broadcast,
+                                        (key, targets, tag), idents=_idents[1:]))
+        msg_ids = [ msg['msg_id'] for msg in msgs ]
+        tracker = msgs[0]['tracker'] if track else None
+        
+        r = AsyncResult(self.client, msg_ids, fname='broadcast', targets=targets, tracker=tracker)
+        if block:
+            r.wait()
+        else:
+            return r
+    
+    def _collective_reduce(self, f, key, dest, targets, block):
+        block = block if block is not None else self.block
+        targets = targets if targets is not None else self.targets
+        
+        _idents, targets = self.client._build_targets(targets)
+        tag = str(uuid.uuid4())
+        msgs = self.client.broadcast_apply_message(self._socket, util._reduce,
+                                        (f, key, targets, tag, dest), idents=_idents)
+        # the result comes back from the first engine only
+        fname = 'reduce' if dest is None else 'allreduce'
+        r = AsyncResult(self.client, msgs[0]['msg_id'], fname=fname, targets=targets[0])
+        if block:
+            try:
+                return r.get()
+            except KeyboardInterrupt:
+                pass
+        return r
+    
+    @sync_results
+    @save_ids
+    def reduce(self, f, key, targets=None, block=None):
+        """
+        Reduce `key` on a set of engines with `f`, in the order of the engines.
+        
+        The engines combine their values with f(a, b) up a binomial tree, so
+        only the result comes back, from the first engine.  See `broadcast`
+        on timeouts, and on running collectives at the same time.
+        """
+        return self._collective_reduce(f, key, None, targets, block)
+    
+    @sync_results
+    @save_ids
+    def allreduce(self, f, key, dest=None, targets=None, block=None):
+        """
+        Reduce `key` on a set of engines with `f`, as `reduce` does, and
+        store the result as `dest` (default: `key`) on all of them.
+        
+        The result is broadcast down the tree it was reduced up, and also
+        returned.
+        """
+        dest = key if dest is None else dest
+        return self._collective_reduce(f, key, dest, targets, block)
+    
     def __getitem__(self, key):
         return self.get(key)
     
@@ -791,9 +878,12 @@ class LoadBalancedView(View):
     after=Any()
     timeout=CFloat()
     retries = CInt(0)
+    affinity=Any()
+    priority = CInt(0)
     
     _task_scheme = Any()
-    _flag_names = List(['targets', 'block', 'track', 'follow', 'after', 'timeout', 'retries'])
+    _flag_names = List(['targets', 'block', 'track', 'follow', 'after', 'timeout', 'retries',
+                        'affinity', 'priority'])
     
     def __init__(self, client=None, socket=None, **flags):
         super(LoadBalancedView, self).__init__(client=client, socket=socket, **flags)
@@ -834,6 +924,17 @@ class LoadBalancedView(View):
         else:
             # pass to Dependency constructor
             return list(Dependency(dep))
+    
+    def _render_affinity(self, affinity):
+        """helper for building the dict of data sizes by msg_id of `affinity`."""
+        if affinity is None:
+            return {}
+        if isinstance(affinity, (str, AsyncResult)):
+            affinity = [affinity]
+        refs = [ a for a in affinity if isinstance(a, AsyncResult) ]
+        rendered = dict( (a, 0) for a in affinity if isinstance(a, str) )
+        rendered.update(self.client._affinity(refs))
+        return rendered
 
     def set_flags(self, **kwargs):
         """set my attribute flags by keyword.
@@ -872,9 +973,25 @@ class LoadBalancedView(View):
 
         retries : int
             Number of times a task will be retried on failure.
+
+        affinity : AsyncResult, ObjectRef, msg_id or collection of them
+            Only for load-balanced execution (targets=None)
+            Data the job will use.  The scheduler prefers engines that
+            already hold it, against their load.  The AsyncResults and
+            ObjectRefs passed to a job are always in its affinity.
+
+        priority : int
+            Only for load-balanced execution (targets=None)
+            Jobs waiting in the scheduler run in order of priority, highest
+            first.  The default is 0.
         """
         
         super(LoadBalancedView, self).set_flags(**kwargs)
+        if 'affinity' in kwargs:
+            value = kwargs['affinity']
+            if isinstance(value, dict) or not self._validate_dependency(value):
+                raise ValueError("Invalid affinity: %r"%value)
+            self.affinity = value
         for name in ('follow', 'after'):
             if name in kwargs:
                 value = kwargs[name]
@@ -895,7 +1012,8 @@ class LoadBalancedView(View):
     @save_ids
     def _really_apply(self, f, args=None, kwargs=None, block=None, track=None,
                                         after=None, follow=None, timeout=None,
-                                        targets=None, retries=None):
+                                        targets=None, retries=None, affinity=None,
+                                        priority=None):
         """calls f(*args, **kwargs) on a remote engine, returning the result.
         
         This method temporarily sets all of `apply`'s flags for a single call.
@@ -938,8 +1056,8 @@ class LoadBalancedView(View):
         if self._task_scheme == 'pure':
             # pure zmq scheme doesn't support extra features
             msg = "Pure ZMQ scheduler doesn't support the following flags:"
-            "follow, after, retries, targets, timeout"
-            if (follow or after or retries or targets or timeout):
+            "follow, after, retries, targets, timeout, priority"
+            if (follow or after or retries or targets or timeout or priority):
                 # hard fail on Scheduler flags
                 raise RuntimeError(msg)
             if isinstance(f, dependent):
@@ -956,9 +1074,13 @@ class LoadBalancedView(View):
         follow = self.follow if follow is None else follow
         timeout = self.timeout if timeout is None else timeout
         targets = self.targets if targets is None else targets
+        affinity = self.affinity if affinity is None else affinity
+        priority = self.priority if priority is None else priority
         
         if not isinstance(retries, int):
             raise TypeError('retries must be int, not %r'%type(retries))
+        if not isinstance(priority, int):
+            raise TypeError('priority must be int, not %r'%type(priority))
 
         if targets is None:
             idents = []
@@ -967,7 +1089,9 @@ class LoadBalancedView(View):
         
         after = self._render_dependency(after)
         follow = self._render_dependency(follow)
-        subheader = dict(after=after, follow=follow, timeout=timeout, targets=idents, retries=retries)
+        affinity = self._render_affinity(affinity)
+        subheader = dict(after=after, follow=follow, timeout=timeout, targets=idents, retries=retries,
+                        affinity=affinity, priority=priority)
         
         msg = self.client.send_apply_message(self._socket, f, args, kwargs, track=track,
                                 subheader=subheader)
@@ -1008,8 +1132,11 @@ class LoadBalancedView(View):
             whether to create a MessageTracker to allow the user to 
             safely edit after arrays and buffers during non-copying
             sends.
-        chunksize : int
+        chunksize : int, 'guided', or 'auto'
             how many elements should be in each task [default 1]
+            'guided' starts with large tasks, which shrink toward the end.
+            'auto' sizes tasks from the run times of the first results,
+            to about 0.1s each.  Either way, results are still in order.
         
         Returns
         -------
@@ -1037,5 +1164,44 @@ class LoadBalancedView(View):
         
         pf = ParallelFunction(self, f, block=block,  chunksize=chunksize)
         return pf.map(*sequences)
+    
+    def imap_unordered(self, f, *sequences, **kwargs):
+        """view.imap_unordered(f, *sequences, chunksize=1) => iterator
+        
+        Like `map`, but iterate through ``(index, result)`` pairs in the order
+        that they finish, where `index` is the position of the result in
+        ``map(f, *sequences)``.  A slow task then holds up only its own results.
+        
+        `chunksize` can be specified by keyword only, as in `map`.
+        """
+        chunksize = kwargs.pop('chunksize', 1)
+        if kwargs:
+            raise TypeError("Invalid kwargs: %s"%kwargs.keys())
+        ar = self.map(f, *sequences, block=False, chunksize=chunksize)
+        return ar._iter_unordered()
+    
+    def imap(self, f, *iterables, **kwargs):
+        """view.imap(f, *iterables, chunksize=1, window=None, ordered=True) => iterator
+        
+        Like `itertools.imap`, a lazy `map` over any iterables, such as the
+        lines of a file.  Items are read and submitted a chunk at a time, with
+        at most `window` chunks [default: twice the number of engines]
+        submitted but not yet consumed, so the whole input never has to be
+        in memory.  Results are let go of as soon as they are yielded.
+        
+        `chunksize` may be an int or 'auto', as in `map`.  With
+        ``ordered=False``, iterate through ``(index, result)`` pairs in the
+        order that they finish, as in `imap_unordered`.
+        
+        All arguments but `f` and the iterables are keyword only.
+        """
+        chunksize = kwargs.pop('chunksize', 1)
+        window = kwargs.pop('window', None)
+        ordered = kwargs.pop('ordered', True)
+        if kwargs:
+            raise TypeError("Invalid kwargs: %s"%kwargs.keys())
+        assert len(iterables) > 0, "must have some iterables to map onto!"
+        return iter(ChunkStream(self, f, iterables, chunksize=chunksize,
+                                window=window, ordered=ordered))
 
 __all__ = ['LoadBalancedView', 'DirectView']
@@ -109,7 +109,7 @@ class ControllerFactory(HubFactory):
             sargs = (self.client_info['task'][1], self.engine_info['task'],
                                 self.monitor_url, self.client_info['notification'])
             kwargs = dict(scheme=self.scheme,logname=self.log.name, loglevel=self.log.level,
-                                                            config=dict(self.config))
+                            config=dict(self.config), control_addr=self.client_info['control'])
             q = Process(target=launch_scheduler, args=sargs, kwargs=kwargs)
             q.daemon=True
             children.append(q)
@@ -122,9 +122,11 @@ class Dependency(set):
         as soon as the first depended-upon task fails.
     """
     
+    # class defaults match the constructor, and are only overridden per-instance
+    # when they differ, so most instances don't need a __dict__
     all=True
     success=True
-    failure=True
+    failure=False
     
     def __init__(self, dependencies=[], all=True, success=True, failure=False):
         if isinstance(dependencies, dict):
@@ -147,11 +149,14 @@ class Dependency(set):
                 raise TypeError("invalid dependency type: %r"%type(d))
         
         set.__init__(self, ids)
-        self.all = all
         if not (success or failure):
             raise ValueError("Must depend on at least one of successes or failures!")
-        self.success=success
-        self.failure = failure
+        if all != self.all:
+            self.all = all
+        if success != self.success:
+            self.success = success
+        if failure != self.failure:
+            self.failure = failure
     
     def check(self, completed, failed=None):
         """check whether our dependencies have been met."""
@@ -33,6 +33,15 @@ This may be extended, but is currently.
 
 We support a subset of mongodb operators:
     $lt,$gt,$lte,$gte,$ne,$in,$nin,$all,$mod,$exists
+
+DictDB keeps an Index of msg_ids for each of the keys in DictDB.indexes.
+Queries with equality, $in or range tests on an indexed key (or on msg_id)
+only check the records the most selective of those tests allows, rather
+than scanning every record.
+
+DictDB can also be capped with record_limit and size_limit.  Past either
+limit, the records completed longest ago are culled: forgotten, or with
+DictDB.spill moved to an SQLiteDB, which is searched along with memory.
 """
 #-----------------------------------------------------------------------------
 #  Copyright (C) 2010  The IPython Development Team
@@ -42,19 +51,22 @@ We support a subset of mongodb operators:
 #-----------------------------------------------------------------------------
 
 
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from datetime import datetime
 
 from IPython.config.configurable import Configurable
 
-from IPython.utils.traitlets import Dict, CUnicode
+from IPython.utils.traitlets import Bool, Dict, CUnicode, Instance, Int, List
 
+# as in SQL, None is never matched by an ordering test
 filters = {
- '$lt' : lambda a,b: a < b,
- '$gt' : lambda a,b: b > a,
+ '$lt' : lambda a,b: a is not None and a < b,
+ '$gt' : lambda a,b: a is not None and a > b,
  '$eq' : lambda a,b: a == b,
  '$ne' : lambda a,b: a != b,
- '$lte': lambda a,b: a <= b,
- '$gte': lambda a,b: a >= b,
+ '$lte': lambda a,b: a is not None and a <= b,
+ '$gte': lambda a,b: a is not None and a >= b,
  '$in' : lambda a,b: a in b,
  '$nin': lambda a,b: a not in b,
  '$all': lambda a,b: all([ a in bb for bb in b ]),
@@ -62,6 +74,9 @@ filters = {
  '$exists' : lambda a,b: (b and a is not None) or (a is None and not b)
 }
 
+# the filters an ordered Index can answer
+range_ops = set(['$lt', '$gt', '$lte', '$gte'])
+
 
 class CompositeFilter(object):
     """Composite filter for matching multiple properties."""
@@ -79,6 +94,122 @@ class CompositeFilter(object):
                 return False
         return True
 
+
+def make_tests(check):
+    """Turn a mongodb-style search dict into a dict by key of tests of
+    record values."""
+    tests = {}
+    for k,v in check.iteritems():
+        if isinstance(v, dict):
+            tests[k] = CompositeFilter(v)
+        else:
+            tests[k] = lambda o, v=v: o==v
+    return tests
+
+
+class Index(object):
+    """An index of msg_ids by the value of one record key.
+
+    `values` maps each value to the set of msg_ids with that value.  The
+    distinct values other than None are also kept sorted, for range queries
+    and ordered iteration.  Values that are dropped stay in the sorted list
+    until it is mostly stale, so removal is O(1).  If the values cannot be
+    ordered, `ordered` becomes False and only equality lookups are used.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.ordered = True
+        self._keys = []
+        self._stale = 0
+
+    def add(self, value, msg_id):
+        """Add msg_id under value.
+
+        Raises TypeError if value is unhashable.
+        """
+        ids = self.values.get(value)
+        if ids is None:
+            ids = self.values[value] = set()
+            if value is not None and self.ordered:
+                self._insert(value)
+        ids.add(msg_id)
+
+    def remove(self, value, msg_id):
+        """Remove msg_id from under value."""
+        ids = self.values[value]
+        ids.discard(msg_id)
+        if not ids:
+            del self.values[value]
+            if value is not None and self.ordered:
+                self._stale += 1
+                if self._stale > 32 and 2*self._stale > len(self._keys):
+                    self._keys = [ key for key in self._keys if key in self.values ]
+                    self._stale = 0
+
+    def _insert(self, value):
+        keys = self._keys
+        try:
+            if not keys or value > keys[-1]:
+                # the common case: timestamps arrive in order
+                keys.append(value)
+                return
+            i = bisect_left(keys, value)
+        except TypeError:
+            self.ordered = False
+            self._keys = []
+            return
+        if i < len(keys) and keys[i] == value:
+            # a stale key has come back
+            self._stale -= 1
+        else:
+            keys.insert(i, value)
+
+    def lookup(self, values):
+        """The number of msg_ids with any of `values`, and an iterator over them."""
+        found = []
+        for value in values:
+            ids = self.values.get(value)
+            if ids:
+                found.append(ids)
+        return sum(map(len, found)), (m for ids in found for m in ids)
+
+    def span(self, tests):
+        """The number of values that may pass the range tests in `tests`,
+        and an iterator over their msg_ids.
+
+        Raises TypeError if the bounds cannot be compared with the values.
+        """
+        keys = self._keys
+        lo, hi = 0, len(keys)
+        for op, bound in tests.iteritems():
+            if op == '$gt':
+                lo = max(lo, bisect_right(keys, bound))
+            elif op == '$gte':
+                lo = max(lo, bisect_left(keys, bound))
+            elif op == '$lt':
+                hi = min(hi, bisect_left(keys, bound))
+            elif op == '$lte':
+                hi = min(hi, bisect_right(keys, bound))
+        hi = max(lo, hi)
+        return hi-lo, self._iter_keys(keys[lo:hi])
+
+    def _iter_keys(self, keys):
+        values = self.values
+        for key in keys:
+            ids = values.get(key)
+            if ids:
+                for msg_id in ids:
+                    yield msg_id
+
+    def __iter__(self):
+        """Iterate through the msg_ids in order of value, None first."""
+        for msg_id in self.values.get(None, ()):
+            yield msg_id
+        for msg_id in self._iter_keys(self._keys):
+            yield msg_id
+
+
 class BaseDB(Configurable):
     """Empty Parent class so traitlets work on DB."""
     # base configurable traits:
@@ -95,6 +226,107 @@ class DictDB(BaseDB):
     """
     
     _records = Dict()
+    # the record keys to keep an Index for.  'submitted' is also
+    # used to order get_history.
+    indexes = List(['engine_uuid', 'client_uuid', 'completed', 'submitted'], config=True)
+    _indexes = Dict()
+    
+    # limits on the records kept in memory, 0 for no limit.  Past either one,
+    # completed records are culled, oldest completion first.  Pending records
+    # are never culled.
+    record_limit = Int(0, config=True)
+    # the limit on the total bytes of buffers and result_buffers
+    size_limit = Int(0, config=True)
+    # move culled records to an SQLiteDB (configured as usual, with
+    # SQLiteDB.location etc.), rather than forgetting them
+    spill = Bool(False, config=True)
+    
+    _size = Int(0)
+    # the msg_ids of completed records in memory, oldest completion first,
+    # kept only if there is a limit
+    _culls = Instance(OrderedDict, ())
+    _overflow = Instance(BaseDB)
+    
+    def __init__(self, **kwargs):
+        super(DictDB, self).__init__(**kwargs)
+        self._build_indexes()
+        if self.spill:
+            # imported here, since sqlitedb imports BaseDB from us
+            from .sqlitedb import SQLiteDB
+            self._overflow = SQLiteDB(session=self.session, config=self.config)
+    
+    def _indexes_changed(self, name, old, new):
+        self._build_indexes()
+    
+    def _build_indexes(self):
+        self._indexes = dict( (key, Index()) for key in self.indexes )
+        for msg_id, rec in self._records.iteritems():
+            self._index_record(msg_id, rec)
+    
+    def _index_record(self, msg_id, rec):
+        for key, index in self._indexes.items():
+            try:
+                index.add(rec.get(key, None), msg_id)
+            except TypeError:
+                # unhashable values, this key can't be indexed
+                del self._indexes[key]
+    
+    def _unindex_record(self, msg_id, rec):
+        for key, index in self._indexes.iteritems():
+            index.remove(rec.get(key, None), msg_id)
+    
+    def _plan(self, check):
+        """Choose the most selective index for a query.
+        
+        Returns an iterator over a superset of the matching msg_ids,
+        or None if every record must be scanned.
+        """
+        best = None
+        for key, value in check.iteritems():
+            if key == 'msg_id':
+                plan = self._plan_msg_id(value)
+            elif key in self._indexes:
+                plan = self._plan_index(self._indexes[key], value)
+            else:
+                continue
+            if plan is not None and (best is None or plan[0] < best[0]):
+                best = plan
+        if best is None:
+            return None
+        return best[1]
+    
+    def _plan_msg_id(self, value):
+        if not isinstance(value, dict):
+            values = [value]
+        elif '$eq' in value:
+            values = [value['$eq']]
+        elif '$in' in value:
+            values = value['$in']
+        else:
+            return None
+        try:
+            values = set(values)
+        except TypeError:
+            return None
+        return len(values), iter(values)
+    
+    def _plan_index(self, index, value):
+        try:
+            if not isinstance(value, dict):
+                return index.lookup([value])
+            elif '$eq' in value:
+                return index.lookup([value['$eq']])
+            elif '$in' in value:
+                return index.lookup(set(value['$in']))
+            elif index.ordered:
+                tests = dict( (op, bound) for op, bound in value.iteritems()
+                                if op in range_ops and bound is not None )
+                if tests:
+                    return index.span(tests)
+        except TypeError:
+            # unhashable or incomparable test values, scan instead
+            pass
+        return None
     
     def _match_one(self, rec, tests):
         """Check if a specific record matches tests."""
@@ -106,18 +338,53 @@ class DictDB(BaseDB):
     def _match(self, check):
         """Find all the matches for a check dict."""
         matches = []
-        tests = {}
-        for k,v in check.iteritems():
-            if isinstance(v, dict):
-                tests[k] = CompositeFilter(v)
-            else:
-                tests[k] = lambda o: o==v
+        tests = make_tests(check)
+        
+        candidates = self._plan(check)
+        if candidates is None:
+            records = self._records.itervalues()
+        else:
+            _records = self._records
+            records = ( _records[m] for m in candidates if m in _records )
         
-        for rec in self._records.itervalues():
+        for rec in records:
             if self._match_one(rec, tests):
                 matches.append(rec)
         return matches
     
+    def _record_size(self, rec):
+        return sum(map(len, rec.get('buffers', None) or [])) + \
+                sum(map(len, rec.get('result_buffers', None) or []))
+    
+    def _over_limit(self):
+        return (self.record_limit and len(self._records) > self.record_limit) or \
+                (self.size_limit and self._size > self.size_limit)
+    
+    def _cull(self):
+        """Cull completed records until we are within our limits."""
+        culls = self._culls
+        while culls and self._over_limit():
+            msg_id = culls.popitem(last=False)[0]
+            rec = self._records[msg_id]
+            self._remove(msg_id)
+            if self._overflow is not None:
+                self._overflow.add_record(msg_id, rec)
+    
+    def _completed(self, msg_id, completed):
+        """Note when a record completed, or that it is pending again."""
+        if not (self.record_limit or self.size_limit):
+            return
+        self._culls.pop(msg_id, None)
+        if completed is not None:
+            self._culls[msg_id] = None
+    
+    def _remove(self, msg_id):
+        """Remove a record from memory."""
+        rec = self._records.pop(msg_id)
+        self._unindex_record(msg_id, rec)
+        self._size -= self._record_size(rec)
+        self._culls.pop(msg_id, None)
+    
     def _extract_subdict(self, rec, keys):
         """extract subdict of keys"""
         d = {}
@@ -131,26 +398,59 @@ class DictDB(BaseDB):
         if self._records.has_key(msg_id):
             raise KeyError("Already have msg_id %r"%(msg_id))
         self._records[msg_id] = rec
+        self._index_record(msg_id, rec)
+        self._size += self._record_size(rec)
+        self._completed(msg_id, rec.get('completed', None))
+        if self._over_limit():
+            self._cull()
     
     def get_record(self, msg_id):
         """Get a specific Task Record, by msg_id."""
         if not self._records.has_key(msg_id):
+            if self._overflow is not None:
+                return self._overflow.get_record(msg_id)
             raise KeyError("No such msg_id %r"%(msg_id))
         return self._records[msg_id]
     
     def update_record(self, msg_id, rec):
         """Update the data in an existing record."""
-        self._records[msg_id].update(rec)
+        if self._overflow is not None and msg_id not in self._records:
+            return self._overflow.update_record(msg_id, rec)
+        record = self._records[msg_id]
+        for key, index in self._indexes.items():
+            if key in rec:
+                old = record.get(key, None)
+                new = rec[key]
+                if old is not new:
+                    index.remove(old, msg_id)
+                    try:
+                        index.add(new, msg_id)
+                    except TypeError:
+                        del self._indexes[key]
+        if 'buffers' in rec or 'result_buffers' in rec:
+            self._size -= self._record_size(record)
+            record.update(rec)
+            self._size += self._record_size(record)
+        else:
+            record.update(rec)
+        if 'completed' in rec:
+            self._completed(msg_id, rec['completed'])
+        if self._over_limit():
+            self._cull()
     
     def drop_matching_records(self, check):
         """Remove a record from the DB."""
         matches = self._match(check)
         for m in matches:
-            del self._records[m['msg_id']]
+            self._remove(m['msg_id'])
+        if self._overflow is not None:
+            self._overflow.drop_matching_records(check)
         
     def drop_record(self, msg_id):
         """Remove a record from the DB."""
-        del self._records[msg_id]
+        if self._overflow is not None and msg_id not in self._records:
+            return self._overflow.drop_record(msg_id)
+        self._remove(msg_id)
         
     
     def find_records(self, check, keys=None):
@@ -169,12 +469,37 @@ class DictDB(BaseDB):
         """
         matches = self._match(check)
         if keys:
-            return [ self._extract_subdict(rec, keys) for rec in matches ]
-        else:
-            return matches
+            matches = [ self._extract_subdict(rec, keys) for rec in matches ]
+        if self._overflow is not None:
+            matches.extend(self._overflow.find_records(check, keys))
+        return matches
         
     
     def get_history(self):
         """get all msg_ids, ordered by time submitted."""
-        msg_ids = self._records.keys()
-        return sorted(msg_ids, key=lambda m: self._records[m]['submitted'])
+        index = self._indexes.get('submitted')
+        if index is not None and index.ordered:
+            msg_ids = list(index)
+        else:
+            msg_ids = self._records.keys()
+            msg_ids.sort(key=lambda m: self._records[m]['submitted'])
+        if self._overflow is not None:
+            # every culled record, without a list of msg_ids to match,
+            # which could be longer than SQLite allows
+            culled = self._overflow.find_records({'msg_id' : {'$ne' : None}}, ['submitted'])
+            if culled:
+                msg_ids = self._merge_history(culled, msg_ids)
+        return msg_ids
+    
+    def _merge_history(self, culled, msg_ids):
+        """merge the history of culled records, dicts of their msg_id and
+        submitted, into that of our own"""
+        submitted = {}
+        for rec in culled:
+            submitted[rec['msg_id']] = rec['submitted']
+        merged = submitted.keys() + msg_ids
+        for msg_id in msg_ids:
+            submitted[msg_id] = self._records[msg_id]['submitted']
+        # None first, as in the submitted Index
+        merged.sort(key=lambda m: (submitted[m] is not None, submitted[m]))
+        return merged
@@ -17,6 +17,7 @@ from __future__ import print_function
 
 import sys
 import time
+from collections import deque
 from datetime import datetime
 
 import zmq
@@ -93,6 +94,41 @@ def init_record(msg):
     }
 
 
+class TaskStats(object):
+    """Counts of the tasks of one client, with how long they waited to
+    start, and how many finished in the last `window` seconds."""
+    
+    window = 60
+    
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.waited = 0. # seconds between submission and start, in total
+        self.longest = 0. # the longest of those
+        self.finished = deque() # times the recent ones finished
+    
+    def submit(self):
+        self.submitted += 1
+    
+    def finish(self, wait=None):
+        """A task finished, `wait` seconds after it was submitted, if known."""
+        self.completed += 1
+        if wait is not None:
+            self.waited += wait
+            self.longest = max(self.longest, wait)
+        self.finished.append(time.time())
+    
+    def as_dict(self):
+        finished = self.finished
+        since = time.time() - self.window
+        while finished and finished[0] < since:
+            finished.popleft()
+        return dict(submitted=self.submitted, completed=self.completed,
+                    pending=self.submitted-self.completed,
+                    wait=self.waited/self.completed if self.completed else 0.,
+                    max_wait=self.longest, rate=float(len(finished))/self.window)
+
+
 class EngineConnector(HasTraits):
     """A simple object for accessing the various zmq connections of an object.
     Attributes are:
@@ -313,7 +349,11 @@ class Hub(LoggingFactory):
     completed=Dict() # completed msg_ids keyed by engine_id
     all_completed=Set() # completed msg_ids keyed by engine_id
     dead_engines=Set() # completed msg_ids keyed by engine_id
+    peers=Dict() # addresses of the engines' peer inboxes, keyed by engine_id
     unassigned=Set() # set of task msg_ds not yet assigned a destination
+    resubmits=Dict() # resubmit requests waiting for results to arrive, keyed by msg_id
+    task_stats=Dict() # TaskStats keyed by client_id
+    task_clients=Dict() # (client_id, submitted) of pending tasks keyed by msg_id
     incoming_registrations=Dict()
     registration_timeout=Int()
     _idcounter=Int(0)
@@ -379,12 +419,14 @@ class Hub(LoggingFactory):
                                 'history_request': self.get_history,
                                 'db_request': self.db_query,
                                 'purge_request': self.purge_results,
+                                'put_request': self.put_object,
                                 'load_request': self.check_load,
                                 'resubmit_request': self.resubmit_task,
                                 'shutdown_request': self.shutdown_request,
                                 'registration_request' : self.register_engine,
                                 'unregistration_request' : self.unregister_engine,
                                 'connection_request': self.connection_request,
+                                'peers_request': self.peers_request,
         }
         
         # ignore resubmit replies
@@ -563,6 +605,9 @@ class Hub(LoggingFactory):
             
         header = msg['header']
         msg_id = header['msg_id']
+        if msg_id in self.pending:
+            self._save_full_request(msg_id, msg)
+            return
         record = init_record(msg)
         record['engine_uuid'] = queue_id
         record['client_uuid'] = client_id
@@ -584,6 +629,14 @@ class Hub(LoggingFactory):
         self.pending.add(msg_id)
         self.queues[eid].append(msg_id)
     
+    def _save_full_request(self, msg_id, msg):
+        """Save the buffers of a pending request that the client sent again
+        in full, after an engine missed the function it was sent by digest."""
+        try:
+            self.db.update_record(msg_id, dict(buffers=msg['buffers']))
+        except Exception:
+            self.log.error("DB Error saving request %r"%msg_id, exc_info=True)
+    
     def save_queue_result(self, idents, msg):
         if len(idents) < 2:
             self.log.error("invalid identity prefix: %s"%idents)
@@ -607,6 +660,9 @@ class Hub(LoggingFactory):
         if not parent:
             return
         msg_id = parent['msg_id']
+        if not msg['header'].get('function_cached', True):
+            # the client sends it again in full
+            return
         if msg_id in self.pending:
             self.pending.remove(msg_id)
             self.all_completed.add(msg_id)
@@ -635,6 +691,7 @@ class Hub(LoggingFactory):
             self.db.update_record(msg_id, result)
         except Exception:
             self.log.error("DB Error updating record %r"%msg_id, exc_info=True)
+        self._release_resubmits(msg_id)
         
             
     #--------------------- Task Queue Traffic ------------------------------
@@ -649,14 +706,21 @@ class Hub(LoggingFactory):
             self.log.error("task::client %r sent invalid task message: %s"%(
                     client_id, msg), exc_info=True)
             return
+        header = msg['header']
+        msg_id = header['msg_id']
+        if msg_id in self.pending:
+            self._save_full_request(msg_id, msg)
+            return
         record = init_record(msg)
 
         record['client_uuid'] = client_id
         record['queue'] = 'task'
-        header = msg['header']
-        msg_id = header['msg_id']
         self.pending.add(msg_id)
         self.unassigned.add(msg_id)
+        if client_id not in self.task_stats:
+            self.task_stats[client_id] = TaskStats()
+        self.task_stats[client_id].submit()
+        self.task_clients[msg_id] = (client_id, record['submitted'])
         try:
             # it's posible iopub arrived first:
             existing = self.db.get_record(msg_id)
@@ -701,10 +765,13 @@ class Hub(LoggingFactory):
             self.log.warn("Task %r had no parent!"%msg)
             return
         msg_id = parent['msg_id']
+        header = msg['header']
+        if not header.get('function_cached', True):
+            # the client sends it again in full
+            return
         if msg_id in self.unassigned:
             self.unassigned.remove(msg_id)
         
-        header = msg['header']
         engine_uuid = header.get('engine', None)
         eid = self.by_ident.get(engine_uuid, None)
         
@@ -715,10 +782,17 @@ class Hub(LoggingFactory):
                 self.completed[eid].append(msg_id)
                 if msg_id in self.tasks[eid]:
                     self.tasks[eid].remove(msg_id)
+                else:
+                    # a backup copy was sent elsewhere, and this one won
+                    for tasks in self.tasks.itervalues():
+                        if msg_id in tasks:
+                            tasks.remove(msg_id)
+                            break
             completed = datetime.strptime(header['date'], util.ISO8601)
             started = header.get('started', None)
             if started is not None:
                 started = datetime.strptime(started, util.ISO8601)
+            self._finish_task_stats(msg_id, started)
             result = {
                 'result_header' : header,
                 'result_content': msg['content'],
@@ -732,10 +806,22 @@ class Hub(LoggingFactory):
                 self.db.update_record(msg_id, result)
             except Exception:
                 self.log.error("DB Error saving task request %r"%msg_id, exc_info=True)
+            self._release_resubmits(msg_id)
             
         else:
             self.log.debug("task::unknown task %s finished"%msg_id)
     
+    def _finish_task_stats(self, msg_id, started=None):
+        """Count task `msg_id` as finished for its client."""
+        if msg_id not in self.task_clients:
+            return
+        client_id, submitted = self.task_clients.pop(msg_id)
+        wait = None
+        if started is not None and submitted is not None:
+            delta = started - submitted
+            wait = max(0., delta.days*86400 + delta.seconds + 1e-6*delta.microseconds)
+        self.task_stats[client_id].finish(wait)
+    
     def save_task_destination(self, idents, msg):
         try:
             msg = self.session.unpack_message(msg, content=True)
@@ -751,9 +837,13 @@ class Hub(LoggingFactory):
         self.log.info("task::task %s arrived on %s"%(msg_id, eid))
         if msg_id in self.unassigned:
             self.unassigned.remove(msg_id)
-        # else:
-        #     self.log.debug("task::task %s not listed as MIA?!"%(msg_id))
-        
+        else:
+            # sent again, after an unmet dependency or preemption, or as a backup
+            for tasks in self.tasks.itervalues():
+                if msg_id in tasks:
+                    tasks.remove(msg_id)
+                    break
+
         self.tasks[eid].append(msg_id)
         # self.pending[msg_id][1].update(received=datetime.now(),engine=(eid,engine_uuid))
         try:
@@ -832,6 +922,15 @@ class Hub(LoggingFactory):
         content['engines'] = jsonable
         self.session.send(self.query, 'connection_reply', content, parent=msg, ident=client_id)
     
+    def peers_request(self, engine_id, msg):
+        """Reply with the peer addresses of the registered engines."""
+        peers = {}
+        for eid, info in self.peers.iteritems():
+            if eid in self.ids and self.keytable[eid] not in self.dead_engines:
+                peers[str(eid)] = info
+        content = dict(status='ok', peers=peers)
+        self.session.send(self.query, 'peers_reply', content, parent=msg, ident=engine_id)
+    
     def register_engine(self, reg, msg):
         """Register a new engine."""
         content = msg['content']
@@ -841,6 +940,7 @@ class Hub(LoggingFactory):
             self.log.error("registration::queue not specified", exc_info=True)
             return
         heart = content.get('heartbeat', None)
+        peer = content.get('peer', None)
         """register a new engine, and create the socket(s) necessary"""
         eid = self._next_id
         # print (eid, queue, reg, heart)
@@ -884,6 +984,8 @@ class Hub(LoggingFactory):
                 ident=reg)
         
         if content['status'] == 'ok':
+            if peer:
+                self.peers[eid] = peer
             if heart in self.heartmonitor.hearts:
                 # already beating
                 self.incoming_registrations[heart] = (eid,queue,reg[0],None)
@@ -952,6 +1054,7 @@ class Hub(LoggingFactory):
                 self.db.update_record(msg_id, rec)
             except Exception:
                 self.log.error("DB Error handling stranded msg %r"%msg_id, exc_info=True)
+            self._release_resubmits(msg_id)
                 
     
     def finish_registration(self, heart):
@@ -983,6 +1086,7 @@ class Hub(LoggingFactory):
     def _purge_stalled_registration(self, heart):
         if heart in self.incoming_registrations:
             eid = self.incoming_registrations.pop(heart)[0]
+            self.peers.pop(eid, None)
             self.log.info("registration::purging stalled registration: %i"%eid)
         else:
             pass
@@ -1051,6 +1155,8 @@ class Hub(LoggingFactory):
                 tasks = len(tasks)
             content[bytes(t)] = {'queue': queue, 'completed': completed , 'tasks': tasks}
         content['unassigned'] = list(self.unassigned) if verbose else len(self.unassigned)
+        content['clients'] = dict( (cid, stats.as_dict())
+                                    for cid, stats in self.task_stats.iteritems() )
         
         self.session.send(self.query, "queue_reply", content=content, ident=client_id)
     
@@ -1097,6 +1203,32 @@ class Hub(LoggingFactory):
         
         self.session.send(self.query, 'purge_reply', content=reply, ident=client_id)
     
+    def put_object(self, client_id, msg):
+        """Store an object from a client as the result of its put_request,
+        so that tasks can refer to it by msg_id."""
+        record = init_record(msg)
+        msg_id = record['msg_id']
+        now = datetime.now()
+        record.update({
+            'client_uuid' : client_id[0],
+            'queue' : 'store',
+            'buffers' : [],
+            'started' : now,
+            'completed' : now,
+            'result_header' : dict(date=now.strftime(util.ISO8601)),
+            'result_content' : dict(status='ok'),
+            'result_buffers' : msg['buffers'],
+        })
+        try:
+            self.db.add_record(msg_id, record)
+        except Exception:
+            reply = error.wrap_exception()
+            self.log.error("DB Error storing object %r"%msg_id, exc_info=True)
+        else:
+            self.all_completed.add(msg_id)
+            reply = dict(status='ok', msg_id=msg_id)
+        self.session.send(self.query, 'put_reply', content=reply, ident=client_id)
+    
     def resubmit_task(self, client_id, msg):
         """Resubmit one or more tasks."""
         def finish(reply):
@@ -1115,6 +1247,13 @@ class Hub(LoggingFactory):
         # validate msg_ids
         found_ids = [ rec['msg_id'] for rec in records ]
         invalid_ids = filter(lambda m: m in self.pending, found_ids)
+        if invalid_ids and set(content.get('finished', [])).issuperset(invalid_ids):
+            # the client has results that have not reached us on the monitor
+            # stream yet, so resubmit once they have
+            request = (set(invalid_ids), client_id, msg)
+            for msg_id in invalid_ids:
+                self.resubmits.setdefault(msg_id, []).append(request)
+            return
         if len(records) > len(msg_ids):
             try:
                 raise RuntimeError("DB appears to be in an inconsistent state."
@@ -1160,6 +1299,13 @@ class Hub(LoggingFactory):
         finish(dict(status='ok'))
 
     
+    def _release_resubmits(self, msg_id):
+        """`msg_id` is no longer pending, so resubmit requests waiting for it may go ahead."""
+        for waiting, client_id, msg in self.resubmits.pop(msg_id, []):
+            waiting.discard(msg_id)
+            if not waiting:
+                self.resubmit_task(client_id, msg)
+    
     def _extract_record(self, rec):
         """decompose a TaskRecord dict into subsection of reply for get_result"""
         io_dict = {}
@@ -1205,14 +1351,15 @@ class Hub(LoggingFactory):
         for msg_id in msg_ids:
             if msg_id in self.pending:
                 pending.append(msg_id)
-            elif msg_id in self.all_completed:
+            elif msg_id in self.all_completed and (statusonly or msg_id in records):
+                # (if it's not in records, it has been culled from the db)
                 completed.append(msg_id)
                 if not statusonly:
                     c,bufs = self._extract_record(records[msg_id])
                     content[msg_id] = c
                     buffers.extend(bufs)
             elif msg_id in records:
-                if rec['completed']:
+                if records[msg_id]['completed']:
                     completed.append(msg_id)
                     c,bufs = self._extract_record(records[msg_id])
                     content[msg_id] = c
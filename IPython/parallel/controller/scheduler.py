@@ -18,9 +18,13 @@ Python Scheduler exists.
 from __future__ import print_function
 
 import logging
+import math
 import sys
+import time
 
+from collections import deque
 from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
 from random import randint, random
 from types import FunctionType
 
@@ -35,11 +39,11 @@ from zmq.eventloop import ioloop, zmqstream
 # local imports
 from IPython.external.decorator import decorator
 from IPython.config.loader import Config
-from IPython.utils.traitlets import Instance, Dict, List, Set, Int
+from IPython.utils.traitlets import Instance, Dict, List, Set, Int, Float, Bool
 
 from IPython.parallel import error
 from IPython.parallel.factory import SessionFactory
-from IPython.parallel.util import connect_logger, local_logger
+from IPython.parallel.util import connect_logger, local_logger, ISO8601
 
 from .dependency import Dependency
 
@@ -111,12 +115,677 @@ def leastload(loads):
     """
     return loads.index(min(loads))
 
+#----------------------------------------------------------------------
+# Engine selection
+#----------------------------------------------------------------------
+
+class EngineSelector(object):
+    """Tracks the load and LRU stamp of each engine, and picks destinations.
+    
+    Engines are identified by their IDENTs.  `choose` picks from every engine
+    that is not full, and `choose_from` picks from an explicit set of candidates.
+    The base class calls a chooser function `scheme` on the loads of the candidates,
+    in LRU order, which is O(n) in the number of engines.  Subclasses keep indexed
+    structures for the builtin schemes, so `choose` does not touch every engine.
+    """
+    
+    def __init__(self, scheme=leastload, hwm=0):
+        self.scheme = scheme
+        self.hwm = hwm
+        self.limits = {} # dict by IDENT of hwm, for engines that have their own
+        self.loads = {} # dict by IDENT of outstanding tasks
+        self.stamps = {} # dict by IDENT of LRU stamps, oldest is lowest
+        self._head = 0 # stamp for the next new engine
+        self._tail = 0 # stamp for the next engine to get a job
+        # engines that are not full, with positions for O(1) removal:
+        self._room = []
+        self._pos = {}
+    
+    def __len__(self):
+        return len(self.loads)
+    
+    def __contains__(self, uid):
+        return uid in self.loads
+    
+    def limit(self, uid):
+        """The hwm of engine `uid`, 0 for none."""
+        return self.limits.get(uid, self.hwm)
+    
+    def set_limit(self, uid, limit):
+        """Give engine `uid` its own hwm."""
+        self.limits[uid] = limit
+        self._update(uid)
+    
+    def full(self, uid):
+        """Whether engine `uid` has hwm outstanding tasks."""
+        hwm = self.limits.get(uid, self.hwm)
+        return bool(hwm) and self.loads[uid] >= hwm
+    
+    def has_room(self):
+        """Whether any engine can take another task."""
+        return bool(self._room)
+    
+    def _open(self, uid):
+        if uid not in self._pos:
+            self._pos[uid] = len(self._room)
+            self._room.append(uid)
+    
+    def _close(self, uid):
+        idx = self._pos.pop(uid, None)
+        if idx is None:
+            return
+        last = self._room.pop()
+        if last != uid:
+            self._room[idx] = last
+            self._pos[last] = idx
+    
+    def _update(self, uid):
+        """Called after the load or stamp of `uid` changed."""
+        if self.full(uid):
+            self._close(uid)
+        else:
+            self._open(uid)
+    
+    def add_engine(self, uid):
+        """New engine, at the head of the line."""
+        self._head -= 1
+        self.loads[uid] = 0
+        self.stamps[uid] = self._head
+        self._update(uid)
+    
+    def remove_engine(self, uid):
+        self._close(uid)
+        del self.loads[uid]
+        del self.stamps[uid]
+        self.limits.pop(uid, None)
+    
+    def add_job(self, uid):
+        """`uid` just got a job, and goes to the back of the line."""
+        self.loads[uid] += 1
+        self.stamps[uid] = self._tail
+        self._tail += 1
+        self._update(uid)
+    
+    def finish_job(self, uid):
+        self.loads[uid] -= 1
+        self._update(uid)
+    
+    def choose_from(self, uids):
+        """Pick one of `uids` with the chooser function."""
+        uids = sorted(uids, key=self.stamps.get)
+        return uids[self.scheme([ self.loads[uid] for uid in uids ])]
+    
+    def choose(self, exclude=()):
+        """Pick an engine that is not full, and not in `exclude`.
+        
+        Returns None if there is no such engine.
+        """
+        uids = [ uid for uid in self._room if uid not in exclude ]
+        if uids:
+            return self.choose_from(uids)
+    
+
+class LeastLoadSelector(EngineSelector):
+    """Lowest load, then LRU, from a lazily updated heap."""
+    
+    def __init__(self, scheme=leastload, hwm=0):
+        EngineSelector.__init__(self, scheme, hwm)
+        self._heap = []
+    
+    def _key(self, uid):
+        return (self.loads[uid], self.stamps[uid])
+    
+    def _update(self, uid):
+        EngineSelector._update(self, uid)
+        if not self.full(uid):
+            heappush(self._heap, (self._key(uid), uid))
+        if len(self._heap) > 2*len(self.loads) + 64:
+            # drop stale entries
+            self._heap = [ (self._key(uid), uid) for uid in self._room ]
+            heapify(self._heap)
+    
+    def choose(self, exclude=()):
+        heap = self._heap
+        skipped = []
+        found = None
+        while heap:
+            key, uid = heap[0]
+            if uid not in self.loads or self.full(uid) or key != self._key(uid):
+                # stale entry
+                heappop(heap)
+            elif uid in exclude:
+                skipped.append(heappop(heap))
+            else:
+                found = uid
+                break
+        for entry in skipped:
+            heappush(heap, entry)
+        return found
+    
+
+class LRUSelector(LeastLoadSelector):
+    """Least recently used, from a lazily updated heap."""
+    
+    def _key(self, uid):
+        return self.stamps[uid]
+    
+
+class RandomSelector(EngineSelector):
+    """Uniform random pick."""
+    
+    # random picks to try before falling back on a full scan for `exclude`
+    tries = 8
+    
+    def _sample(self, exclude):
+        for i in xrange(self.tries):
+            uid = self._room[randint(0, len(self._room)-1)]
+            if uid not in exclude:
+                return uid
+        uids = [ uid for uid in self._room if uid not in exclude ]
+        if uids:
+            return uids[randint(0, len(uids)-1)]
+    
+    def choose(self, exclude=()):
+        if self._room:
+            return self._sample(exclude)
+    
+
+class TwoBinSelector(RandomSelector):
+    """Pick two at random, use the LRU of the two."""
+    
+    def choose(self, exclude=()):
+        if self._room:
+            a = self._sample(exclude)
+            if a is None:
+                return None
+            b = self._sample(exclude)
+            return min(a, b, key=self.stamps.get)
+    
+
+class FenwickTree(object):
+    """A binary indexed tree of non-negative weights.
+    
+    Supports O(log n) updates, and picking an index with probability
+    proportional to its weight.
+    """
+    
+    def __init__(self, weights=()):
+        self.rebuild(list(weights))
+    
+    def __len__(self):
+        return len(self.weights)
+    
+    def rebuild(self, weights=None):
+        """Rebuild the tree, which also discards accumulated rounding errors."""
+        if weights is not None:
+            self.weights = weights
+        n = len(self.weights)
+        self.tree = tree = [0.]+self.weights
+        for i in xrange(1, n+1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._updates = 0
+    
+    def __setitem__(self, i, w):
+        delta = w - self.weights[i]
+        self.weights[i] = w
+        tree = self.tree
+        n = len(self.weights)
+        i += 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+        self._updates += 1
+        if self._updates > 64*n:
+            self.rebuild()
+    
+    def __getitem__(self, i):
+        return self.weights[i]
+    
+    def append(self, w):
+        self.weights.append(w)
+        self.rebuild()
+    
+    def total(self):
+        i = len(self.weights)
+        s = 0.
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+    
+    def find(self, x):
+        """The index i such that sum(weights[:i]) <= x < sum(weights[:i+1])."""
+        n = len(self.weights)
+        pos = 0
+        step = 1
+        while 2*step <= n:
+            step *= 2
+        while step:
+            if pos + step <= n and self.tree[pos+step] <= x:
+                pos += step
+                x -= self.tree[pos]
+            step //= 2
+        return pos
+    
+    def sample(self):
+        """Weighted random index, or None if every weight is zero."""
+        t = self.total()
+        if t <= 0:
+            return None
+        i = self.find(random()*t)
+        if i >= len(self.weights) or self.weights[i] <= 0:
+            # rounding error, fall back on a linear pick
+            x = random()*sum(self.weights)
+            for i,w in enumerate(self.weights):
+                x -= w
+                if w > 0 and x < 0:
+                    return i
+            return None
+        return i
+    
+
+class WeightedSelector(RandomSelector):
+    """Pick two at random using inverse load as weight, and
+    return the less loaded of the two.
+    
+    Weights are kept in a FenwickTree, with weight zero for full engines.
+    """
+    
+    def __init__(self, scheme=weighted, hwm=0):
+        RandomSelector.__init__(self, scheme, hwm)
+        self._slots = {} # dict by IDENT of index in self._weights
+        self._uids = [] # IDENT by slot, None for free slots
+        self._free = []
+        self._weights = FenwickTree()
+    
+    def _update(self, uid):
+        RandomSelector._update(self, uid)
+        if self.full(uid):
+            w = 0.
+        else:
+            # weight 0 a million times more than 1:
+            w = 1./(1e-6+self.loads[uid])
+        self._weights[self._slots[uid]] = w
+    
+    def add_engine(self, uid):
+        if self._free:
+            slot = self._free.pop()
+            self._uids[slot] = uid
+        else:
+            slot = len(self._uids)
+            self._uids.append(uid)
+            self._weights.append(0.)
+        self._slots[uid] = slot
+        RandomSelector.add_engine(self, uid)
+    
+    def remove_engine(self, uid):
+        RandomSelector.remove_engine(self, uid)
+        slot = self._slots.pop(uid)
+        self._weights[slot] = 0.
+        self._uids[slot] = None
+        self._free.append(slot)
+    
+    def _sample(self, exclude):
+        for i in xrange(self.tries):
+            slot = self._weights.sample()
+            if slot is None:
+                return None
+            uid = self._uids[slot]
+            if uid not in exclude:
+                return uid
+        uids = [ uid for uid in self._room if uid not in exclude ]
+        if uids:
+            weights = [ 1./(1e-6+self.loads[uid]) for uid in uids ]
+            x = random()*sum(weights)
+            for uid,w in zip(uids, weights):
+                x -= w
+                if x < 0:
+                    break
+            return uid
+    
+    def choose(self, exclude=()):
+        if self._room:
+            a = self._sample(exclude)
+            if a is None:
+                return None
+            b = self._sample(exclude)
+            return min(a, b, key=self.loads.get)
+    
+
+# indexed selectors for the builtin chooser functions:
+selectors = {
+    plainrandom : RandomSelector,
+    lru : LRUSelector,
+    twobin : TwoBinSelector,
+    weighted : WeightedSelector,
+    leastload : LeastLoadSelector,
+}
+
+def make_selector(scheme, hwm=0):
+    """Build the EngineSelector for a chooser function."""
+    cls = selectors.get(scheme, EngineSelector)
+    return cls(scheme, hwm)
+
+
+def run_time(header):
+    """The seconds a task ran, from the header of its reply, or None."""
+    try:
+        started = datetime.strptime(header['started'], ISO8601)
+        completed = datetime.strptime(header['date'], ISO8601)
+    except (KeyError, ValueError):
+        return None
+    delta = completed - started
+    return delta.days*86400 + delta.seconds + 1e-6*delta.microseconds
+
+
+class Pacer(object):
+    """Sets the hwm of each engine from how long its tasks take to run, and
+    how long a task takes to get to it and back.
+    
+    An engine with only the task it is running is idle for a round trip after
+    each one, so it gets enough more to cover the round trip, unless that would
+    keep it idle less than `idle` of the time anyway, so long tasks are not
+    hoarded.  Both times are moving averages.  A round trip is only measured
+    for tasks sent to an engine with nothing else to do.  Durations are
+    forgotten when an engine runs out of work, since the next tasks may take
+    a different time, and until one of them finishes the hwm is `initial`.
+    """
+    
+    idle = 0.05 # the fraction of the time engines may be idle, to not prefetch
+    smoothing = 0.2 # weight of the newest time in the averages
+    
+    def __init__(self, initial=2, maximum=32):
+        self.initial = initial
+        self.maximum = maximum
+        self.durations = {} # dict by IDENT of seconds tasks run
+        self.latencies = {} # dict by IDENT of seconds from sending a task to its reply, less the run
+    
+    def remove_engine(self, uid):
+        self.durations.pop(uid, None)
+        self.latencies.pop(uid, None)
+    
+    def forget(self, uid):
+        """Engine `uid` ran out of work."""
+        self.durations.pop(uid, None)
+    
+    def _average(self, averages, uid, t):
+        old = averages.get(uid)
+        if old is None:
+            averages[uid] = t
+        else:
+            averages[uid] = old + self.smoothing * (t - old)
+    
+    def finished(self, uid, duration, turnaround=None):
+        """A task ran on `uid` for `duration` seconds.  `turnaround` is the
+        seconds from sending it to its reply, if it was sent to an idle engine."""
+        self._average(self.durations, uid, max(duration, 0.))
+        if turnaround is not None:
+            self._average(self.latencies, uid, max(turnaround - duration, 0.))
+    
+    def limit(self, uid):
+        """The hwm for engine `uid`."""
+        latency = self.latencies.get(uid)
+        if latency is None or uid not in self.durations:
+            return self.initial
+        duration = self.durations[uid]
+        if latency <= self.idle * (latency + duration):
+            return 1
+        depth = latency / duration if duration > 0 else self.maximum
+        return int(min(self.maximum, 1 + math.ceil(depth)))
+    
+
+class Speculator(object):
+    """Keeps the durations of the recent tasks of each client, to tell when
+    one of their tasks is a straggler.
+    
+    A task is one once it has run for longer than `percentile` of the last
+    `window` durations of its client's tasks, when there are at least
+    `minimum` of them.
+    """
+    
+    window = 100 # durations kept for each client
+    minimum = 10 # durations needed before any task is a straggler
+    
+    def __init__(self, percentile=90.):
+        self.percentile = percentile
+        self.durations = {} # dict by client of deques of seconds tasks ran
+    
+    def finished(self, client, duration):
+        """A task of `client` ran for `duration` seconds."""
+        durations = self.durations.get(client)
+        if durations is None:
+            durations = self.durations[client] = deque(maxlen=self.window)
+        durations.append(duration)
+    
+    def threshold(self, client):
+        """The seconds after which a task of `client` is a straggler, or None."""
+        durations = self.durations.get(client)
+        if durations is None or len(durations) < self.minimum:
+            return None
+        ranked = sorted(durations)
+        rank = int(math.ceil(self.percentile / 100. * len(ranked))) - 1
+        return ranked[min(max(rank, 0), len(ranked)-1)]
+    
+
+#----------------------------------------------------------------------
+# Data locality
+#----------------------------------------------------------------------
+
+class Holdings(object):
+    """Tracks the results each engine should hold, with their sizes.
+    
+    Engines keep the results they computed, and those they fetched for their
+    tasks, in `limit` bytes, forgetting the least recently used first.  This
+    mirrors that for each engine, from the tasks they ran, so the scheduler
+    can tell how many of the bytes a task needs each engine already has.
+    """
+    
+    def __init__(self, limit=1<<28):
+        self.limit = limit
+        self.sizes = {} # dict by msg_id of size in bytes, for those held anywhere
+        self.holders = {} # dict by msg_id of the set of IDENTs holding it
+        self._held = {} # dict by IDENT of dicts by msg_id of bytes counted
+        self._stamps = {} # dict by IDENT of dicts by msg_id of LRU stamps
+        self._uses = {} # dict by IDENT of deques of (stamp, msg_id)
+        self._totals = {} # dict by IDENT of bytes held
+        self._clock = 0
+    
+    def add_engine(self, uid):
+        self._held[uid] = {}
+        self._stamps[uid] = {}
+        self._uses[uid] = deque()
+        self._totals[uid] = 0
+    
+    def remove_engine(self, uid):
+        for msg_id in self._held.pop(uid):
+            self._drop(uid, msg_id)
+        del self._stamps[uid]
+        del self._uses[uid]
+        del self._totals[uid]
+    
+    def _drop(self, uid, msg_id):
+        holders = self.holders[msg_id]
+        holders.discard(uid)
+        if not holders:
+            del self.holders[msg_id]
+            del self.sizes[msg_id]
+    
+    def size(self, msg_id, default=0):
+        """The size of `msg_id`, or `default` if it isn't known, but at least 1."""
+        return max(self.sizes.get(msg_id, 0), default, 1)
+    
+    def add(self, uid, msg_id, nbytes=0):
+        """Engine `uid` just got, or used, result `msg_id` of `nbytes` bytes."""
+        held = self._held[uid]
+        stamps = self._stamps[uid]
+        if msg_id not in held:
+            nbytes = self.size(msg_id, nbytes)
+            if nbytes > self.limit:
+                return
+            self.sizes[msg_id] = nbytes
+            self.holders.setdefault(msg_id, set()).add(uid)
+            held[msg_id] = nbytes
+            self._totals[uid] += nbytes
+        self._clock += 1
+        stamps[msg_id] = self._clock
+        uses = self._uses[uid]
+        uses.append((self._clock, msg_id))
+        while self._totals[uid] > self.limit:
+            stamp, old = uses.popleft()
+            if stamps.get(old) == stamp:
+                del stamps[old]
+                self._totals[uid] -= held.pop(old)
+                self._drop(uid, old)
+        if len(uses) > 2*len(stamps) + 64:
+            # drop the stale entries
+            self._uses[uid] = deque(sorted( (stamp, m) for m, stamp in stamps.iteritems() ))
+    
+    def held(self, uid, affinity):
+        """How many of the bytes in `affinity`, a dict by msg_id of sizes,
+        engine `uid` holds."""
+        held = self._held.get(uid, ())
+        return sum( self.size(m, n) for m, n in affinity.iteritems() if m in held )
+    
+
 #---------------------------------------------------------------------
 # Classes
 #---------------------------------------------------------------------
 # store empty default dependency:
 MET = Dependency([])
 
+# header keys that are parsed into Job attributes
+DIRECTIVES = ('after', 'follow', 'targets', 'timeout', 'retries', 'affinity', 'priority')
+
+class Job(object):
+    """Simple container for a task, as it passes through the scheduler.
+    
+    The message is parsed once, on submission.  The parsed header and
+    identities are kept alongside the raw frames, which are relayed to the
+    engine without copying.  The scheduling directives in the header are only
+    kept as attributes, and `full_header` puts them back for replies.
+    """
+    __slots__ = ('msg_id', 'raw_msg', 'idents', 'header', 'targets', 'after',
+                'follow', 'timeout', 'retries', 'affinity', 'priority', 'blacklist',
+                'submitted', 'sent', 'queued', 'held_for')
+    
+    def __init__(self, msg_id, raw_msg, idents, header, targets, after, follow,
+                timeout, retries=0, affinity=None, priority=0):
+        self.msg_id = msg_id
+        self.raw_msg = raw_msg
+        self.idents = idents
+        # a new, small dict, without the directives:
+        self.header = dict((k,v) for k,v in header.iteritems() if k not in DIRECTIVES)
+        self.targets = targets # set of IDENTs, or None
+        self.after = after
+        self.follow = follow
+        self.timeout = timeout
+        self.retries = retries # retries remaining
+        self.affinity = affinity # dict by msg_id of sizes of the data it uses, or None
+        self.priority = priority # higher runs first
+        # IDENTs where the job has encountered UnmetDependency, built on demand:
+        self.blacklist = None
+        self.submitted = None # order it was sent to its engine in
+        self.sent = None # time it was sent to an idle engine, for adaptive hwm
+        self.queued = None # order it started waiting in
+        self.held_for = None # IDENTs it is held for while it can't run, or None
+    
+    def full_header(self):
+        """The header, with the directives that are still relevant, as the parent of a reply."""
+        header = dict(self.header)
+        header.update(after=self.after.as_dict(), follow=self.follow.as_dict(),
+                    targets=list(self.targets or []), retries=self.retries,
+                    affinity=self.affinity or {}, priority=self.priority)
+        return header
+
+
+class JobQueue(object):
+    """Jobs waiting for a destination, by priority, and then in a deque for
+    each client, which is the first of their identities.
+    
+    Clients take turns by weighted fair queuing.  Each has a virtual time,
+    which goes up by 1/share for each job sent for it, and the client with
+    the lowest goes next.  A client that had nothing waiting starts from
+    the virtual time of the last job sent, so it gets no credit for having
+    been idle.  So the virtual times of clients with nothing waiting are
+    forgotten from time to time, which forgives them at most the last job
+    sent for them.
+    """
+    
+    def __init__(self):
+        self.queues = {} # dict by priority of dicts by client of deques of Jobs
+        self.vtimes = {} # dict by client of virtual times
+        self.clock = 0. # virtual time of the last job sent
+        self.count = 0 # jobs appended, for the order they started waiting in
+        self.kept = 16 # virtual times kept by the last prune, at least 16
+    
+    def __len__(self):
+        return sum( sum(map(len, level.itervalues())) for level in self.queues.itervalues() )
+    
+    def _queue(self, job):
+        level = self.queues.get(job.priority)
+        if level is None:
+            level = self.queues[job.priority] = {}
+        client = job.idents[0]
+        queue = level.get(client)
+        if queue is None:
+            queue = level[client] = deque()
+        return queue
+    
+    def _start(self, queue, job):
+        """Start the virtual time of the client of `queue`, if it is empty."""
+        if not queue:
+            client = job.idents[0]
+            self.vtimes[client] = max(self.vtimes.get(client, 0.), self.clock)
+    
+    def append(self, job):
+        queue = self._queue(job)
+        self._start(queue, job)
+        self.count += 1
+        job.queued = self.count
+        queue.append(job)
+    
+    def appendleft(self, job):
+        """Put `job` back at the front of the line for its priority and client."""
+        queue = self._queue(job)
+        self._start(queue, job)
+        queue.appendleft(job)
+    
+    def charge(self, client, share=1):
+        """A job was sent for `client`, whose share is `share`."""
+        vtime = self.vtimes.get(client, self.clock)
+        self.clock = max(self.clock, vtime)
+        self.vtimes[client] = vtime + 1./share
+        if len(self.vtimes) > 2 * self.kept:
+            self.prune()
+    
+    def prune(self):
+        """Forget the virtual times of clients with nothing waiting."""
+        waiting = set()
+        for level in self.queues.itervalues():
+            waiting.update( client for client, queue in level.iteritems() if queue )
+        for client in self.vtimes.keys():
+            if client not in waiting:
+                del self.vtimes[client]
+        self.kept = max(16, len(self.vtimes))
+    
+    def levels(self):
+        """The dicts by client of deques that have jobs in them, highest
+        priority first."""
+        for priority in sorted(self.queues, reverse=True):
+            level = self.queues.get(priority)
+            if level is None:
+                continue
+            for client, queue in level.items():
+                if not queue:
+                    del level[client]
+            if level:
+                yield level
+            else:
+                del self.queues[priority]
+    
+
 class TaskScheduler(SessionFactory):
     """Python TaskScheduler object.
     
@@ -127,6 +796,30 @@ class TaskScheduler(SessionFactory):
     """
     
     hwm = Int(0, config=True) # limit number of outstanding tasks
+    # set the hwm of each engine from how long its tasks take, and how long
+    # a task takes to get to it and back, instead of using hwm:
+    adaptive_hwm = Bool(False, config=True)
+    max_hwm = Int(32, config=True) # the largest adaptive hwm
+    # limit number of outstanding tasks of each client, so the rest wait
+    # in the scheduler, where clients take turns:
+    client_hwm = Int(0, config=True)
+    # dict by username of the share of the engines their clients get, when
+    # clients take turns, relative to the default of 1:
+    shares = Dict(config=True)
+    # bytes of data that one more outstanding task on an engine is worth,
+    # when placing tasks where the data in their affinity already is:
+    locality_weight = Int(1<<20, config=True)
+    # bytes of results engines are assumed to keep, as their Kernel.store_limit:
+    holdings_limit = Int(1<<28, config=True)
+    # with hwm, let a job that finds every engine full take the place of jobs
+    # of lower priority that are sent to an engine but not started, which are
+    # aborted and wait again.  Needs the control_stream.
+    preempt = Bool(False, config=True)
+    # send a copy of a task that has run for longer than speculate_percentile
+    # of the durations of its client's recent tasks to an idle engine, and
+    # take whichever copy succeeds first.  Tasks must be safe to run twice.
+    speculate = Bool(False, config=True)
+    speculate_percentile = Float(90., config=True)
     
     # input arguments:
     scheme = Instance(FunctionType, default=leastload) # function for determining the destination
@@ -134,30 +827,70 @@ class TaskScheduler(SessionFactory):
     engine_stream = Instance(zmqstream.ZMQStream) # engine-facing stream
     notifier_stream = Instance(zmqstream.ZMQStream) # hub-facing sub stream
     mon_stream = Instance(zmqstream.ZMQStream) # hub-facing pub stream
+    control_stream = Instance(zmqstream.ZMQStream) # control queue stream, for preempting
     
     # internals:
     graph = Dict() # dict by msg_id of [ msg_ids that depend on key ]
-    retries = Dict() # dict by msg_id of retries remaining (non-neg ints)
-    # waiting = List() # list of msg_ids ready to run, but haven't due to HWM
-    depending = Dict() # dict by msg_id of (msg_id, raw_msg, after, follow)
-    pending = Dict() # dict by engine_uuid of submitted tasks
+    waiting = Instance(JobQueue, ()) # Jobs ready to run, but haven't due to HWM/location, by priority
+    blocked = Dict() # dict by engine_uuid of dicts by msg_id of Jobs held for it, due to targets/follow
+    timeouts = List() # heap of (timeout, msg_id) for depending tasks
+    depending = Dict() # dict by msg_id of Jobs
+    pending = Dict() # dict by engine_uuid of dicts by msg_id of submitted Jobs
+    priorities = Dict() # dict by priority of the number of submitted Jobs
+    inflight = Dict() # dict by client of the number of submitted Jobs
+    preempted = Dict() # dict by msg_id of (engine_uuid, Job) for Jobs being aborted
+    copies = Dict() # dict by msg_id of the engine_uuids running copies of a Job with a backup
+    losers = Dict() # dict by msg_id of the engine_uuids whose copy lost, whose replies are dropped
+    missed = Dict() # dict by msg_id of Jobs whose function an engine missed, until the client sends them in full
+    busy = Dict() # dict by engine_uuid of about when it started its current task, for speculate
     completed = Dict() # dict by engine_uuid of completed tasks
     failed = Dict() # dict by engine_uuid of failed tasks
     destinations = Dict() # dict by msg_id of engine_uuids where jobs ran (reverse of completed+failed)
     clients = Dict() # dict by msg_id for who submitted the task
     targets = List() # list of target IDENTs
-    loads = List() # list of engine loads
+    selector = Instance(EngineSelector) # engine loads, for picking destinations
+    holdings = Instance(Holdings) # results held by engines, for data affinity
+    pacer = Instance(Pacer) # task times, for adaptive hwm, or None
+    speculator = Instance(Speculator) # task times by client, for speculate, or None
     # full = Set() # set of IDENTs that have HWM outstanding tasks
     all_completed = Set() # set of all completed tasks
     all_failed = Set() # set of all failed tasks
     all_done = Set() # set of all finished tasks=union(completed,failed)
     all_ids = Set() # set of all submitted task IDs
-    blacklist = Dict() # dict by msg_id of locations where a job has encountered UnmetDependency
     auditor = Instance('zmq.eventloop.ioloop.PeriodicCallback')
+    straggler_check = Instance('zmq.eventloop.ioloop.PeriodicCallback')
+    _submitted = 0 # the number of Jobs sent to engines, for their order
+    _scanning = False # whether run_waiting is running
+    _rescan = False # whether run_waiting was called again while it was running
+    
+    def _selector_default(self):
+        return make_selector(self.scheme, self.hwm)
+    
+    def _holdings_default(self):
+        return Holdings(self.holdings_limit)
+    
+    def _pacer_default(self):
+        if self.adaptive_hwm:
+            return Pacer(maximum=self.max_hwm)
     
+    def _speculator_default(self):
+        if self.speculate:
+            return Speculator(self.speculate_percentile)
+    
+    @property
+    def limited(self):
+        """Whether engines have an hwm, so jobs may wait for one."""
+        return bool(self.hwm or self.adaptive_hwm)
     
     def start(self):
         self.engine_stream.on_recv(self.dispatch_result, copy=False)
+        if self.control_stream is not None:
+            # the replies to our abort requests
+            self.control_stream.on_recv(lambda msg: None)
+        elif self.preempt:
+            self.log.warn("task::no control stream, so jobs cannot be preempted")
+        elif self.speculate:
+            self.log.warn("task::no control stream, so losing backups cannot be aborted")
         self._notification_handlers = dict(
             registration_notification = self._register_engine,
             unregistration_notification = self._unregister_engine
@@ -165,6 +898,9 @@ class TaskScheduler(SessionFactory):
         self.notifier_stream.on_recv(self.dispatch_notification)
         self.auditor = ioloop.PeriodicCallback(self.audit_timeouts, 2e3, self.loop) # 1 Hz
         self.auditor.start()
+        if self.speculator is not None:
+            self.straggler_check = ioloop.PeriodicCallback(self.back_up_stragglers, 500, self.loop)
+            self.straggler_check.start()
         self.log.info("Scheduler started...%r"%self)
     
     def resume_receiving(self):
@@ -198,8 +934,11 @@ class TaskScheduler(SessionFactory):
     def _register_engine(self, uid):
         """New engine with ident `uid` became available."""
         # head of the line:
-        self.targets.insert(0,uid)
-        self.loads.insert(0,0)
+        self.targets.append(uid)
+        self.selector.add_engine(uid)
+        self.holdings.add_engine(uid)
+        if self.pacer is not None:
+            self.selector.set_limit(uid, self.pacer.limit(uid))
         # initialize sets
         self.completed[uid] = set()
         self.failed[uid] = set()
@@ -223,13 +962,19 @@ class TaskScheduler(SessionFactory):
         # map(self.destinations.pop, self.failed.pop(uid))
 
         # prevent this engine from receiving work
-        idx = self.targets.index(uid)
-        self.targets.pop(idx)
-        self.loads.pop(idx)
+        self.targets.remove(uid)
+        self.selector.remove_engine(uid)
+        self.holdings.remove_engine(uid)
+        if self.pacer is not None:
+            self.pacer.remove_engine(uid)
+        self.busy.pop(uid, None)
+        # jobs held for it may be unreachable now, so they wait in line again
+        self.wake(uid)
         
         # wait 5 seconds before cleaning up pending jobs, since the results might
         # still be incoming
-        if self.pending[uid]:
+        if self.pending[uid] or uid in [ e for e,job in self.preempted.itervalues() ] \
+                or [ engines for engines in self.losers.itervalues() if uid in engines ]:
             dc = ioloop.DelayedCallback(lambda : self.handle_stranded_tasks(uid), 5000, self.loop)
             dc.start()
         else:
@@ -240,18 +985,32 @@ class TaskScheduler(SessionFactory):
     @logged
     def handle_stranded_tasks(self, engine):
         """Deal with jobs resident in an engine that died."""
+        requeued = False
+        for msg_id, (uid, job) in self.preempted.items():
+            if uid == engine:
+                # the abort will never be acknowledged
+                del self.preempted[msg_id]
+                self.requeue(job)
+                requeued = True
+        if requeued:
+            # nothing else may come along to try them
+            self.run_waiting()
+        for msg_id, engines in self.losers.items():
+            if engine in engines:
+                # the lost copy will never reply
+                engines.remove(engine)
+                if not engines:
+                    del self.losers[msg_id]
+        
         lost = self.pending[engine]
         for msg_id in lost.keys():
             if msg_id not in self.pending[engine]:
                 # prevent double-handling of messages
                 continue
 
-            raw_msg = lost[msg_id][0]
-
-            idents,msg = self.session.feed_identities(raw_msg, copy=False)
-            msg = self.session.unpack_message(msg, copy=False, content=False)
-            parent = msg['header']
-            idents = [engine, idents[0]]
+            job = lost[msg_id]
+            parent = job.full_header()
+            idents = [engine, job.idents[0]]
 
             # build fake error reply
             try:
@@ -288,12 +1047,22 @@ class TaskScheduler(SessionFactory):
         
         header = msg['header']
         msg_id = header['msg_id']
+        if msg_id in self.missed:
+            # sent again in full, after an engine missed its function
+            job = self.missed.pop(msg_id)
+            job.raw_msg = raw_msg
+            if not self.maybe_run(job):
+                self.save_unmet(job)
+            return
         self.all_ids.add(msg_id)
         
-        # targets
-        targets = set(header.get('targets', []))
+        # targets, None if unrestricted
+        targets = header.get('targets', None)
+        targets = set(targets) if targets else None
         retries = header.get('retries', 0)
-        self.retries[msg_id] = retries
+        # data affinity, None if there is none
+        affinity = header.get('affinity', None) or None
+        priority = header.get('priority', 0)
         
         # time dependencies
         after = Dependency(header.get('after', []))
@@ -309,45 +1078,52 @@ class TaskScheduler(SessionFactory):
         
         # location dependencies
         follow = Dependency(header.get('follow', []))
+        if not follow:
+            # share the empty dependency
+            follow = MET
         
         # turn timeouts into datetime objects:
         timeout = header.get('timeout', None)
         if timeout:
             timeout = datetime.now() + timedelta(0,timeout,0)
         
-        args = [raw_msg, targets, after, follow, timeout]
+        job = Job(msg_id=msg_id, raw_msg=raw_msg, idents=idents, header=header,
+                targets=targets, after=after, follow=follow, timeout=timeout,
+                retries=retries, affinity=affinity, priority=priority)
         
         # validate and reduce dependencies:
         for dep in after,follow:
             # check valid:
             if msg_id in dep or dep.difference(self.all_ids):
-                self.depending[msg_id] = args
+                self.depending[msg_id] = job
                 return self.fail_unreachable(msg_id, error.InvalidDependency)
             # check if unreachable:
             if dep.unreachable(self.all_completed, self.all_failed):
-                self.depending[msg_id] = args
+                self.depending[msg_id] = job
                 return self.fail_unreachable(msg_id)
         
         if after.check(self.all_completed, self.all_failed):
             # time deps already met, try to run
-            if not self.maybe_run(msg_id, *args):
+            if not self.maybe_run(job):
                 # can't run yet
                 if msg_id not in self.all_failed:
                     # could have failed as unreachable
-                    self.save_unmet(msg_id, *args)
+                    self.save_unmet(job)
         else:
-            self.save_unmet(msg_id, *args)
+            self.save_unmet(job)
     
     # @logged
     def audit_timeouts(self):
-        """Audit all waiting tasks for expired timeouts."""
+        """Audit all waiting tasks for expired timeouts.
+        
+        Only the expired entries at the front of the timeout heap are visited.
+        """
         now = datetime.now()
-        for msg_id in self.depending.keys():
-            # must recheck, in case one failure cascaded to another:
-            if msg_id in self.depending:
-                raw,after,targets,follow,timeout = self.depending[msg_id]
-                if timeout and timeout < now:
-                    self.fail_unreachable(msg_id, error.TaskTimeout)
+        while self.timeouts and self.timeouts[0][0] < now:
+            timeout, msg_id = heappop(self.timeouts)
+            # must recheck, in case the task ran, or one failure cascaded to another:
+            if msg_id in self.depending and self.depending[msg_id].timeout == timeout:
+                self.fail_unreachable(msg_id, error.TaskTimeout)
                 
     @logged
     def fail_unreachable(self, msg_id, why=error.ImpossibleDependency):
@@ -356,15 +1132,9 @@ class TaskScheduler(SessionFactory):
         if msg_id not in self.depending:
             self.log.error("msg %r already failed!"%msg_id)
             return
-        raw_msg,targets,after,follow,timeout = self.depending.pop(msg_id)
-        for mid in follow.union(after):
-            if mid in self.graph:
-                self.graph[mid].remove(msg_id)
-        
-        # FIXME: unpacking a message I've already unpacked, but didn't save:
-        idents,msg = self.session.feed_identities(raw_msg, copy=False)
-        msg = self.session.unpack_message(msg, copy=False, content=False)
-        header = msg['header']
+        job = self.depending.pop(msg_id)
+        self._untrack(msg_id, job.follow.union(job.after))
+        self.unhold(job)
         
         try:
             raise why()
@@ -375,24 +1145,30 @@ class TaskScheduler(SessionFactory):
         self.all_failed.add(msg_id)
         
         msg = self.session.send(self.client_stream, 'apply_reply', content, 
-                                                parent=header, ident=idents)
-        self.session.send(self.mon_stream, msg, ident=['outtask']+idents)
+                                                parent=job.full_header(), ident=job.idents)
+        self.session.send(self.mon_stream, msg, ident=['outtask']+job.idents)
         
         self.update_graph(msg_id, success=False)
     
     @logged
-    def maybe_run(self, msg_id, raw_msg, targets, after, follow, timeout):
+    def maybe_run(self, job):
         """check location dependencies, and run if they are met."""
-        blacklist = self.blacklist.setdefault(msg_id, set())
-        if follow or targets or blacklist or self.hwm:
-            # we need a can_run filter
-            def can_run(idx):
-                # check hwm
-                if self.hwm and self.loads[idx] == self.hwm:
+        if self.client_hwm and self.client_full(job.idents[0]):
+            # wait for the client's turn
+            return False
+        msg_id = job.msg_id
+        targets = job.targets
+        follow = job.follow
+        blacklist = job.blacklist or ()
+        if follow or targets:
+            # we need a can_run filter, but only on the engines that
+            # could possibly satisfy follow or targets
+            selector = self.selector
+            def can_run(target):
+                if target not in selector or target in blacklist:
                     return False
-                target = self.targets[idx]
-                # check blacklist
-                if target in blacklist:
+                # check hwm
+                if selector.full(target):
                     return False
                 # check targets
                 if targets and target not in targets:
@@ -400,9 +1176,14 @@ class TaskScheduler(SessionFactory):
                 # check follow
                 return follow.check(self.completed[target], self.failed[target])
             
-            indices = filter(can_run, range(len(self.targets)))
-
-            if not indices:
+            if follow:
+                # follow can only be met where the follow tasks ran
+                candidates = set(self.destinations[m] for m in follow if m in self.destinations)
+            else:
+                candidates = targets
+            candidates = filter(can_run, candidates)
+            
+            if not candidates:
                 # couldn't run
                 if follow.all:
                     # check follow for impossibility
@@ -415,55 +1196,239 @@ class TaskScheduler(SessionFactory):
                     for m in follow.intersection(relevant):
                         dests.add(self.destinations[m])
                     if len(dests) > 1:
-                        self.depending[msg_id] = (raw_msg, targets, after, follow, timeout)
+                        self.depending[msg_id] = job
                         self.fail_unreachable(msg_id)
                         return False
                 if targets:
                     # check blacklist+targets for impossibility
                     targets.difference_update(blacklist)
                     if not targets or not targets.intersection(self.targets):
-                        self.depending[msg_id] = (raw_msg, targets, after, follow, timeout)
+                        self.depending[msg_id] = job
                         self.fail_unreachable(msg_id)
                         return False
-                return False
+                if follow:
+                    return False
+                target = self.preempt_for(job, blacklist)
+                if target is None:
+                    return False
+            elif job.affinity and not follow:
+                target = self.choose_local(job, candidates)
+            else:
+                target = selector.choose_from(candidates)
         else:
-            indices = None
-            
-        self.submit_task(msg_id, raw_msg, targets, follow, timeout, indices)
+            if job.affinity:
+                target = self.choose_local(job, exclude=blacklist)
+            else:
+                target = self.selector.choose(exclude=blacklist)
+            if target is None:
+                # every engine is full or blacklisted
+                target = self.preempt_for(job, blacklist)
+                if target is None:
+                    return False
+        
+        self.submit_task(job, target)
         return True
             
+    def choose_local(self, job, candidates=None, exclude=()):
+        """Pick an engine for a job with data affinity.
+        
+        The engine the scheme would pick competes with those holding any of
+        the data in `job.affinity`.  The cost of each is the bytes of it that
+        it would have to fetch, plus `locality_weight` for each outstanding
+        task, and the cheapest wins.  Picks from `candidates` if given, or
+        else from every engine that is not full, or in `exclude`.
+        """
+        selector = self.selector
+        holdings = self.holdings
+        affinity = job.affinity
+        if candidates is None:
+            target = selector.choose(exclude=exclude)
+            if target is None:
+                return None
+            def eligible(uid):
+                return uid in selector and uid not in exclude and not selector.full(uid)
+        else:
+            target = selector.choose_from(candidates)
+            eligible = set(candidates).__contains__
+        local = set()
+        for msg_id in affinity:
+            local.update(holdings.holders.get(msg_id, ()))
+        if not local:
+            return target
+        needed = sum( holdings.size(m, n) for m, n in affinity.iteritems() )
+        weight = self.locality_weight
+        def cost(uid):
+            return needed - holdings.held(uid, affinity) + weight * selector.loads[uid]
+        best = cost(target)
+        for uid in local:
+            if uid != target and eligible(uid):
+                c = cost(uid)
+                if c < best:
+                    target, best = uid, c
+        return target
+    
+    def preempt_for(self, job, exclude=()):
+        """Make room for `job` on an engine, by aborting jobs of lower
+        priority that are sent to it but not started, if `preempt` is set.
+        
+        The job an engine got first is taken to be running, so only those
+        behind it are aborted, and they wait again once the engine says they
+        are.  The engine where the fewest jobs would still run before `job`
+        is picked.  Returns it, or None if there is none.
+        """
+        if not self.preempt or self.control_stream is None or not self.priorities:
+            return None
+        if min(self.priorities) >= job.priority:
+            # nothing to preempt
+            return None
+        best = None
+        for uid, jobs in self.pending.iteritems():
+            if len(jobs) < 2 or uid in exclude or uid not in self.selector:
+                continue
+            if job.targets and uid not in job.targets:
+                continue
+            queued = sorted(jobs.itervalues(), key=lambda j: j.submitted)[1:]
+            victims = [ j for j in queued if j.priority < job.priority
+                                            and j.msg_id not in self.copies ]
+            if victims:
+                key = (len(queued) - len(victims), len(victims))
+                if best is None or key < best[0]:
+                    best = (key, uid, victims)
+        if best is None:
+            return None
+        key, uid, victims = best
+        for victim in victims:
+            self._unpend(uid, victim.msg_id)
+            self.finish_job(uid)
+            self.preempted[victim.msg_id] = (uid, victim)
+        self.log.info("task::preempting %s on %s for %s"%(
+                        [ v.msg_id for v in victims ], uid, job.msg_id))
+        content = dict(msg_ids=[ v.msg_id for v in victims ])
+        self.session.send(self.control_stream, 'abort_request', content=content, ident=uid)
+        return uid
+    
+    def requeue(self, job):
+        """Put `job`, which was sent to an engine but not run there, back at
+        the front of the line.  Its dependencies were met, so it has no
+        timeout any more."""
+        job.timeout = None
+        self.depending[job.msg_id] = job
+        self.waiting.appendleft(job)
+    
     @logged
-    def save_unmet(self, msg_id, raw_msg, targets, after, follow, timeout):
+    def save_unmet(self, job):
         """Save a message for later submission when its dependencies are met."""
-        self.depending[msg_id] = [raw_msg,targets,after,follow,timeout]
+        msg_id = job.msg_id
+        self.depending[msg_id] = job
         # track the ids in follow or after, but not those already finished
-        for dep_id in after.union(follow).difference(self.all_done):
+        for dep_id in job.after.union(job.follow).difference(self.all_done):
             if dep_id not in self.graph:
                 self.graph[dep_id] = set()
             self.graph[dep_id].add(msg_id)
+        if job.after is MET:
+            # time deps are met, it is only waiting for a destination
+            self.wait(job)
+        if job.timeout:
+            heappush(self.timeouts, (job.timeout, msg_id))
     
-    @logged
-    def submit_task(self, msg_id, raw_msg, targets, follow, timeout, indices=None):
-        """Submit a task to any of a subset of our targets."""
-        if indices:
-            loads = [self.loads[i] for i in indices]
+    def wait(self, job):
+        """Wait for a destination for `job`, whose time dependencies are met.
+        
+        A job with targets or follow is held for the engines it could run on,
+        and only tried again when one of them replies, or its follow changes.
+        Others wait in line, as do those of a client with `client_hwm` jobs out.
+        """
+        job.after = MET
+        if (job.targets or job.follow) and not self.client_full(job.idents[0]):
+            self.hold(job)
         else:
-            loads = self.loads
-        idx = self.scheme(loads)
-        if indices:
-            idx = indices[idx]
-        target = self.targets[idx]
+            self.unhold(job)
+            self.waiting.append(job)
+    
+    def hold(self, job):
+        """Hold `job` for the engines it could run on."""
+        if job.follow:
+            engines = set(self.destinations[m] for m in job.follow if m in self.destinations)
+        else:
+            engines = set(job.targets)
+        engines.difference_update(job.blacklist or ())
+        self.unhold(job)
+        job.held_for = engines
+        if job.queued is None:
+            self.waiting.count += 1
+            job.queued = self.waiting.count
+        for uid in engines:
+            self.blocked.setdefault(uid, {})[job.msg_id] = job
+    
+    def unhold(self, job):
+        """Stop holding `job`, if it is held."""
+        if job.held_for is None:
+            return
+        for uid in job.held_for:
+            jobs = self.blocked.get(uid)
+            if jobs is not None:
+                jobs.pop(job.msg_id, None)
+                if not jobs:
+                    del self.blocked[uid]
+        job.held_for = None
+    
+    def wake(self, engine):
+        """Put the jobs held for `engine` back at the front of their line,
+        in the order they started waiting, for `run_waiting` to try."""
+        jobs = self.blocked.pop(engine, None)
+        if not jobs:
+            return
+        for job in sorted(jobs.itervalues(), key=lambda j: j.queued, reverse=True):
+            self.unhold(job)
+            self.waiting.appendleft(job)
+    
+    def _untrack(self, msg_id, dep_ids):
+        """Remove msg_id from the graph entries of `dep_ids`."""
+        for mid in dep_ids:
+            if mid in self.graph:
+                self.graph[mid].discard(msg_id)
+    
+    @logged
+    def submit_task(self, job, target):
+        """Submit a task to the engine `target`."""
         # print (target, map(str, msg[:3]))
         # send job to the engine
         self.engine_stream.send(target, flags=zmq.SNDMORE, copy=False)
-        self.engine_stream.send_multipart(raw_msg, copy=False)
+        self.engine_stream.send_multipart(job.raw_msg, copy=False)
+        if self.pacer is not None:
+            # only a job sent to an idle engine measures the round trip
+            job.sent = time.time() if not self.selector.loads[target] else None
+        if self.speculator is not None and not self.selector.loads[target]:
+            self.busy[target] = time.time()
         # update load
-        self.add_job(idx)
-        self.pending[target][msg_id] = (raw_msg, targets, MET, follow, timeout)
+        self.add_job(target)
+        job.after = MET
+        self._submitted += 1
+        job.submitted = self._submitted
+        self.pending[target][job.msg_id] = job
+        self.priorities[job.priority] = self.priorities.get(job.priority, 0) + 1
+        client = job.idents[0]
+        self.inflight[client] = self.inflight.get(client, 0) + 1
+        self.waiting.charge(client, self.shares.get(job.header.get('username'), 1))
         # notify Hub
-        content = dict(msg_id=msg_id, engine_id=target)
+        content = dict(msg_id=job.msg_id, engine_id=target)
         self.session.send(self.mon_stream, 'task_destination', content=content, 
                         ident=['tracktask',self.session.session])
+    
+    def _unpend(self, engine, msg_id):
+        """Remove `msg_id` from the pending Jobs of `engine`, and return it."""
+        job = self.pending[engine].pop(msg_id)
+        for counts, key in ((self.priorities, job.priority), (self.inflight, job.idents[0])):
+            count = counts[key] - 1
+            if count:
+                counts[key] = count
+            else:
+                del counts[key]
+        return job
+    
+    def client_full(self, client):
+        """Whether `client` has client_hwm outstanding tasks."""
+        return bool(self.client_hwm) and self.inflight.get(client, 0) >= self.client_hwm
         
     
     #-----------------------------------------------------------------------
@@ -476,38 +1441,86 @@ class TaskScheduler(SessionFactory):
             idents,msg = self.session.feed_identities(raw_msg, copy=False)
             msg = self.session.unpack_message(msg, content=False, copy=False)
             engine = idents[0]
-            try:
-                idx = self.targets.index(engine)
-            except ValueError:
-                pass # skip load-update for dead engines
+            msg_id = msg['parent_header']['msg_id']
+            if self.preempted.get(msg_id, (None,))[0] == engine:
+                # its load was taken off when it was preempted
+                preempted = self.preempted.pop(msg_id)[1]
             else:
-                self.finish_job(idx)
+                preempted = None
+                if engine in self.selector:
+                    self.finish_job(engine)
+                    # the jobs held for it get another chance
+                    self.wake(engine)
+                    if self.speculator is not None:
+                        # its next task starts now
+                        self.busy[engine] = time.time()
+                # else skip load-update for dead engines
         except Exception:
             self.log.error("task::Invaid result: %s"%raw_msg, exc_info=True)
             return
 
         header = msg['header']
         parent = msg['parent_header']
-        if header.get('dependencies_met', True):
+        if preempted is not None:
+            if header.get('status') == 'aborted':
+                self.requeue(preempted)
+                self.run_waiting()
+                return
+            # it started before the abort arrived
+            self.pending[engine][msg_id] = preempted
+            self.priorities[preempted.priority] = self.priorities.get(preempted.priority, 0) + 1
+            client = preempted.idents[0]
+            self.inflight[client] = self.inflight.get(client, 0) + 1
+        if (msg_id in self.copies or msg_id in self.losers) and not self.settle(engine, msg_id, header):
+            return
+        if not header.get('function_cached', True):
+            self.handle_function_miss(idents, parent, raw_msg)
+        elif header.get('dependencies_met', True):
             success = (header['status'] == 'ok')
-            msg_id = parent['msg_id']
-            retries = self.retries[msg_id]
-            if not success and retries > 0:
+            job = self.pending[engine][parent['msg_id']]
+            if self.pacer is not None or self.speculator is not None:
+                duration = run_time(header)
+                if duration is not None:
+                    if self.pacer is not None and engine in self.selector:
+                        self.pace(engine, job, duration)
+                    if success and self.speculator is not None:
+                        self.speculator.finished(job.idents[0], duration)
+            if not success and job.retries > 0:
                 # failed
-                self.retries[msg_id] = retries - 1
+                job.retries -= 1
                 self.handle_unmet_dependency(idents, parent)
             else:
-                del self.retries[msg_id]
                 # relay to client and update graph
-                self.handle_result(idents, parent, raw_msg, success)
+                nbytes = None
+                if success and header.get('kept', False):
+                    nbytes = sum(map(len, msg['buffers']))
+                self.handle_result(idents, parent, raw_msg, success, nbytes)
                 # send to Hub monitor
                 self.mon_stream.send_multipart(['outtask']+raw_msg, copy=False)
         else:
             self.handle_unmet_dependency(idents, parent)
+        if self.speculator is not None and engine in self.selector \
+                and not self.selector.loads[engine]:
+            # nothing else for it to do
+            self.back_up_stragglers()
         
+    def pace(self, engine, job, duration):
+        """Update the hwm of `engine`, which just replied to `job`, which ran
+        for `duration` seconds."""
+        turnaround = None if job.sent is None else time.time() - job.sent
+        self.pacer.finished(engine, duration, turnaround)
+        if not self.selector.loads[engine] and not self.waiting:
+            self.pacer.forget(engine)
+        limit = self.pacer.limit(engine)
+        if limit != self.selector.limit(engine):
+            self.log.debug("task::hwm of %s is now %i"%(engine, limit))
+            self.selector.set_limit(engine, limit)
+    
     @logged
-    def handle_result(self, idents, parent, raw_msg, success=True):
-        """handle a real task result, either success or failure"""
+    def handle_result(self, idents, parent, raw_msg, success=True, nbytes=None):
+        """handle a real task result, either success or failure.
+        
+        `nbytes` is the size of the result, if the engine keeps it."""
         # first, relay result to client
         engine = idents[0]
         client = idents[1]
@@ -517,11 +1530,12 @@ class TaskScheduler(SessionFactory):
         self.client_stream.send_multipart(raw_msg, copy=False)
         # now, update our data structures
         msg_id = parent['msg_id']
-        self.blacklist.pop(msg_id, None)
-        self.pending[engine].pop(msg_id)
+        job = self._unpend(engine, msg_id)
         if success:
             self.completed[engine].add(msg_id)
             self.all_completed.add(msg_id)
+            if engine in self.selector:
+                self.record_holdings(engine, job, nbytes)
         else:
             self.failed[engine].add(msg_id)
             self.all_failed.add(msg_id)
@@ -530,36 +1544,56 @@ class TaskScheduler(SessionFactory):
         
         self.update_graph(msg_id, success)
         
+    def record_holdings(self, engine, job, nbytes):
+        """`engine` just ran `job`, so it holds the data in its affinity, and
+        its result of `nbytes` bytes, unless that is None."""
+        holdings = self.holdings
+        if job.affinity:
+            for msg_id, size in job.affinity.iteritems():
+                holdings.add(engine, msg_id, size)
+        if nbytes is not None:
+            holdings.add(engine, job.msg_id, nbytes)
+    
+    @logged
+    def handle_function_miss(self, idents, parent, raw_msg):
+        """handle a task whose function the engine didn't have.
+        
+        The reply is relayed to the client, which sends the task again in
+        full, under the same msg_id.  The Job waits for that, without being
+        done or failed."""
+        engine = idents[0]
+        client = idents[1]
+        raw_msg[:2] = [client,engine]
+        self.client_stream.send_multipart(raw_msg, copy=False)
+        msg_id = parent['msg_id']
+        self.missed[msg_id] = self._unpend(engine, msg_id)
+        if self.limited and engine in self.selector:
+            # it may take another job
+            self.update_graph(None)
+    
     @logged
     def handle_unmet_dependency(self, idents, parent):
         """handle an unmet dependency"""
         engine = idents[0]
         msg_id = parent['msg_id']
         
-        if msg_id not in self.blacklist:
-            self.blacklist[msg_id] = set()
-        self.blacklist[msg_id].add(engine)
-        
-        args = self.pending[engine].pop(msg_id)
-        raw,targets,after,follow,timeout = args
+        job = self._unpend(engine, msg_id)
+        if job.blacklist is None:
+            job.blacklist = set()
+        job.blacklist.add(engine)
         
-        if self.blacklist[msg_id] == targets:
-            self.depending[msg_id] = args
+        if job.blacklist == job.targets:
+            self.depending[msg_id] = job
             self.fail_unreachable(msg_id)
-        elif not self.maybe_run(msg_id, *args):
+        elif not self.maybe_run(job):
             # resubmit failed
             if msg_id not in self.all_failed:
                 # put it back in our dependency tree
-                self.save_unmet(msg_id, *args)
+                self.save_unmet(job)
         
-        if self.hwm:
-            try:
-                idx = self.targets.index(engine)
-            except ValueError:
-                pass # skip load-update for dead engines
-            else:
-                if self.loads[idx] == self.hwm-1:
-                    self.update_graph(None)
+        if self.limited and engine in self.selector:
+            if self.selector.loads[engine] == self.selector.limit(engine)-1:
+                self.update_graph(None)
         
         
     
@@ -568,62 +1602,229 @@ class TaskScheduler(SessionFactory):
         """dep_id just finished. Update our dependency
         graph and submit any jobs that just became runable.
         
-        Called with dep_id=None to update entire graph for hwm, but without finishing
-        a task.
+        Only the jobs that depend on dep_id are rechecked.
+        Called with dep_id=None to recheck just the waiting jobs for hwm,
+        or a new engine, but without finishing a task.
         """
-        # print ("\n\n***********")
-        # pprint (dep_id)
-        # pprint (self.graph)
-        # pprint (self.depending)
-        # pprint (self.all_completed)
-        # pprint (self.all_failed)
-        # print ("\n\n***********\n\n")
+        # an engine or a client may have just become no longer full,
+        # so give jobs that have been waiting the first chance
+        if dep_id is None or self.limited or self.client_hwm:
+            self.run_waiting()
+        
         # update any jobs that depended on the dependency
         jobs = self.graph.pop(dep_id, [])
-
-        # recheck *all* jobs if
-        # a) we have HWM and an engine just become no longer full
-        # or b) dep_id was given as None
-        if dep_id is None or self.hwm and any( [ load==self.hwm-1 for load in self.loads ]):
-            jobs = self.depending.keys()
         
         for msg_id in jobs:
-            raw_msg, targets, after, follow, timeout = self.depending[msg_id]
+            if msg_id not in self.depending:
+                # already ran, or failed in a cascade
+                continue
+            job = self.depending[msg_id]
+            after = job.after
+            follow = job.follow
             
             if after.unreachable(self.all_completed, self.all_failed) or follow.unreachable(self.all_completed, self.all_failed):
                 self.fail_unreachable(msg_id)
             
             elif after.check(self.all_completed, self.all_failed): # time deps met, maybe run
-                if self.maybe_run(msg_id, raw_msg, targets, MET, follow, timeout):
+                if self.maybe_run(job):
                     
                     self.depending.pop(msg_id)
-                    for mid in follow.union(after):
-                        if mid in self.graph:
-                            self.graph[mid].remove(msg_id)
+                    self._untrack(msg_id, follow.union(after))
+                    self.unhold(job)
+                elif (after is not MET or job.held_for is not None) and msg_id not in self.all_failed:
+                    # can't run yet, wait for a destination, or where its
+                    # follow now points.  Those in line already stay there.
+                    self.wait(job)
+    
+    def run_waiting(self):
+        """Submit jobs whose time dependencies are met, but had no destination
+        when they were last checked, due to hwm, targets, or follow.
+        
+        Jobs are tried by priority.  Clients with jobs of the same priority take
+        turns, as the JobQueue says, except those with `client_hwm` jobs out,
+        and the jobs of each client are tried in the order they started waiting.
+        This stops as soon as every engine is full, so freeing one hwm slot
+        does not touch the rest of the queue, and a job that can't run on the
+        engines its targets or follow allow is held for them, out of the queue.
+        
+        A job failing in the scan may call this again, through update_graph.
+        That call only asks for another pass, once this one is done.
+        """
+        if self._scanning:
+            self._rescan = True
+            return
+        self._scanning = True
+        try:
+            self._rescan = True
+            while self._rescan:
+                self._rescan = False
+                self._scan_waiting()
+        finally:
+            self._scanning = False
+    
+    def _scan_waiting(self):
+        """One pass of run_waiting."""
+        vtimes = self.waiting.vtimes
+        for level in self.waiting.levels():
+            active = [ client for client in level if not self.client_full(client) ]
+            skipped = {} # dict by client of jobs that can't run yet, in order
+            while active:
+                if not self.selector.has_room():
+                    # every engine is full
+                    break
+                if len(active) == 1:
+                    client = active[0]
+                else:
+                    client = min(active, key=vtimes.get)
+                queue = level.get(client)
+                if not queue:
+                    # emptied by a cascade of failures
+                    active.remove(client)
+                    continue
+                job = queue.popleft()
+                msg_id = job.msg_id
+                if self.depending.get(msg_id) is not job:
+                    # stale entry, already ran or failed
+                    pass
+                elif job.follow.unreachable(self.all_completed, self.all_failed):
+                    self.fail_unreachable(msg_id)
+                elif self.maybe_run(job):
+                    self.depending.pop(msg_id)
+                    self._untrack(msg_id, job.follow)
+                elif msg_id not in self.all_failed:
+                    if job.targets or job.follow:
+                        # wait for the engines it could run on
+                        self.hold(job)
+                    else:
+                        skipped.setdefault(client, []).append(job)
+                if not queue or self.client_full(client):
+                    active.remove(client)
+            for jobs in skipped.itervalues():
+                # back to the front of their line, in order
+                for job in reversed(jobs):
+                    self.waiting.appendleft(job)
+            if not self.selector.has_room():
+                return
+    
+    #-----------------------------------------------------------------------
+    # Speculation
+    #-----------------------------------------------------------------------
+    
+    def back_up_stragglers(self):
+        """Send a copy of each task that has run for longer than the
+        Speculator allows to an idle engine, the longest running first,
+        while there are idle engines.
+        
+        The job an engine got first is taken to be running, since about when
+        the engine last replied, or got it.  Jobs with follow dependencies,
+        or with a copy already, are not backed up.
+        """
+        loads = self.selector.loads
+        idle = set(uid for uid, load in loads.iteritems() if not load)
+        if not idle:
+            return
+        now = time.time()
+        thresholds = {} # dict by client of Speculator thresholds
+        stragglers = []
+        for uid, jobs in self.pending.iteritems():
+            if not jobs or uid not in self.selector:
+                continue
+            job = min(jobs.itervalues(), key=lambda j: j.submitted)
+            if job.follow or job.msg_id in self.copies:
+                continue
+            client = job.idents[0]
+            if client not in thresholds:
+                thresholds[client] = self.speculator.threshold(client)
+            threshold = thresholds[client]
+            elapsed = now - self.busy.get(uid, now)
+            if threshold is not None and elapsed > threshold:
+                stragglers.append((elapsed, uid, job))
+        stragglers.sort(key=lambda s: s[0], reverse=True)
+        for elapsed, uid, job in stragglers:
+            candidates = idle.difference(job.blacklist or ())
+            if job.targets:
+                candidates.intersection_update(job.targets)
+            if not candidates:
+                continue
+            target = self.selector.choose_from(candidates)
+            idle.remove(target)
+            self.log.info("task::%s has run on %s for %.3g s, backing it up on %s"%(
+                            job.msg_id, uid, elapsed, target))
+            self.back_up(job, uid, target)
+            if not idle:
+                break
+    
+    def back_up(self, job, engine, target):
+        """Send a copy of `job`, which is running on `engine`, to `target`."""
+        msg_id = job.msg_id
+        self.copies[msg_id] = set([engine, target])
+        self.engine_stream.send(target, flags=zmq.SNDMORE, copy=False)
+        self.engine_stream.send_multipart(job.raw_msg, copy=False)
+        # the round trip of a copy is not measured
+        job.sent = None
+        self.busy[target] = time.time()
+        self.add_job(target)
+        self.pending[target][msg_id] = job
+        # notify Hub
+        content = dict(msg_id=msg_id, engine_id=target)
+        self.session.send(self.mon_stream, 'task_destination', content=content,
+                        ident=['tracktask',self.session.session])
+    
+    def settle(self, engine, msg_id, header):
+        """Decide what to do with a reply from `engine` to a Job with copies.
+        
+        The first successful reply wins, or else the last one, so a copy that
+        fails, or dies with its engine, leaves the other to finish.  The other
+        copies lose, and are aborted, in case they have not started.  A copy
+        that has started runs to the end, and its reply is dropped.
+        Returns whether the reply is the Job's.
+        """
+        losers = self.losers.get(msg_id)
+        if losers is not None and engine in losers:
+            losers.remove(engine)
+            if not losers:
+                del self.losers[msg_id]
+        else:
+            copies = self.copies.pop(msg_id, None)
+            if copies is None:
+                return True
+            copies.discard(engine)
+            if not copies or (header.get('dependencies_met', True) and header['status'] == 'ok'):
+                for uid in copies:
+                    self.pending[uid].pop(msg_id, None)
+                    if self.control_stream is not None:
+                        self.session.send(self.control_stream, 'abort_request',
+                                        content=dict(msg_ids=[msg_id]), ident=uid)
+                if copies:
+                    self.losers[msg_id] = copies
+                return True
+            self.copies[msg_id] = copies
+            self.pending[engine].pop(msg_id)
+        if engine in self.selector:
+            # it may take another job
+            self.update_graph(None)
+        return False
     
     #----------------------------------------------------------------------
     # methods to be overridden by subclasses
     #----------------------------------------------------------------------
     
-    def add_job(self, idx):
-        """Called after self.targets[idx] just got the job with header.
+    def add_job(self, target):
+        """Called after engine `target` just got a job.
         Override with subclasses.  The default ordering is simple LRU.
         The default loads are the number of outstanding jobs."""
-        self.loads[idx] += 1
-        for lis in (self.targets, self.loads):
-            lis.append(lis.pop(idx))
-            
+        self.selector.add_job(target)
     
-    def finish_job(self, idx):
-        """Called after self.targets[idx] just finished a job.
+    def finish_job(self, target):
+        """Called after engine `target` just finished a job.
         Override with subclasses."""
-        self.loads[idx] -= 1
+        self.selector.finish_job(target)
     
 
 
 def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, config=None,logname='ZMQ', 
                             log_addr=None, loglevel=logging.DEBUG, scheme='lru',
-                            identity=b'task'):
+                            identity=b'task', control_addr=None):
     from zmq.eventloop import ioloop
     from zmq.eventloop.zmqstream import ZMQStream
     
@@ -645,6 +1846,13 @@ def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, config=None,logname=
     nots = ZMQStream(ctx.socket(zmq.SUB),loop)
     nots.setsockopt(zmq.SUBSCRIBE, '')
     nots.connect(not_addr)
+    if control_addr:
+        # a client of the control queue, to abort preempted jobs
+        ctls = ZMQStream(ctx.socket(zmq.XREQ),loop)
+        ctls.setsockopt(zmq.IDENTITY, identity+b'_control')
+        ctls.connect(control_addr)
+    else:
+        ctls = None
     
     scheme = globals().get(scheme, None)
     # setup logging
@@ -654,7 +1862,7 @@ def launch_scheduler(in_addr, out_addr, mon_addr, not_addr, config=None,logname=
         local_logger(logname, loglevel)
     
     scheduler = TaskScheduler(client_stream=ins, engine_stream=outs,
-                            mon_stream=mons, notifier_stream=nots,
+                            mon_stream=mons, notifier_stream=nots, control_stream=ctls,
                             scheme=scheme, loop=loop, logname=logname,
                             config=config)
     scheduler.start()
@@ -6,17 +6,20 @@
 #  the file COPYING, distributed as part of this software.
 #-----------------------------------------------------------------------------
 
+import atexit
 import json
+import logging
 import os
+import weakref
 import cPickle as pickle
 from datetime import datetime
+from functools import partial
+from threading import Condition, Lock, Thread
 
 import sqlite3
 
-from zmq.eventloop import ioloop
-
-from IPython.utils.traitlets import CUnicode, CStr, Instance, List
-from .dictdb import BaseDB
+from IPython.utils.traitlets import CUnicode, CStr, Float, Instance, List
+from .dictdb import BaseDB, make_tests
 from IPython.parallel.util import ISO8601
 
 #-----------------------------------------------------------------------------
@@ -31,8 +34,8 @@ operators = {
  '$ne' : "!=",
  '$lte': "<=",
  '$gte': ">=",
- '$in' : ('=', ' OR '),
- '$nin': ('!=', ' AND '),
+ '$in' : ('=', 'IN'),
+ '$nin': ('!=', 'NOT IN'),
  # '$all': None,
  # '$mod': None,
  # '$exists' : None
@@ -76,16 +79,198 @@ def _convert_bufs(bs):
     else:
         return pickle.loads(bytes(bs))
 
+def _open_db(dbfile, journal_mode, synchronous):
+    """Open a connection to a db file.  Each thread needs its own."""
+    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES, 
+        # isolation_level = None)#,
+         cached_statements=64)
+    db.execute("PRAGMA journal_mode = %s"%journal_mode)
+    db.execute("PRAGMA synchronous = %s"%synchronous)
+    return db
+
+#-----------------------------------------------------------------------------
+# write-behind queue
+#-----------------------------------------------------------------------------
+
+class _Writer(object):
+    """The write-behind queue of an SQLiteDB, and the thread that writes it.
+    
+    It has no reference to its SQLiteDB, which closes it when it is closed
+    or collected.  Writers that are still open are closed at exit.
+    """
+    
+    def __init__(self, connect, table, keys, interval):
+        self.connect = connect
+        self.table = table
+        self.keys = keys
+        self.interval = interval
+        # dicts by msg_id of [is_new, record] waiting to be written,
+        # and being written by the thread.  A record of None is a drop:
+        self.queued = {}
+        self.writing = {}
+        self.cond = Condition(Lock())
+        self.closing = False
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def enqueue(self, msg_id, rec, is_new):
+        """Queue a write, merging it with any queued write of the same msg_id."""
+        with self.cond:
+            entry = self.queued.get(msg_id)
+            if entry is None or is_new:
+                self.queued[msg_id] = [is_new, rec]
+            elif entry[1] is not None:
+                entry[1].update(rec)
+            # else an update of a dropped record, which does nothing
+    
+    def drop(self, msg_id):
+        """Queue the removal of a record, instead of any queued write of it."""
+        with self.cond:
+            self.queued[msg_id] = [False, None]
+    
+    def snapshot(self):
+        """The queued writes, as a dict by msg_id of lists of [is_new, record],
+        oldest first.  The records are copied, since the thread may be
+        writing them."""
+        entries = {}
+        with self.cond:
+            for q in (self.writing, self.queued):
+                for msg_id, (is_new, rec) in q.iteritems():
+                    if rec is not None:
+                        rec = dict(rec)
+                    entries.setdefault(msg_id, []).append([is_new, rec])
+        return entries
+    
+    def run(self):
+        """The thread: write queued records in batches, until closed."""
+        db = self.connect()
+        # transactions are explicit, for savepoints
+        db.isolation_level = None
+        while True:
+            with self.cond:
+                if not self.queued and not self.closing:
+                    self.cond.wait(self.interval)
+                if not self.queued:
+                    if self.closing:
+                        break
+                    continue
+                batch = self.writing = self.queued
+                self.queued = {}
+            try:
+                self.write_batch(db, batch)
+            except Exception:
+                logging.error("SQLiteDB: failed to write %i records"%len(batch), exc_info=True)
+            with self.cond:
+                self.writing = {}
+                self.cond.notify_all()
+        db.close()
+    
+    def write_batch(self, db, batch):
+        """Write one batch, with one executemany per statement, in one transaction."""
+        inserts = []
+        updates = {}
+        drops = []
+        for msg_id, (is_new, rec) in batch.iteritems():
+            if rec is None:
+                drops.append((msg_id,))
+            elif is_new:
+                inserts.append([ rec[key] for key in self.keys ])
+            else:
+                keys = tuple(sorted(rec.keys()))
+                values = [ rec[key] for key in keys ]
+                values.append(msg_id)
+                updates.setdefault(keys, []).append(values)
+        
+        db.execute("BEGIN")
+        try:
+            if inserts:
+                tups = '(%s)'%(','.join(['?']*len(self.keys)))
+                query = "INSERT INTO %s VALUES %s"%(self.table, tups)
+                self.write_rows(db, query, inserts, 0)
+            for keys, lines in updates.iteritems():
+                sets = ', '.join([ '%s = ?'%key for key in keys ])
+                query = "UPDATE %s SET %s WHERE msg_id == ?"%(self.table, sets)
+                self.write_rows(db, query, lines, -1)
+            if drops:
+                query = "DELETE FROM %s WHERE msg_id == ?"%self.table
+                self.write_rows(db, query, drops, 0)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    
+    def write_rows(self, db, query, rows, idx):
+        """Write `rows` with one executemany, or one at a time if that fails,
+        to keep those that can be written.  `row[idx]` is the msg_id."""
+        db.execute("SAVEPOINT rows")
+        try:
+            db.executemany(query, rows)
+        except sqlite3.Error:
+            # undo the rows written before the bad one, and find the bad one(s)
+            db.execute("ROLLBACK TO rows")
+            for row in rows:
+                try:
+                    db.execute(query, row)
+                except sqlite3.Error:
+                    logging.error("SQLiteDB: failed to write %r"%row[idx], exc_info=True)
+        db.execute("RELEASE rows")
+    
+    def flush(self):
+        """Block until all queued writes are committed."""
+        with self.cond:
+            while self.queued or self.writing:
+                self.cond.notify_all()
+                self.cond.wait(self.interval)
+    
+    def close(self):
+        """Write everything that is queued, and stop the thread."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+
+# dict by weakref to an SQLiteDB of its open _Writer
+_writers = {}
+
+def _collected(ref):
+    """An SQLiteDB was collected without being closed."""
+    writer = _writers.pop(ref, None)
+    if writer is not None:
+        writer.close()
+
+@atexit.register
+def _close_writers():
+    """Don't lose queued writes on exit."""
+    for ref in _writers.keys():
+        _collected(ref)
+
 #-----------------------------------------------------------------------------
 # SQLiteDB class
 #-----------------------------------------------------------------------------
 
 class SQLiteDB(BaseDB):
-    """SQLite3 TaskRecord backend."""
+    """SQLite3 TaskRecord backend.
+    
+    Writes are queued in memory, and an add followed by updates of the same
+    msg_id is coalesced into a single row write.  A writer thread with its own
+    connection flushes the queue every `flush_interval` seconds, with one
+    `executemany` per statement and one commit per batch, so the Hub's loop
+    never waits on the disk for a write.  If a statement fails, its rows are
+    written one at a time, so only the bad ones are lost.  Drops are queued
+    too.  Reads see queued writes, by merging them with what the db has,
+    without waiting for the writer.
+    """
     
     filename = CUnicode('tasks.db', config=True)
     location = CUnicode('', config=True)
     table = CUnicode("", config=True)
+    # PRAGMA journal_mode, WAL lets the Hub read while the writer commits
+    journal_mode = CUnicode('WAL', config=True)
+    # PRAGMA synchronous: OFF, NORMAL, or FULL
+    synchronous = CUnicode('NORMAL', config=True)
+    # seconds between batched writes
+    flush_interval = Float(0.1, config=True)
     
     _db = Instance('sqlite3.Connection')
     _keys = List(['msg_id' ,
@@ -121,12 +306,10 @@ class SQLiteDB(BaseDB):
                 self.location = '.'
         self._init_db()
         
-        # register db commit as 2s periodic callback
-        # to prevent clogging pipes
-        # assumes we are being run in a zmq ioloop app
-        loop = ioloop.IOLoop.instance()
-        pc = ioloop.PeriodicCallback(self._db.commit, 2000, loop)
-        pc.start()
+        connect = partial(_open_db, self._dbfile(), self.journal_mode, self.synchronous)
+        self._writer = _Writer(connect, self.table, self._keys, self.flush_interval)
+        self._ref = weakref.ref(self, _collected)
+        _writers[self._ref] = self._writer
     
     def _defaults(self, keys=None):
         """create an empty record"""
@@ -146,11 +329,7 @@ class SQLiteDB(BaseDB):
         sqlite3.register_adapter(list, _adapt_bufs)
         sqlite3.register_converter('bufs', _convert_bufs)
         # connect to the db
-        dbfile = os.path.join(self.location, self.filename)
-        self._db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES, 
-            # isolation_level = None)#,
-             cached_statements=64)
-        # print dir(self._db)
+        self._db = self._connect()
         
         self._db.execute("""CREATE TABLE IF NOT EXISTS %s 
                 (msg_id text PRIMARY KEY,
@@ -175,6 +354,25 @@ class SQLiteDB(BaseDB):
                 """%self.table)
         self._db.commit()
     
+    def _dbfile(self):
+        return os.path.join(self.location, self.filename)
+    
+    def _connect(self):
+        """Open a connection to our db file.  Each thread needs its own."""
+        return _open_db(self._dbfile(), self.journal_mode, self.synchronous)
+    
+    def flush(self):
+        """Block until all queued writes are committed."""
+        self._writer.flush()
+    
+    def close(self):
+        """Write everything that is queued, and close the db."""
+        writer = _writers.pop(self._ref, None)
+        if writer is None:
+            return
+        writer.close()
+        self._db.close()
+    
     def _dict_to_list(self, d):
         """turn a mongodb-style record dict into a list."""
         
@@ -208,17 +406,20 @@ class SQLiteDB(BaseDB):
                     except KeyError:
                         raise KeyError("Unsupported operator: %r"%test)
                     if isinstance(op, tuple):
-                        op, join = op
+                        op, list_op = op
                     
                     if value is None and op in null_operators:
-                            expr = "%s %s"%null_operators[op]
+                            expr = "%s %s"%(name, null_operators[op])
                     else:
                         expr = "%s %s ?"%(name, op)
                         if isinstance(value, (tuple,list)):
                             if op in null_operators and any([v is None for v in value]):
                                 # equality tests don't work with NULL
                                 raise ValueError("Cannot use %r test with NULL values on SQLite backend"%test)
-                            expr = '( %s )'%( join.join([expr]*len(value)) )
+                            # a single IN test, since long OR chains exceed
+                            # SQLite's expression depth limit
+                            marks = ','.join(['?']*len(value))
+                            expr = '%s %s (%s)'%(name, list_op, marks)
                             args.extend(value)
                         else:
                             args.append(value)
@@ -226,7 +427,7 @@ class SQLiteDB(BaseDB):
             else:
                 # it's an equality check
                 if sub_check is None:
-                    expressions.append("%s IS NULL")
+                    expressions.append("%s IS NULL"%name)
                 else:
                     expressions.append("%s = ?"%name)
                     args.append(sub_check)
@@ -234,50 +435,87 @@ class SQLiteDB(BaseDB):
         expr = " AND ".join(expressions)
         return expr, args
     
+    def _merge(self, entries, read):
+        """Apply `entries`, the queued writes of one record, oldest first, to
+        the record in the db, which is only read, by calling `read`, if they
+        don't replace it.  Returns None if there is no record."""
+        for i in range(len(entries)-1, -1, -1):
+            is_new, rec = entries[i]
+            if is_new or rec is None:
+                # an add or a drop, nothing older matters
+                entries = entries[i:]
+                break
+        if entries and entries[0][1] is None:
+            return None
+        if entries and entries[0][0]:
+            d = entries.pop(0)[1]
+        else:
+            d = read()
+            if d is None:
+                return None
+        for is_new, rec in entries:
+            d.update(rec)
+        return d
+    
+    def _read_rows(self, msg_ids, keys=None):
+        """Read the records of `msg_ids` from the db, as a dict by msg_id."""
+        keys = self._keys if keys is None else keys
+        msg_ids = list(msg_ids)
+        records = {}
+        # in chunks, within SQLite's limit on the number of parameters
+        for i in range(0, len(msg_ids), 500):
+            chunk = msg_ids[i:i+500]
+            query = "SELECT %s FROM %s WHERE msg_id IN (%s)"%(
+                        ', '.join(keys), self.table, ','.join(['?']*len(chunk)))
+            for line in self._db.execute(query, chunk):
+                rec = self._list_to_dict(line, keys)
+                records[rec['msg_id']] = rec
+        return records
+    
+    def _queued_records(self, queued, keys=None):
+        """The records with writes in `queued`, a snapshot of the writer, as
+        they will be once those are written, by msg_id."""
+        rows = self._read_rows([ m for m, entries in queued.iteritems()
+                                if not [ e for e in entries if e[0] or e[1] is None ] ], keys)
+        records = {}
+        for msg_id, entries in queued.iteritems():
+            rec = self._merge(entries, lambda : rows.get(msg_id))
+            if rec is not None:
+                records[msg_id] = rec
+        return records
+    
     def add_record(self, msg_id, rec):
         """Add a new Task Record, by msg_id."""
         d = self._defaults()
         d.update(rec)
         d['msg_id'] = msg_id
-        line = self._dict_to_list(d)
-        tups = '(%s)'%(','.join(['?']*len(line)))
-        self._db.execute("INSERT INTO %s VALUES %s"%(self.table, tups), line)
-        # self._db.commit()
+        self._writer.enqueue(msg_id, d, True)
     
     def get_record(self, msg_id):
         """Get a specific Task Record, by msg_id."""
-        cursor = self._db.execute("""SELECT * FROM %s WHERE msg_id==?"""%self.table, (msg_id,))
-        line = cursor.fetchone()
-        if line is None:
+        entries = self._writer.snapshot().get(msg_id, [])
+        def read():
+            cursor = self._db.execute("""SELECT * FROM %s WHERE msg_id==?"""%self.table, (msg_id,))
+            line = cursor.fetchone()
+            if line is not None:
+                return self._list_to_dict(line)
+        d = self._merge(entries, read)
+        if d is None:
             raise KeyError("No such msg: %r"%msg_id)
-        return self._list_to_dict(line)
+        return d
     
     def update_record(self, msg_id, rec):
         """Update the data in an existing record."""
-        query = "UPDATE %s SET "%self.table
-        sets = []
-        keys = sorted(rec.keys())
-        values = []
-        for key in keys:
-            sets.append('%s = ?'%key)
-            values.append(rec[key])
-        query += ', '.join(sets)
-        query += ' WHERE msg_id == ?'
-        values.append(msg_id)
-        self._db.execute(query, values)
-        # self._db.commit()
+        self._writer.enqueue(msg_id, dict(rec), False)
     
     def drop_record(self, msg_id):
         """Remove a record from the DB."""
-        self._db.execute("""DELETE FROM %s WHERE msg_id==?"""%self.table, (msg_id,))
-        # self._db.commit()
+        self._writer.drop(msg_id)
     
     def drop_matching_records(self, check):
         """Remove a record from the DB."""
-        expr,args = self._render_expression(check)
-        query = "DELETE FROM %s WHERE %s"%(self.table, expr)
-        self._db.execute(query,args)
-        # self._db.commit()
+        for rec in self.find_records(check, ['msg_id']):
+            self._writer.drop(rec['msg_id'])
         
     def find_records(self, check, keys=None):
         """Find records matching a query dict, optionally extracting subset of keys.
@@ -307,20 +545,37 @@ class SQLiteDB(BaseDB):
         else:
             req = '*'
         expr,args = self._render_expression(check)
+        queued = self._writer.snapshot()
         query = """SELECT %s FROM %s WHERE %s"""%(req, self.table, expr)
         cursor = self._db.execute(query, args)
-        matches = cursor.fetchall()
         records = []
-        for line in matches:
+        for line in cursor:
             rec = self._list_to_dict(line, keys)
-            records.append(rec)
+            if rec['msg_id'] not in queued:
+                records.append(rec)
+        # the records with queued writes are matched here, as they will be
+        tests = make_tests(check)
+        for rec in self._queued_records(queued).itervalues():
+            for key, test in tests.iteritems():
+                if not test(rec.get(key, None)):
+                    break
+            else:
+                if keys:
+                    rec = dict( (key, rec[key]) for key in keys )
+                records.append(rec)
         return records
     
     def get_history(self):
         """get all msg_ids, ordered by time submitted."""
-        query = """SELECT msg_id FROM %s ORDER by submitted ASC"""%self.table
-        cursor = self._db.execute(query)
-        # will be a list of length 1 tuples
-        return [ tup[0] for tup in cursor.fetchall()]
+        queued = self._writer.snapshot()
+        query = """SELECT msg_id, submitted FROM %s"""%self.table
+        submitted = dict(self._db.execute(query).fetchall())
+        keys = ['msg_id', 'submitted']
+        for msg_id in queued:
+            submitted.pop(msg_id, None)
+        for msg_id, rec in self._queued_records(queued, keys).iteritems():
+            submitted[msg_id] = rec['submitted']
+        # None first, as ORDER BY does, and ties in a stable order
+        return sorted(submitted, key=lambda m: (submitted[m] is not None, submitted[m], m))
 
 __all__ = ['SQLiteDB']
\ No newline at end of file
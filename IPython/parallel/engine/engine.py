@@ -25,8 +25,9 @@ from IPython.utils.traitlets import Instance, Str, Dict, Int, Type, CFloat
 from IPython.parallel.controller.heartmonitor import Heart
 from IPython.parallel.factory import RegistrationFactory
 from IPython.parallel.streamsession import Message
-from IPython.parallel.util import disambiguate_url
+from IPython.parallel.util import disambiguate_url, local_interface
 
+from .peers import PeerCommunicator
 from .streamkernel import Kernel
 
 class EngineFactory(RegistrationFactory):
@@ -38,11 +39,17 @@ class EngineFactory(RegistrationFactory):
     display_hook_factory=Type('IPython.zmq.displayhook.DisplayHook', config=True)
     location=Str(config=True)
     timeout=CFloat(2,config=True)
+    # where to bind the inbox for messages from other engines (default: the
+    # interface that reaches the controller), and how long to wait for one
+    # (forever if negative)
+    peer_interface=Str('', config=True)
+    peer_timeout=CFloat(60, config=True)
     
     # not configurable:
     id=Int(allow_none=True)
     registrar=Instance('zmq.eventloop.zmqstream.ZMQStream')
     kernel=Instance(Kernel)
+    peers=Instance(PeerCommunicator)
     
     
     def __init__(self, **kwargs):
@@ -53,12 +60,15 @@ class EngineFactory(RegistrationFactory):
         reg.setsockopt(zmq.IDENTITY, self.ident)
         reg.connect(self.url)
         self.registrar = zmqstream.ZMQStream(reg, self.loop)
+        interface = self.peer_interface or local_interface(self.url)
+        self.peers = PeerCommunicator(ctx, interface, self.peer_timeout)
         
     def register(self):
         """send the registration_request"""
         
         self.log.info("registering")
-        content = dict(queue=self.ident, heartbeat=self.ident, control=self.ident)
+        content = dict(queue=self.ident, heartbeat=self.ident, control=self.ident,
+                        peer=self.peers.info)
         self.registrar.on_recv(self.complete_registration)
         # print (self.session.key)
         self.session.send(self.registrar, "registration_request",content=content)
@@ -127,7 +137,8 @@ class EngineFactory(RegistrationFactory):
             
             self.kernel = Kernel(config=self.config, int_id=self.id, ident=self.ident, session=self.session, 
                     control_stream=control_stream, shell_streams=shell_streams, iopub_stream=iopub_stream, 
-                    loop=loop, user_ns = self.user_ns, logname=self.log.name)
+                    loop=loop, user_ns = self.user_ns, logname=self.log.name,
+                    context=ctx, hub_url=self.url, peers=self.peers)
             self.kernel.start()
             hb_addrs = [ disambiguate_url(addr, self.location) for addr in hb_addrs ]
             heart = Heart(*map(str, hb_addrs), heart_id=identity)
@@ -0,0 +1,186 @@
+"""The results and objects an engine gets from the Hub for its tasks."""
+#-----------------------------------------------------------------------------
+#  Copyright (C) 2011  The IPython Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+#-----------------------------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+
+import time
+from collections import deque
+
+from IPython.utils.pickleutil import ResultReference, allPrimitive
+
+from IPython.parallel import error
+from IPython.parallel.util import unserialize_object
+
+#-----------------------------------------------------------------------------
+# Classes
+#-----------------------------------------------------------------------------
+
+class _Packed(object):
+    """A result kept serialized, until a task needs it."""
+    __slots__ = ('buffers',)
+    def __init__(self, buffers):
+        self.buffers = buffers
+
+
+class ObjectStore(object):
+    """Results of tasks, and objects put in the Hub, by msg_id.
+
+    Each is fetched from the Hub the first time a task needs it, and kept
+    for later tasks while they all fit in `limit` bytes, forgetting the
+    least recently used first.  Pending results are waited for, for up to
+    `timeout` seconds, or as long as it takes if `timeout` is negative.
+    The Hub may hear of a task after an engine is asked to use its result,
+    so unknown msg_ids are asked for again for up to `grace` seconds.
+
+    The engine's own results are kept as well, so tasks scheduled where
+    their inputs were computed need not fetch them.
+
+    `socket` is an XREQ socket connected to the Hub's query address.
+    """
+
+    def __init__(self, session, socket, limit=1<<28, timeout=60, grace=5):
+        self.session = session
+        self.socket = socket
+        self.limit = limit
+        self.timeout = timeout
+        self.grace = grace
+        self._objects = {}
+        self._sizes = {}
+        self._size = 0
+        self._stamps = {}
+        self._uses = deque()
+        self._clock = 0
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._objects
+
+    def _use(self, msg_id):
+        self._clock += 1
+        self._stamps[msg_id] = self._clock
+        self._uses.append((self._clock, msg_id))
+
+    def _keep(self, msg_id, obj, size):
+        """Keep `obj`, forgetting older objects as we need the room."""
+        if size > self.limit:
+            return
+        self._objects[msg_id] = obj
+        self._sizes[msg_id] = size
+        self._size += size
+        self._use(msg_id)
+        uses = self._uses
+        stamps = self._stamps
+        while self._size > self.limit:
+            stamp, old = uses.popleft()
+            if stamps.get(old) == stamp:
+                del self._objects[old]
+                del stamps[old]
+                self._size -= self._sizes.pop(old)
+        if len(uses) > 2*len(stamps) + 64:
+            # drop the stale entries
+            self._uses = deque(sorted( (stamp, m) for m, stamp in stamps.iteritems() ))
+
+    def keep_result(self, msg_id, buffers):
+        """Keep a copy of the serialized result `msg_id`, computed here, if
+        it fits.  Returns whether it was kept."""
+        size = 256 + sum(map(len, buffers))
+        if size > self.limit:
+            # don't copy what we would throw away
+            return False
+        self._keep(msg_id, _Packed(map(bytes, buffers)), size)
+        return True
+
+    def _request(self, msg_ids):
+        """Ask the Hub for the results of `msg_ids`, returning the reply."""
+        self.session.send(self.socket, "result_request",
+                        content=dict(msg_ids=msg_ids, status_only=False))
+        idents, msg = self.session.recv(self.socket, 0)
+        content = msg['content']
+        if content['status'] != 'ok':
+            raise error.unwrap_exception(content)
+        return content, msg['buffers']
+
+    def _fetch(self, msg_ids):
+        """Get the results of `msg_ids` from the Hub, waiting for any that
+        are pending.  Returns a dict of them by msg_id."""
+        results = {}
+        tic = time.time()
+        interval = 0.01
+        while msg_ids:
+            try:
+                content, buffers = self._request(msg_ids)
+            except error.RemoteError as e:
+                if e.ename != 'KeyError' or time.time() > tic + self.grace:
+                    raise
+                time.sleep(interval)
+                interval = min(2*interval, 1.)
+                continue
+            # the Hub sends the buffers of completed results in msg_id order
+            for msg_id in sorted(msg_ids):
+                if msg_id not in content['completed']:
+                    continue
+                rcontent = content[msg_id]['result_content']
+                if isinstance(rcontent, str):
+                    rcontent = self.session.unpack(rcontent)
+                if rcontent['status'] != 'ok':
+                    raise error.unwrap_exception(rcontent)
+                obj, rest = unserialize_object(buffers)
+                size = 256 + sum(map(len, buffers[:len(buffers)-len(rest)]))
+                buffers = rest
+                results[msg_id] = obj
+                self._keep(msg_id, obj, size)
+            msg_ids = content['pending']
+            if msg_ids:
+                if self.timeout >= 0 and time.time() > tic + self.timeout:
+                    raise error.TimeoutError("results still pending: %r"%msg_ids)
+                time.sleep(interval)
+                interval = min(2*interval, 1.)
+        return results
+
+    def get(self, msg_ids):
+        """The results of `msg_ids`, as a list."""
+        found = {}
+        missing = set()
+        for msg_id in msg_ids:
+            if msg_id in self._objects:
+                obj = self._objects[msg_id]
+                if isinstance(obj, _Packed):
+                    obj = self._objects[msg_id] = unserialize_object(obj.buffers)[0]
+                found[msg_id] = obj
+                self._use(msg_id)
+            else:
+                missing.add(msg_id)
+        if missing:
+            found.update(self._fetch(sorted(missing)))
+        return map(found.get, msg_ids)
+
+    def resolve(self, obj):
+        """What `obj` stands for, if it is a ResultReference."""
+        if isinstance(obj, ResultReference):
+            return obj.join(self.get(obj.msg_ids))
+        return obj
+
+    def resolve_args(self, args, kwargs):
+        """Resolve the ResultReferences in `args` and `kwargs`, and in lists
+        and tuples in them, as the client found them."""
+        resolve = self.resolve
+        def resolve_arg(arg):
+            if isinstance(arg, (list, tuple)) and not allPrimitive(arg):
+                for item in arg:
+                    if isinstance(item, ResultReference):
+                        return type(arg)(map(resolve, arg))
+                return arg
+            return resolve(arg)
+        args = map(resolve_arg, args)
+        for key, value in kwargs.iteritems():
+            kwargs[key] = resolve_arg(value)
+        return args, kwargs
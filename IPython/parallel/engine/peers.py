@@ -0,0 +1,407 @@
+"""Messages between engines, and collectives over binomial trees of them."""
+#-----------------------------------------------------------------------------
+#  Copyright (C) 2011  The IPython Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+#-----------------------------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+# Imports
+#-----------------------------------------------------------------------------
+
+import socket
+import time
+from collections import deque
+
+import zmq
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from IPython.parallel import error
+from IPython.parallel.util import (disambiguate_url, serialize_object,
+                                    unserialize_object)
+
+#-----------------------------------------------------------------------------
+# Binomial trees
+#-----------------------------------------------------------------------------
+
+def tree_parent(rank):
+    """The parent of `rank` in a binomial tree rooted at rank 0, or None."""
+    if rank == 0:
+        return None
+    return rank & (rank - 1)
+
+def tree_children(rank, size):
+    """The children of `rank` in a binomial tree of `size` ranks rooted at 0.
+
+    They are in increasing order, and the subtree of each child is the ranks
+    from it up to the next child, so folding the children in order folds
+    the ranks in order.
+    """
+    children = []
+    bit = 1
+    while bit < size and not rank & bit:
+        child = rank | bit
+        if child >= size:
+            break
+        children.append(child)
+        bit <<= 1
+    return children
+
+#-----------------------------------------------------------------------------
+# The communicator
+#-----------------------------------------------------------------------------
+
+_communicator = None
+
+def communicator():
+    """The PeerCommunicator of this engine."""
+    if _communicator is None:
+        raise error.KernelError("this engine has no peer communicator")
+    return _communicator
+
+
+class PeerCommunicator(object):
+    """Sends objects between engines, by engine id.
+
+    Each engine binds an inbox on `interface`, whose address it registers
+    with the Hub, and connects to the inboxes of the engines it sends to as
+    it first needs them, asking the Hub where they are.  Each message starts
+    with an envelope packed by the engine's Session, with its key, and those
+    without the key are dropped.  Messages carry a tag, and are received by
+    sender and tag, in the order each sender sent them.  Arrays are sent
+    without copying, and forwarded without unpacking.  Receiving waits for
+    up to `timeout` seconds, or forever if negative.
+
+    On the engines, `communicator()` returns it, so that code run there can
+    exchange arrays with its neighbors::
+
+        com = communicator()
+        com.send(right, edge, tag='halo')
+        halo = com.recv(left, tag='halo')
+
+    A failure is sent on in place of the object it prevented, so that
+    every engine waiting for it raises a RemoteError for it.
+    """
+
+    # frames smaller than this are copied as they are sent, which is cheaper
+    # than tracking when zmq is done with them
+    copy_threshold = 1<<16
+    # the most packed and parsed envelopes remembered, since halo
+    # exchanges send the same status and tag over and over
+    cache_size = 1024
+
+    def __init__(self, context, interface='tcp://127.0.0.1', timeout=60):
+        self.context = context
+        self.timeout = timeout
+        self.inbox = context.socket(zmq.PULL)
+        port = self.inbox.bind_to_random_port(interface)
+        self.url = "%s:%i"%(interface, port)
+        # guess first public IP from socket, for peers to reach '*' by
+        self.location = socket.gethostbyname_ex(socket.gethostname())[2][0]
+        self.id = None
+        self.session = None
+        self.query = None
+        self.log = None
+        self.addresses = {}
+        self._outboxes = {}
+        self._received = {}
+        self._packed = {}
+        self._parsed = {}
+        self._poller = zmq.Poller()
+        self._poller.register(self.inbox, zmq.POLLIN)
+
+    @property
+    def info(self):
+        """The address to register with the Hub."""
+        return (self.url, self.location)
+
+    def register(self, session, query, engine_id, log):
+        """Use the Hub behind the XREQ socket `query` to find peers, as engine
+        `engine_id`, and become the communicator of this engine.  Messages
+        are signed and checked by `session`, and dropped ones logged to
+        `log`."""
+        global _communicator
+        self.session = session
+        self.query = query
+        self.id = engine_id
+        self.log = log
+        _communicator = self
+
+    def close(self):
+        for s in self._outboxes.values():
+            s.close()
+        self._outboxes = {}
+        self.inbox.close()
+
+    #-------------------------------------------------------------------------
+    # Point to point
+    #-------------------------------------------------------------------------
+
+    def _lookup(self):
+        """Ask the Hub where the engines are."""
+        self.session.send(self.query, "peers_request", content={})
+        idents, msg = self.session.recv(self.query, 0)
+        content = msg['content']
+        if content['status'] != 'ok':
+            raise error.unwrap_exception(content)
+        self.addresses = dict( (int(eid), tuple(info))
+                                for eid, info in content['peers'].iteritems() )
+
+    def _outbox(self, peer):
+        s = self._outboxes.get(peer)
+        if s is None:
+            if peer not in self.addresses:
+                self._lookup()
+            if peer not in self.addresses:
+                raise error.InvalidEngineID("No such engine: %r"%peer)
+            url, location = self.addresses[peer]
+            s = self.context.socket(zmq.PUSH)
+            s.connect(disambiguate_url(url, location))
+            self._outboxes[peer] = s
+        return s
+
+    def _pack(self, obj):
+        """The status and frames that send `obj`.
+
+        Contiguous arrays of plain dtypes are sent as one frame of data, with
+        their dtype and shape in the status, rather than serialized, to keep
+        halo exchanges of small arrays cheap.
+        """
+        if numpy is not None and type(obj) is numpy.ndarray and \
+                obj.flags.c_contiguous and obj.dtype.fields is None and \
+                not obj.dtype.hasobject:
+            shape = ','.join(map(str, obj.shape))
+            return "array:%s:%s"%(obj.dtype.str, shape), [buffer(obj)]
+        pmd, bufs = serialize_object(obj)
+        return 'ok', [pmd] + bufs
+
+    def _failure(self, e):
+        """The status and frames that send on the failure `e`."""
+        if isinstance(e, error.RemoteError):
+            origin = e.engine_info.get('engine_id', self.id)
+            failure = (e.ename, e.evalue, origin)
+        else:
+            failure = (e.__class__.__name__, str(e), self.id)
+        return 'error', [serialize_object(failure)[0]]
+
+    def _unpack(self, status, frames):
+        if status.startswith('array:'):
+            kind, dtype, shape = status.split(':')
+            shape = [ int(n) for n in shape.split(',') if n ]
+            return numpy.frombuffer(buffer(frames[0]), dtype=dtype).reshape(shape)
+        obj = unserialize_object(frames, copy=False)[0]
+        if status == 'error':
+            ename, evalue, origin = obj
+            raise error.RemoteError(ename, evalue, None, dict(engine_id=origin))
+        return obj
+
+    def _send_frames(self, peer, tag, status, frames, track=False):
+        """Send `frames` to `peer`, returning a MessageTracker for them if
+        `track`.  Frames smaller than `copy_threshold` bytes, and frames sent
+        to ourself, are copied, so they are done at once.  A single small
+        frame is sent in one part with the envelope, after a newline."""
+        if peer == self.id:
+            frames = [ f if isinstance(f, zmq.Message) else zmq.Message(bytes(buffer(f)))
+                        for f in frames ]
+            self._received.setdefault((peer, tag), deque()).append((status, frames))
+            return zmq.MessageTracker() if track else None
+        outbox = self._outbox(peer)
+        envelope = self._envelope(status, tag)
+        if len(frames) == 1 and len(frames[0]) < self.copy_threshold:
+            frame = frames[0]
+            frame = frame.bytes if isinstance(frame, zmq.Message) else bytes(buffer(frame))
+            outbox.send(envelope + '\n' + frame)
+            return zmq.MessageTracker() if track else None
+        outbox.send(envelope, zmq.SNDMORE)
+        trackers = []
+        last = len(frames) - 1
+        for i, frame in enumerate(frames):
+            flags = zmq.SNDMORE if i < last else 0
+            if len(frame) < self.copy_threshold:
+                outbox.send(frame, flags)
+            else:
+                t = outbox.send(frame, flags, copy=False, track=track)
+                if track:
+                    trackers.append(t)
+        if track:
+            return zmq.MessageTracker(*trackers)
+
+    def _recv_frames(self, peer, tag):
+        """The status and frames of the next message from `peer` with `tag`,
+        keeping the others that arrive meanwhile."""
+        key = (peer, tag)
+        queue = self._received.get(key)
+        if queue:
+            found = queue.popleft()
+            if not queue:
+                del self._received[key]
+            return found
+        if self.timeout >= 0:
+            deadline = time.time() + self.timeout
+        while True:
+            if self.timeout >= 0:
+                remaining = max(0, deadline - time.time())
+                if not self._poller.poll(1000 * remaining):
+                    raise error.TimeoutError("nothing from engine %r with tag %r after %.1f s"%(
+                                            peer, tag, self.timeout))
+            msg = self.inbox.recv_multipart(copy=False)
+            try:
+                status, found, frames = self._parse(msg)
+            except Exception:
+                self.log.error("peers::dropping invalid message", exc_info=True)
+                continue
+            if found == key:
+                return status, frames
+            self._received.setdefault(found, deque()).append((status, frames))
+
+    def _envelope(self, status, tag):
+        """The first frame of a message, with the session key, our id, and
+        `status` and `tag`, packed once for each status and tag."""
+        envelope = self._packed.get((status, tag))
+        if envelope is None:
+            if len(self._packed) >= self.cache_size:
+                self._packed.clear()
+            envelope = self.session.pack(dict(key=self.session.key, status=status,
+                                            sender=self.id, tag=tag))
+            self._packed[(status, tag)] = envelope
+        return envelope
+
+    def _parse(self, msg):
+        """The status, (sender, tag) and frames of the message `msg`.
+
+        Raises KeyError if it doesn't have the session key.  Each envelope
+        is only unpacked the first time it is seen.
+        """
+        if len(msg) == 1:
+            # the envelope, which is JSON without newlines, and one frame
+            envelope, frame = msg[0].bytes.split('\n', 1)
+            frames = [zmq.Message(frame)]
+        else:
+            envelope = msg[0].bytes
+            frames = msg[1:]
+        parsed = self._parsed.get(envelope)
+        if parsed is None:
+            content = self.session.unpack(envelope)
+            if content.get('key') != self.session.key:
+                raise KeyError("Invalid Session Key: %r"%content.get('key'))
+            parsed = (content['status'], (int(content['sender']), str(content['tag'])))
+            if len(self._parsed) >= self.cache_size:
+                self._parsed.clear()
+            self._parsed[envelope] = parsed
+        return parsed + (frames,)
+
+    def send(self, peer, obj, tag='', track=False):
+        """Send `obj` to engine `peer`, without waiting for it to be received.
+
+        Arrays are sent without copying, so they must not be changed until
+        zmq is done with them.  With `track`, this returns a MessageTracker
+        to wait for that on.
+        """
+        status, frames = self._pack(obj)
+        return self._send_frames(peer, tag, status, frames, track)
+
+    def recv(self, peer, tag=''):
+        """Receive the next object that engine `peer` sent with `tag`.
+
+        Arrays are read-only views of the message."""
+        return self._unpack(*self._recv_frames(peer, tag))
+
+    def sendrecv(self, dest, obj, source=None, tag=''):
+        """Send `obj` to engine `dest`, and receive the next object with
+        `tag` from engine `source` (default: `dest`).
+
+        This returns once `obj` is sent, so exchanging arrays in place with
+        engines that send to us as well is safe.
+        """
+        source = dest if source is None else source
+        tracker = self.send(dest, obj, tag, track=True)
+        received = self.recv(source, tag)
+        tracker.wait()
+        return received
+
+    #-------------------------------------------------------------------------
+    # Collectives
+    #-------------------------------------------------------------------------
+
+    def _tree(self, ids):
+        """Our rank, parent and children in the tree over `ids`."""
+        try:
+            rank = list(ids).index(self.id)
+        except ValueError:
+            raise error.InvalidEngineID("engine %r is not in %r"%(self.id, ids))
+        return rank, tree_parent(rank), tree_children(rank, len(ids))
+
+    def broadcast(self, ids, tag, obj=None):
+        """Send `obj` from engine ids[0] to the engines `ids`, returning it.
+
+        Each engine sends it on to the roots of its subtrees, the largest
+        first, so it reaches every engine in log2(len(ids)) steps.
+        """
+        rank, parent, children = self._tree(ids)
+        failure = None
+        if parent is not None:
+            status, frames = self._recv_frames(ids[parent], tag)
+        else:
+            try:
+                status, frames = self._pack(obj)
+            except Exception as e:
+                failure = e
+                status, frames = self._failure(e)
+        for child in reversed(children):
+            self._send_frames(ids[child], tag, status, frames)
+        if failure is not None:
+            raise failure
+        if parent is None:
+            return obj
+        return self._unpack(status, frames)
+
+    def _reduce(self, ids, tag, f, obj, failure=None):
+        """Fold `obj` with those of our subtree, sending the result to our
+        parent.  Returns it, and the first failure, or None."""
+        rank, parent, children = self._tree(ids)
+        for child in children:
+            try:
+                other = self.recv(ids[child], tag)
+                if failure is None:
+                    obj = f(obj, other)
+            except Exception as e:
+                if failure is None:
+                    failure = e
+        if parent is not None:
+            if failure is None:
+                try:
+                    status, frames = self._pack(obj)
+                except Exception as e:
+                    failure = e
+            if failure is None:
+                self._send_frames(ids[parent], tag, status, frames)
+            else:
+                self._send_frames(ids[parent], tag, *self._failure(failure))
+        return obj, failure
+
+    def reduce(self, ids, tag, f, obj, failure=None):
+        """Reduce the objects of the engines `ids` with `f`, in the order of
+        `ids`, to engine ids[0], which returns the result.  The others return
+        None.  An engine that can't contribute an object gives the exception
+        `failure` instead, to raise everywhere it is needed."""
+        obj, failure = self._reduce(ids, tag, f, obj, failure)
+        if failure is not None:
+            raise failure
+        if ids[0] == self.id:
+            return obj
+
+    def allreduce(self, ids, tag, f, obj, failure=None):
+        """Reduce the objects of the engines `ids` with `f`, in the order of
+        `ids`, and broadcast the result to all of them."""
+        obj, failure = self._reduce(ids, tag, f, obj, failure)
+        if ids[0] == self.id and failure is not None:
+            status, frames = self._failure(failure)
+            for child in reversed(tree_children(0, len(ids))):
+                self._send_frames(ids[child], tag, status, frames)
+            raise failure
+        return self.broadcast(ids, tag, obj)
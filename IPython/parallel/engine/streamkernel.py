@@ -28,12 +28,16 @@ import zmq
 from zmq.eventloop import ioloop, zmqstream
 
 # Local imports.
-from IPython.utils.traitlets import Instance, List, Int, Dict, Set, Str
+from IPython.utils.traitlets import Instance, List, Int, Dict, Set, Str, Bool, Float
 from IPython.zmq.completer import KernelCompleter
 
 from IPython.parallel.error import wrap_exception
 from IPython.parallel.factory import SessionFactory
-from IPython.parallel.util import serialize_object, unpack_apply_message, ISO8601
+from IPython.parallel.util import (serialize_object, unpack_apply_message,
+                                    FunctionCache, ISO8601)
+
+from .objectstore import ObjectStore
+from .peers import PeerCommunicator
 
 def printer(*args):
     pprint(args, stream=sys.__stdout__)
@@ -67,6 +71,22 @@ class Kernel(SessionFactory):
     int_id = Int(-1, config=True)
     user_ns = Dict(config=True)
     exec_lines = List(config=True)
+    # array arguments are read-only views of the received message;
+    # set this to give applied functions writeable copies instead
+    writeable_arrays = Bool(False, config=True)
+    # how many functions to keep uncanned, for clients to send by digest
+    function_cache_size = Int(1024, config=True)
+    # how many bytes of the results that tasks were given to keep for later
+    # tasks, and how long to wait for pending ones (forever if negative),
+    # since the engine handles nothing else while it waits
+    store_limit = Int(1<<28, config=True)
+    store_timeout = Float(60, config=True)
+    # whether to keep a copy of each load-balanced result there as well, so
+    # tasks the scheduler places by data affinity need not fetch it.  Results
+    # of tasks that had an affinity themselves are kept either way.
+    keep_results = Bool(False, config=True)
+    # the Hub's query address, to fetch those results from
+    hub_url = Str()
     
     control_stream = Instance(zmqstream.ZMQStream)
     task_stream = Instance(zmqstream.ZMQStream)
@@ -79,6 +99,9 @@ class Kernel(SessionFactory):
     completer = Instance(KernelCompleter)
     
     aborted = Set()
+    functions = Instance(FunctionCache)
+    store = Instance(ObjectStore)
+    peers = Instance(PeerCommunicator)
     shell_handlers = Dict()
     control_handlers = Dict()
     
@@ -88,13 +111,26 @@ class Kernel(SessionFactory):
     def _connect_completer(self):
         self.completer = KernelCompleter(self.user_ns)
     
+    def _clear_functions(self):
+        # cached functions have the old namespace as their globals
+        self.functions.clear()
+    
     def __init__(self, **kwargs):
         super(Kernel, self).__init__(**kwargs)
         self._set_prefix()
         self._connect_completer()
+        self.functions = FunctionCache(self.function_cache_size)
+        if self.hub_url:
+            query = self.context.socket(zmq.XREQ)
+            query.connect(self.hub_url)
+            self.store = ObjectStore(self.session, query, self.store_limit,
+                                    self.store_timeout)
+            if self.peers is not None:
+                self.peers.register(self.session, query, self.int_id, self.log)
         
         self.on_trait_change(self._set_prefix, 'id')
         self.on_trait_change(self._connect_completer, 'user_ns')
+        self.on_trait_change(self._clear_functions, 'user_ns')
         
         # Build dict of handlers for message types
         for msg_type in ['execute_request', 'complete_request', 'apply_request', 
@@ -312,7 +348,11 @@ class Kernel(SessionFactory):
             # suffix = 
             prefix = "_"+str(msg_id).replace("-","")+"_"
             
-            f,args,kwargs = unpack_apply_message(bufs, working, copy=False)
+            f,args,kwargs = unpack_apply_message(bufs, working, copy=False,
+                                                writeable=self.writeable_arrays,
+                                                functions=self.functions)
+            if self.store is not None:
+                args, kwargs = self.store.resolve_args(args, kwargs)
             # if bound:
             #     bound_ns = Namespace(working)
             #     args = [bound_ns]+list(args)
@@ -342,15 +382,26 @@ class Kernel(SessionFactory):
         except:
             exc_content = self._wrap_exception('apply')
             # exc_msg = self.session.msg(u'pyerr', exc_content, parent)
-            self.session.send(self.iopub_stream, u'pyerr', exc_content, parent=parent,
+            if exc_content['ename'] != 'FunctionCacheMiss':
+                # the client sends a missed function again, so this isn't
+                # an error to show
+                self.session.send(self.iopub_stream, u'pyerr', exc_content, parent=parent,
                                 ident='%s.pyerr'%self.prefix)
             reply_content = exc_content
             result_buf = []
             
             if exc_content['ename'] == 'UnmetDependency':
                 sub['dependencies_met'] = False
+            elif exc_content['ename'] == 'FunctionCacheMiss':
+                sub['function_cached'] = False
         else:
             reply_content = {'status' : 'ok'}
+            header = parent['header']
+            if self.store is not None and 'affinity' in header and \
+                    (self.keep_results or header['affinity']):
+                # only the scheduler places tasks by where results are, and
+                # it needs to know which ones we kept
+                sub['kept'] = self.store.keep_result(msg_id, result_buf)
         
         # put 'ok'/'error' status in header, for scheduler introspection:
         sub['status'] = reply_content['status']
@@ -163,6 +163,10 @@ class DependencyTimeout(ImpossibleDependency):
 class InvalidDependency(ImpossibleDependency):
     pass
 
+class FunctionCacheMiss(KernelError):
+    """A function was sent by digest to an engine that doesn't have it."""
+    pass
+
 class RemoteError(KernelError):
     """Error raised elsewhere"""
     ename=None
@@ -28,12 +28,16 @@ from zmq.eventloop.zmqstream import ZMQStream
 from .util import ISO8601
 
 def squash_unicode(obj):
-    """coerce unicode back to bytestrings."""
+    """coerce unicode back to bytestrings.
+    
+    dict keys are interned, so the many messages held by the
+    controller share a single copy of each key.
+    """
     if isinstance(obj,dict):
         for key in obj.keys():
             obj[key] = squash_unicode(obj[key])
             if isinstance(key, unicode):
-                obj[squash_unicode(key)] = obj.pop(key)
+                obj[intern(squash_unicode(key))] = obj.pop(key)
     elif isinstance(obj, list):
         for i,v in enumerate(obj):
             obj[i] = squash_unicode(v)
@@ -82,9 +82,9 @@ class ClusterTestCase(BaseZMQTestCase):
         
         assert not len(self.client.ids) < n, "waiting for engines timed out"
     
-    def connect_client(self):
+    def connect_client(self, **kwargs):
         """connect a client with my Context, and track its sockets for cleanup"""
-        c = Client(profile='iptest', context=self.context)
+        c = Client(profile='iptest', context=self.context, **kwargs)
         for name in filter(lambda n:n.endswith('socket'), dir(c)):
             s = getattr(c, name)
             s.setsockopt(zmq.LINGER, 0)
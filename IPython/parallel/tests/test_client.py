@@ -11,6 +11,8 @@
 # Imports
 #-------------------------------------------------------------------------------
 
+import json
+import pickle
 import time
 from datetime import datetime
 from tempfile import mktemp
@@ -19,7 +21,7 @@ import zmq
 
 from IPython.parallel.client import client as clientmod
 from IPython.parallel import error
-from IPython.parallel import AsyncResult, AsyncHubResult
+from IPython.parallel import AsyncResult, AsyncHubResult, ObjectRef
 from IPython.parallel import LoadBalancedView, DirectView
 
 from clienttest import ClusterTestCase, segfault, wait, add_engines
@@ -127,12 +129,27 @@ class TestClient(ClusterTestCase):
         self.assertEquals(sorted(qs.keys()), ['completed', 'queue', 'tasks'])
         allqs = self.client.queue_status()
         self.assertTrue(isinstance(allqs, dict))
-        self.assertEquals(sorted(allqs.keys()), sorted(self.client.ids + ['unassigned']))
+        self.assertEquals(sorted(allqs.keys()), sorted(self.client.ids + ['clients', 'unassigned']))
         unassigned = allqs.pop('unassigned')
+        clients = allqs.pop('clients')
+        self.assertTrue(isinstance(clients, dict))
         for eid,qs in allqs.items():
             self.assertTrue(isinstance(qs, dict))
             self.assertEquals(sorted(qs.keys()), ['completed', 'queue', 'tasks'])
 
+    def test_queue_status_clients(self):
+        """queue_status has task statistics for each client"""
+        v = self.client.load_balanced_view()
+        v.map_sync(lambda x: x, range(4))
+        me = self.client.session.session
+        # the Hub sees results after we do
+        time.sleep(0.25)
+        stats = self.client.queue_status()['clients'][me]
+        self.assertTrue(stats['completed'] >= 4)
+        self.assertEquals(stats['pending'], stats['submitted'] - stats['completed'])
+        self.assertTrue(stats['rate'] > 0)
+        self.assertTrue(0 <= stats['wait'] <= stats['max_wait'])
+
     def test_shutdown(self):
         # self.addEngine(4)
         ids = self.client.ids
@@ -223,6 +240,14 @@ class TestClient(ClusterTestCase):
         r2 = ahr.get(1)
         self.assertFalse(r1 == r2)
 
+    def test_resubmit_immediately(self):
+        """a task can be resubmitted as soon as its result arrives"""
+        v = self.client.load_balanced_view()
+        for i in range(10):
+            ar = v.apply_async(lambda : 1)
+            ar.get(1)
+            self.assertEquals(self.client.resubmit(ar.msg_ids).get(1), 1)
+
     def test_resubmit_inflight(self):
         """ensure ValueError on resubmit of inflight task"""
         v = self.client.load_balanced_view()
@@ -236,6 +261,182 @@ class TestClient(ClusterTestCase):
         """ensure KeyError on resubmit of nonexistant task"""
         self.assertRaisesRemote(KeyError, self.client.resubmit, ['invalid'])
 
+    def test_wait_timeout(self):
+        """wait returns when its timeout passes, and when its jobs are done"""
+        ar = self.client[-1].apply_async(wait, 0.5)
+        tic = time.time()
+        self.assertFalse(self.client.wait(ar, timeout=0.1))
+        self.assertTrue(time.time()-tic < 0.4)
+        self.assertTrue(self.client.wait([ar], timeout=5))
+        self.assertTrue(ar.ready())
+        self.assertTrue(self.client.wait(ar.msg_ids, timeout=0))
+    
+    def test_as_completed(self):
+        """as_completed yields jobs as they finish, with their indices"""
+        view = self.client.load_balanced_view()
+        ars = [ view.apply_async(wait, t) for t in (0.5, 0.01, 0.2) ]
+        ars.append(ars[1].msg_ids[0])
+        done = list(self.client.as_completed(ars, timeout=5))
+        self.assertEquals(sorted(i for i,ar in done), range(4))
+        self.assertEquals([ i for i,ar in done ][-2:], [2, 0])
+        self.assertEquals([ ar.get() for i,ar in done ][-2:], [0.2, 0.5])
+        ar = view.apply_async(wait, 1)
+        it = self.client.as_completed([ar], timeout=0.1)
+        self.assertRaises(error.TimeoutError, it.next)
+    
+    def test_metadata(self):
+        """Metadata records have strict keys, but accept extra iopub data"""
+        md = clientmod.Metadata(msg_id='abc')
+        self.assertEquals(md.msg_id, 'abc')
+        self.assertEquals(md['stdout'], '')
+        self.assertRaises(KeyError, md.__setitem__, 'nosuchkey', 5)
+        self.assertRaises(AttributeError, setattr, md, 'nosuchkey', 5)
+        md.update(status='ok', display_data='x')
+        self.assertEquals(md.status, 'ok')
+        self.assertEquals(md.display_data, 'x')
+        self.assertEquals(dict(md.items())['display_data'], 'x')
+        self.assertEquals(md, clientmod.Metadata(md.items()))
+        # it is still a dict, and can be pickled
+        self.assertTrue(isinstance(md, dict))
+        self.assertEquals(json.loads(json.dumps(md))['display_data'], 'x')
+        for protocol in range(3):
+            md2 = pickle.loads(pickle.dumps(md, protocol))
+            self.assertTrue(isinstance(md2, clientmod.Metadata))
+            self.assertEquals(md2, md)
+            self.assertRaises(KeyError, md2.__setitem__, 'nosuchkey', 5)
+    
+    def test_metadata_store(self):
+        """MetadataStore keeps tuples, and its Metadata write back to it"""
+        store = clientmod.MetadataStore()
+        md = store['abc']
+        self.assertTrue(isinstance(md, clientmod.Metadata))
+        md['status'] = 'ok'
+        md.update(display_data='x')
+        # everyone asking while it is in use shares it
+        self.assertTrue(store.get('abc') is md)
+        del md
+        self.assertTrue(isinstance(store._records['abc'], tuple))
+        md = store['abc']
+        self.assertEquals(md.status, 'ok')
+        self.assertEquals(md.display_data, 'x')
+        self.assertEquals(store.keys(), ['abc'])
+        # once dropped, it no longer writes back
+        self.assertTrue(store.pop('abc') is md)
+        md['stdout'] = 'x'
+        self.assertFalse('abc' in store)
+        self.assertEquals(store.get('abc'), None)
+    
+    def test_retention_get(self):
+        """retention='get' lets results go once they are collected"""
+        c = self.connect_client(retention='get')
+        ar = c[-1].apply_async(lambda : 5)
+        msg_id = ar.msg_ids[0]
+        self.assertEquals(ar.get(), 5)
+        self.assertFalse(msg_id in c.results)
+        self.assertFalse(msg_id in c.metadata)
+        self.assertEquals(ar.metadata.status, 'ok')
+        # asking again goes to the Hub
+        ahr = c.get_result(msg_id)
+        self.assertTrue(isinstance(ahr, AsyncHubResult))
+        self.assertEquals(ahr.get(), 5)
+    
+    def test_retention_weak(self):
+        """retention='weak' keeps results as long as their AsyncResults"""
+        c = self.connect_client(retention='weak')
+        ar = c[-1].apply_async(lambda : 5)
+        msg_id = ar.msg_ids[0]
+        ar.get()
+        self.assertEquals(c.results[msg_id], 5)
+        del ar
+        self.assertFalse(msg_id in c.results)
+        self.assertFalse(msg_id in c.metadata)
+        # results that arrive after their AsyncResult is gone are not kept
+        msg_id = c[-1].apply_async(wait, 0.1).msg_ids[0]
+        c.wait(msg_id)
+        self.assertFalse(msg_id in c.results)
+        self.assertFalse(msg_id in c.metadata)
+    
+    def test_retention_lru(self):
+        """retention='lru' keeps the most recently used results"""
+        c = self.connect_client(retention='lru', results_limit=1000)
+        ars = [ c[-1].apply_async(lambda i: i, i) for i in range(10) ]
+        c.wait(ars)
+        self.assertTrue(c._results_size <= 1000)
+        self.assertTrue(0 < len(c.results) < 10)
+        self.assertTrue(ars[-1].msg_ids[0] in c.results)
+        self.assertFalse(ars[0].msg_ids[0] in c.results)
+        # culled results are fetched from the Hub
+        self.assertEquals([ ar.get() for ar in ars ], range(10))
+        self.assertTrue(c._results_size <= 1000)
+        self.assertTrue(ars[-1].msg_ids[0] in c.results)
+    
+    def test_function_digest(self):
+        """functions are sent by digest to engines that have them"""
+        c = self.client
+        v = c[-1]
+        def double(x):
+            return 2*x
+        digest = c._pack_function(double)[1]
+        ar = v.apply_async(double, 1)
+        self.assertEquals(c._function_sends[ar.msg_ids[0]], (digest, None))
+        ar = v.apply_async(double, 2)
+        self.assertNotEquals(c._function_sends[ar.msg_ids[0]][1], None)
+        self.assertEquals(ar.get(), 4)
+        self.assertTrue(digest in c._engine_functions[c._engines[c.ids[-1]]])
+    
+    def test_function_cache_miss(self):
+        """a function an engine doesn't have is sent again in full, under the same msg_id"""
+        c = self.client
+        def triple(x):
+            return 3*x
+        digest = c._pack_function(triple)[1]
+        for engine in c._engines.values():
+            c._engine_functions[engine].add(digest)
+        ar = c.load_balanced_view().apply_async(triple, 2)
+        self.assertEquals(ar.get(), 6)
+        self.assertEquals(ar.metadata['status'], 'ok')
+        ar2 = c[:].apply_async(triple, 3)
+        self.assertEquals(ar2.get(), [9]*len(c.ids))
+        msg_ids = ar.msg_ids + ar2.msg_ids
+        # the Hub sees results after we do, and records only the results
+        time.sleep(0.25)
+        recs = c.db_query({'msg_id' : {'$in' : msg_ids}}, keys=['msg_id', 'result_header'])
+        self.assertEquals(sorted( r['msg_id'] for r in recs ), sorted(msg_ids))
+        for rec in recs:
+            self.assertEquals(rec['result_header']['status'], 'ok')
+    
+    def test_put(self):
+        """objects put in the Hub can be passed to tasks by reference"""
+        c = self.client
+        ref = c.put(range(10))
+        self.assertTrue(isinstance(ref, ObjectRef))
+        self.assertEquals(ref.get(), range(10))
+        msg_id = ref.msg_ids[0]
+        self.assertTrue(msg_id in c.hub_history())
+        self.assertEquals(c[-1].apply_sync(sum, ref), 45)
+        lbv = c.load_balanced_view()
+        self.assertEquals(lbv.apply_sync(lambda x, y=None: len(x)+len(y), ref, y=ref), 20)
+        self.assertEquals(lbv.apply_sync(lambda xs: map(len, xs), [ref, ref]), [10, 10])
+        # the Hub forgets it once the ObjectRef is gone
+        del ref
+        self.assertFalse(msg_id in c.hub_history())
+    
+    def test_result_reference(self):
+        """AsyncResults passed to tasks are resolved on the engine"""
+        c = self.client
+        lbv = c.load_balanced_view()
+        ar = lbv.apply_async(wait, 0.1)
+        ar2 = lbv.apply_async(lambda x: x*2, ar)
+        self.assertEquals(ar2.get(), 0.2)
+        # the scheduler, not the engine, waits for pending tasks
+        self.assertEquals(c.metadata[ar2.msg_ids[0]]['after']['dependencies'], ar.msg_ids)
+        amr = lbv.map_async(lambda x: x+1, range(4))
+        self.assertEquals(lbv.apply_sync(lambda x: x, amr), range(1,5))
+        self.assertEquals(c[-1].apply_sync(lambda x: x, amr), range(1,5))
+        bad = lbv.apply_async(lambda : 1/0)
+        # the error of a failed result is raised by the tasks given it
+        self.assertRaisesRemote(error.RemoteError, lbv.apply_sync, lambda x: x, bad)
+    
     def test_purge_results(self):
         hist = self.client.hub_history()
         self.client.purge_results(hist)
@@ -12,6 +12,7 @@
 #-------------------------------------------------------------------------------
 
 
+import logging
 import tempfile
 import time
 
@@ -20,6 +21,7 @@ from unittest import TestCase
 
 from nose import SkipTest
 
+from IPython.config.loader import Config
 from IPython.parallel import error, streamsession as ss
 from IPython.parallel.controller.dictdb import DictDB
 from IPython.parallel.controller.sqlitedb import SQLiteDB
@@ -161,10 +163,288 @@ class TestDictBackend(TestCase):
         self.db.drop_matching_records(query)
         recs = self.db.find_records(query)
         self.assertTrue(len(recs)==0)
+    
+    def test_find_records_gt(self):
+        """test finding records with '$gt' and a closed range"""
+        hist = self.db.get_history()
+        tics = [ self.db.get_record(m)['submitted'] for m in hist ]
+        recs = self.db.find_records({'submitted' : {'$gt' : tics[4]}})
+        self.assertEquals(len(recs), len([ t for t in tics if t > tics[4] ]))
+        for rec in recs:
+            self.assertTrue(rec['submitted'] > tics[4])
+        recs = self.db.find_records({'submitted' : {'$gt' : tics[0], '$lte' : tics[-1]}})
+        self.assertEquals(len(recs), len([ t for t in tics if tics[0] < t ]))
+    
+    def test_find_records_updated(self):
+        """queries on several keys see updated values"""
+        msg_ids = self.load_records(4)
+        # the table may be shared, so use values no other record has
+        a, b, c = [ s+msg_ids[0] for s in 'abc' ]
+        for msg_id in msg_ids[:2]:
+            self.db.update_record(msg_id, dict(engine_uuid=a, client_uuid=c))
+        self.db.update_record(msg_ids[2], dict(engine_uuid=b, client_uuid=c))
+        recs = self.db.find_records(dict(engine_uuid=a, client_uuid=c))
+        self.assertEquals(set([ r['msg_id'] for r in recs ]), set(msg_ids[:2]))
+        self.db.update_record(msg_ids[0], dict(engine_uuid=b))
+        recs = self.db.find_records(dict(engine_uuid={'$in' : [b]}, client_uuid=c))
+        self.assertEquals(set([ r['msg_id'] for r in recs ]), set([msg_ids[0], msg_ids[2]]))
             
 class TestSQLiteBackend(TestDictBackend):
     def create_db(self):
         return SQLiteDB(location=tempfile.gettempdir())
     
     def tearDown(self):
-        self.db._db.close()
+        self.db.close()
+    
+    def test_coalesce(self):
+        """add and update of one msg_id are written as one row"""
+        self.db.close()
+        # long interval, so nothing is written until we flush
+        self.db = SQLiteDB(location=tempfile.gettempdir(), flush_interval=60.)
+        msg_id = self.load_records(1)[-1]
+        now = self._round_to_millisecond(datetime.now())
+        self.db.update_record(msg_id, dict(stdout='hi'))
+        self.db.update_record(msg_id, dict(stdout='hello', completed=now))
+        self.assertEquals(self.db._writer.queued.keys(), [msg_id])
+        is_new, rec = self.db._writer.queued[msg_id]
+        self.assertTrue(is_new)
+        # reads see queued writes
+        rec = self.db.get_record(msg_id)
+        self.assertEquals(rec['stdout'], 'hello')
+        self.assertEquals(rec['completed'], now)
+        self.db.flush()
+        self.assertEquals(self.db._writer.queued, {})
+        rec = self.db.get_record(msg_id)
+        self.assertEquals(rec['stdout'], 'hello')
+        self.assertEquals(rec['completed'], now)
+    
+    def test_reads_dont_wait(self):
+        """reads and drops see queued writes without waiting for the writer"""
+        written = self.load_records(3)
+        self.db.close()
+        self.db = SQLiteDB(location=tempfile.gettempdir(), table=self.db.table,
+                            flush_interval=60.)
+        def flush():
+            raise AssertionError("flushed")
+        self.db._writer.flush = flush
+        queued = self.load_records(3)
+        self.db.update_record(written[0], dict(stdout='hi'))
+        self.db.update_record(queued[0], dict(stdout='hi'))
+        self.db.drop_record(written[1])
+        self.db.drop_record(queued[1])
+        self.db.drop_matching_records(dict(msg_id=queued[2]))
+        recs = self.db.find_records(dict(stdout='hi', msg_id={'$in' : written+queued}),
+                                    ['stdout'])
+        self.assertEquals(set([ r['msg_id'] for r in recs ]), set([written[0], queued[0]]))
+        self.assertEquals(recs[0].keys(), ['msg_id', 'stdout'])
+        recs = self.db.find_records({'msg_id' : {'$in' : written+queued}})
+        self.assertEquals(set([ r['msg_id'] for r in recs ]),
+                            set([written[0], written[2], queued[0]]))
+        history = self.db.get_history()
+        self.assertEquals(history[-3:], [written[0], written[2], queued[0]])
+        self.assertRaises(KeyError, self.db.get_record, written[1])
+        self.assertEquals(len(self.db._writer.queued), 5)
+        del self.db._writer.flush
+        self.db.flush()
+        self.assertEquals(self.db.get_history(), history)
+        recs = self.db.find_records({'msg_id' : {'$in' : written+queued}})
+        self.assertEquals(len(recs), 3)
+    
+    def test_update_written(self):
+        """updates of written records are merged into reads before they are written"""
+        msg_id = self.load_records(1)[-1]
+        self.db.flush()
+        self.db.update_record(msg_id, dict(stdout='hello'))
+        self.assertEquals(self.db.get_record(msg_id)['stdout'], 'hello')
+        self.db.flush()
+        self.assertEquals(self.db.get_record(msg_id)['stdout'], 'hello')
+    
+    def test_close_writes(self):
+        """closing writes everything queued"""
+        msg_ids = self.load_records(5)
+        table = self.db.table
+        self.db.close()
+        self.db = SQLiteDB(location=tempfile.gettempdir(), table=table)
+        recs = self.db.find_records({'msg_id' : {'$in' : msg_ids}})
+        self.assertEquals(len(recs), 5)
+
+    def test_bad_rows(self):
+        """rows that can't be written don't lose the rest of their batch"""
+        msg_ids = self.load_records(4)
+        self.db.flush()
+        errors = []
+        handler = logging.Handler()
+        handler.emit = errors.append
+        logging.getLogger().addHandler(handler)
+        try:
+            self.db.close()
+            self.db = SQLiteDB(location=tempfile.gettempdir(), table=self.db.table,
+                                flush_interval=60.)
+            # added twice, amid new records
+            new = self.load_records(2)
+            self.db.add_record(msg_ids[0], self.db.get_record(msg_ids[0]))
+            new.extend(self.load_records(2))
+            for msg_id in msg_ids[1:]:
+                self.db.update_record(msg_id, dict(stdout='ok'))
+            self.db.update_record(msg_ids[2], dict(stdout=object()))
+            self.db.flush()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEquals(len(errors), 2)
+        recs = self.db.find_records({'msg_id' : {'$in' : msg_ids+new}})
+        self.assertEquals(len(recs), 8)
+        stdout = dict( (rec['msg_id'], rec['stdout']) for rec in recs )
+        self.assertEquals([ stdout[m] for m in msg_ids ], ['', 'ok', '', 'ok'])
+    
+    def test_collected(self):
+        """a db that is collected without being closed writes what is queued"""
+        table = self.db.table
+        self.db.close()
+        db = SQLiteDB(location=tempfile.gettempdir(), table=table, flush_interval=60.)
+        self.db = db
+        msg_ids = self.load_records(3)
+        writer = db._writer
+        self.db = db = None
+        self.assertFalse(writer.thread.is_alive())
+        self.db = SQLiteDB(location=tempfile.gettempdir(), table=table)
+        recs = self.db.find_records({'msg_id' : {'$in' : msg_ids}})
+        self.assertEquals(len(recs), 3)
+
+
+class TestDictIndexes(TestCase):
+    """DictDB's indexed queries agree with a full scan"""
+    
+    def setUp(self):
+        self.session = ss.StreamSession()
+        self.indexed = DictDB()
+        self.scanned = DictDB(indexes=[])
+        base = datetime.now()
+        for i in range(100):
+            msg = self.session.msg('apply_request', content=dict(a=5))
+            msg['buffers'] = []
+            rec = init_record(msg)
+            rec['submitted'] = base + timedelta(seconds=i/3)
+            rec['engine_uuid'] = 'engine-%i'%(i%4)
+            rec['client_uuid'] = 'client-%i'%(i%3)
+            if i%2:
+                rec['completed'] = base + timedelta(seconds=i)
+            for db in (self.indexed, self.scanned):
+                db.add_record(msg['msg_id'], dict(rec))
+        self.base = base
+    
+    def assertSameMatches(self, query):
+        found = [ r['msg_id'] for r in self.indexed.find_records(query) ]
+        expected = [ r['msg_id'] for r in self.scanned.find_records(query) ]
+        self.assertEquals(len(found), len(set(found)))
+        self.assertEquals(set(found), set(expected))
+    
+    def test_queries(self):
+        t = lambda s: self.base + timedelta(seconds=s)
+        msg_ids = self.scanned.get_history()
+        for query in [
+                dict(engine_uuid='engine-1'),
+                dict(engine_uuid={'$in' : ['engine-1', 'engine-3', 'engine-1']}),
+                dict(engine_uuid='engine-2', client_uuid='client-1'),
+                dict(completed=None),
+                dict(completed={'$ne' : None}, engine_uuid='engine-1'),
+                dict(submitted={'$gte' : t(10), '$lt' : t(20)}),
+                dict(submitted=t(10)),
+                dict(completed={'$gt' : t(50)}, client_uuid={'$nin' : ['client-0']}),
+                dict(msg_id={'$in' : msg_ids[10:20] + ['nosuchid']}, completed={'$lt' : t(15)}),
+                dict(stdout=''),
+            ]:
+            self.assertSameMatches(query)
+    
+    def test_update_and_drop(self):
+        t = lambda s: self.base + timedelta(seconds=s)
+        for msg_id in self.scanned.get_history()[:50]:
+            for db in (self.indexed, self.scanned):
+                db.update_record(msg_id, dict(engine_uuid='new', completed=t(1000)))
+        query = dict(completed={'$ne' : None}, engine_uuid={'$in' : ['engine-1', 'new']})
+        self.assertSameMatches(query)
+        for db in (self.indexed, self.scanned):
+            db.drop_matching_records(dict(engine_uuid='new'))
+        self.assertSameMatches(query)
+        self.assertSameMatches(dict(completed={'$gte' : t(1000)}))
+        submitted = lambda db: [ db.get_record(m)['submitted'] for m in db.get_history() ]
+        self.assertEquals(submitted(self.indexed), submitted(self.scanned))
+
+
+class TestDictLimits(TestCase):
+    """DictDB culls completed records past its limits"""
+    
+    def setUp(self):
+        self.session = ss.StreamSession()
+        self.db = None
+    
+    def tearDown(self):
+        if self.db is not None and self.db._overflow is not None:
+            self.db._overflow.close()
+    
+    def load_records(self, n, nbytes=0):
+        msg_ids = []
+        for i in range(n):
+            msg = self.session.msg('apply_request', content=dict(a=5))
+            msg['buffers'] = ['x'*nbytes]
+            self.db.add_record(msg['msg_id'], init_record(msg))
+            msg_ids.append(msg['msg_id'])
+        return msg_ids
+    
+    def complete(self, msg_ids, nbytes=0):
+        for msg_id in msg_ids:
+            self.db.update_record(msg_id, dict(completed=datetime.now(),
+                                    result_buffers=['y'*nbytes]))
+    
+    def test_record_limit(self):
+        self.db = DictDB(record_limit=10)
+        msg_ids = self.load_records(20)
+        self.assertEquals(len(self.db._records), 20)
+        # only completed records are culled, the oldest first
+        self.complete(msg_ids[5:15])
+        self.assertEquals(len(self.db._records), 10)
+        for msg_id in msg_ids[5:15]:
+            self.assertRaises(KeyError, self.db.get_record, msg_id)
+        self.complete(msg_ids[:5])
+        self.assertEquals(len(self.db._records), 10)
+        self.complete(msg_ids[15:17])
+        self.assertEquals(set(self.db.get_history()), set(msg_ids[:5]+msg_ids[15:]))
+        recs = self.db.find_records(dict(completed={'$ne' : None}))
+        self.assertEquals(set(r['msg_id'] for r in recs), set(msg_ids[:5]+msg_ids[15:17]))
+    
+    def test_size_limit(self):
+        self.db = DictDB(size_limit=6000)
+        msg_ids = self.load_records(10, 500)
+        self.assertEquals(self.db._size, 5000)
+        self.complete(msg_ids, 500)
+        self.assertEquals(self.db._size, 6000)
+        self.assertEquals(set(self.db._records), set(msg_ids[4:]))
+        self.db.drop_matching_records(dict(msg_id={'$in' : msg_ids}))
+        self.assertEquals(self.db._size, 0)
+        self.assertFalse(self.db._culls)
+    
+    def test_no_limit(self):
+        """completions are only tracked for culling if there is a limit"""
+        self.db = DictDB()
+        self.complete(self.load_records(10))
+        self.assertEquals(len(self.db._records), 10)
+        self.assertFalse(self.db._culls)
+    
+    def test_spill(self):
+        config = Config()
+        config.SQLiteDB.location = tempfile.gettempdir()
+        self.db = DictDB(record_limit=5, spill=True, config=config,
+                    session=self.session.session)
+        msg_ids = self.load_records(10, 10)
+        self.complete(msg_ids[:8], 10)
+        self.assertEquals(len(self.db._records), 5)
+        for msg_id in msg_ids:
+            rec = self.db.get_record(msg_id)
+            self.assertEquals(rec['msg_id'], msg_id)
+            self.assertEquals(rec['buffers'], ['x'*10])
+        recs = self.db.find_records(dict(msg_id={'$in' : msg_ids}))
+        self.assertEquals(sorted(r['msg_id'] for r in recs), sorted(msg_ids))
+        self.assertEquals(self.db.get_history(), msg_ids)
+        self.db.update_record(msg_ids[0], dict(stdout='late'))
+        self.assertEquals(self.db.get_record(msg_ids[0])['stdout'], 'late')
+        self.db.drop_matching_records(dict(completed={'$ne' : None}))
+        self.assertEquals(self.db.get_history(), msg_ids[8:])
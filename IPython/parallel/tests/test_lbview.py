@@ -18,6 +18,7 @@ import zmq
 
 from IPython import parallel  as pmod
 from IPython.parallel import error
+from IPython.parallel.client.remotefunction import ParallelFunction
 
 from IPython.parallel.tests import add_engines
 
@@ -51,6 +52,81 @@ class TestLoadBalancedView(ClusterTestCase):
         r = self.view.map_sync(f, data)
         self.assertEquals(r, map(f, data))
 
+    def test_map_guided(self):
+        def f(x):
+            return x**2
+        data = range(100)
+        ar = self.view.map_async(f, data, chunksize='guided')
+        self.assertEquals(ar.get(), map(f, data))
+        self.assertTrue(1 < len(ar.msg_ids) < len(data))
+
+    def test_map_auto(self):
+        def f(x, y):
+            return x*y
+        data = range(200)
+        r = self.view.map_sync(f, data, data, chunksize='auto')
+        self.assertEquals(r, map(f, data, data))
+
+    def test_map_auto_iter(self):
+        def f(x):
+            import time
+            time.sleep(0.001)
+            return -x
+        data = range(300)
+        ar = self.view.map_async(f, data, chunksize='auto')
+        self.assertEquals(list(ar), map(f, data))
+        self.assertTrue(len(ar.msg_ids) < len(data))
+        self.assertEquals(ar.get(), map(f, data))
+
+    def test_imap_unordered(self):
+        def f(x):
+            import time
+            time.sleep(0.5 if x == 0 else 0.01)
+            return 2*x
+        data = range(8)
+        for chunksize in (1, 'auto'):
+            r = list(self.view.imap_unordered(f, data, chunksize=chunksize))
+            self.assertEquals(sorted(r), list(enumerate(map(f, data))))
+            # others may queue behind the slow one, but not all of them
+            self.assertNotEquals(r[0], (0, 0))
+    
+    def test_imap(self):
+        def f(x, y):
+            return x+y
+        data = xrange(50)
+        it = self.view.imap(f, iter(data), (2*x for x in data), chunksize=3, window=4)
+        self.assertEquals(it.next(), 0)
+        self.assertTrue(len(self.view.outstanding) <= 4)
+        self.assertEquals(list(it), [ 3*x for x in data ][1:])
+        r = list(self.view.imap(f, data, data, chunksize='auto', ordered=False))
+        self.assertEquals(sorted(r), list(enumerate(2*x for x in data)))
+        self.assertRaises(ValueError, self.view.imap, f, data, data, chunksize='guided')
+    
+    def test_imap_unordered_window(self):
+        """imap(ordered=False) has at most `window` chunks in flight"""
+        before = len(self.client.history)
+        it = self.view.imap(lambda x: x, iter(xrange(50)), ordered=False, window=4)
+        for i, r in enumerate(it):
+            # i+1 chunks are consumed, and the rest are in flight
+            self.assertTrue(len(self.client.history) - before - (i+1) <= 4)
+        self.assertEquals(i, 49)
+    
+    def test_imap_forgets(self):
+        """imap lets go of results once they are consumed"""
+        msg_ids = set(self.client.history)
+        self.assertEquals(list(self.view.imap(abs, xrange(-10, 0), chunksize=2)), range(10, 0, -1))
+        new = set(self.client.history).difference(msg_ids)
+        self.assertEquals(len(new), 5)
+        for msg_id in new:
+            self.assertFalse(msg_id in self.client.results)
+            self.assertFalse(msg_id in self.view.results)
+    
+    def test_map_schedule_dist(self):
+        pf = ParallelFunction(self.view, abs, dist='r', chunksize='auto')
+        self.assertRaises(ValueError, pf.map, range(4))
+        pf = ParallelFunction(self.view, abs, chunksize='bogus')
+        self.assertRaises(ValueError, pf.map, range(4))
+
     def test_abort(self):
         view = self.view
         ar = self.client[:].apply_async(time.sleep, .5)
@@ -74,6 +150,16 @@ class TestLoadBalancedView(ClusterTestCase):
         with view.temp_flags(retries=len(self.client), timeout=0.25):
             self.assertRaisesRemote(error.TaskTimeout, view.apply_sync, fail)
 
+    def test_priority(self):
+        view = self.view
+        with view.temp_flags(priority=10):
+            ar = view.apply_async(lambda : 10)
+        self.assertEquals(ar.get(), 10)
+        self.assertEquals(view.priority, 0)
+        with view.temp_flags(priority=-1):
+            ars = [ view.apply_async(lambda x: x, i) for i in range(4) ]
+        self.assertEquals([ ar.get() for ar in ars ], range(4))
+
     def test_invalid_dependency(self):
         view = self.view
         with view.temp_flags(after='12345'):
@@ -109,6 +195,23 @@ class TestLoadBalancedView(ClusterTestCase):
         for ar in ars:
             self.assertEquals(ar.engine_id, first_id)
 
+    def test_affinity(self):
+        """tasks go where the data they use already is"""
+        view = self.view
+        refs = [ self.client.put(range(i, 100000)) for i in range(3) ]
+        first = [ view.apply_async(len, ref) for ref in refs ]
+        self.assertEquals([ ar.get() for ar in first ], [100000, 99999, 99998])
+        # in reverse, so least recently used engines are not the ones
+        for i, ref in reversed(list(enumerate(refs))):
+            ar = view.apply_async(sum, ref)
+            self.assertEquals(ar.get(), sum(range(i, 100000)))
+            self.assertEquals(ar.engine_id, first[i].engine_id)
+        # a result stays where it was computed
+        with view.temp_flags(affinity=first[1]):
+            ar = view.apply_async(lambda : 1)
+        ar.get()
+        self.assertEquals(ar.engine_id, first[1].engine_id)
+    
     def test_after(self):
         view = self.view
         ar = view.apply_async(time.sleep, 0.5)
@@ -118,3 +221,21 @@ class TestLoadBalancedView(ClusterTestCase):
         ar.wait()
         ar2.wait()
         self.assertTrue(ar2.started > ar.completed)
+
+    def test_after_many(self):
+        view = self.view
+        ar = view.apply_async(time.sleep, 0.5)
+        with view.temp_flags(after=ar):
+            ars = [ view.apply_async(lambda x: x, i) for i in range(50) ]
+        self.assertEquals([ a.get(10) for a in ars ], range(50))
+        for a in ars:
+            self.assertTrue(a.started > ar.completed)
+
+    def test_after_timeout(self):
+        view = self.view
+        ar = view.apply_async(time.sleep, 3)
+        with view.temp_flags(after=ar, timeout=0.1):
+            ar2 = view.apply_async(lambda : 1)
+        # the timeout audit runs every two seconds
+        self.assertRaisesRemote(error.TaskTimeout, ar2.get, 5)
+        ar.get()
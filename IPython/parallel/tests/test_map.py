@@ -0,0 +1,112 @@
+"""test the chunk schedules for load-balanced maps"""
+
+#-------------------------------------------------------------------------------
+#  Copyright (C) 2011  The IPython Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Imports
+#-------------------------------------------------------------------------------
+
+from unittest import TestCase
+
+from IPython.parallel.client import map as Map
+from IPython.parallel.tests.clienttest import skip_without
+
+
+class PartitionTest(TestCase):
+
+    def test_bounds(self):
+        m = Map.Map()
+        for n in (0, 1, 7, 16, 101):
+            for q in (1, 3, 4, 16):
+                parts = [ m.getPartition(range(n), p, q) for p in range(q) ]
+                self.assertEquals(sum(parts, []), range(n))
+                sizes = map(len, parts)
+                self.assertTrue(max(sizes) - min(sizes) <= 1)
+                self.assertEquals(sizes, sorted(sizes, reverse=True))
+
+    def test_round_robin_list(self):
+        m = Map.RoundRobinMap()
+        parts = [ m.getPartition(range(10), p, 3) for p in range(3) ]
+        self.assertEquals(parts, [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]])
+        self.assertEquals(m.joinPartitions(parts), range(10))
+
+    @skip_without('numpy')
+    def test_join_arrays(self):
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        a = numpy.arange(30).reshape(10, 3)
+        for m in (Map.Map(), Map.RoundRobinMap()):
+            parts = [ m.getPartition(a, p, 4) for p in range(4) ]
+            # views, not copies
+            for part in parts:
+                self.assertTrue(numpy.may_share_memory(part, a))
+            joined = m.joinPartitions(parts)
+            self.assertEquals(joined.dtype, a.dtype)
+            assert_array_equal(joined, a)
+        # mixed dtypes are joined in the one they all fit in
+        joined = Map.Map().joinPartitions([numpy.arange(3), numpy.ones(2)])
+        self.assertEquals(joined.dtype, numpy.float64)
+        assert_array_equal(joined, [0, 1, 2, 1, 1])
+
+
+class GuidedChunksTest(TestCase):
+
+    def test_sizes(self):
+        chunks = Map.GuidedChunks()
+        chunks.start(100, 4)
+        sizes = chunks.sizes(100)
+        self.assertEquals(sum(sizes), 100)
+        self.assertEquals(sizes[0], 13)
+        self.assertEquals(sizes, sorted(sizes, reverse=True))
+        self.assertEquals(sizes[-1], 1)
+
+    def test_minimum(self):
+        chunks = Map.GuidedChunks(minimum=5)
+        chunks.start(100, 4)
+        sizes = chunks.sizes(100)
+        self.assertEquals(sum(sizes), 100)
+        self.assertEquals(min(sizes[:-1]), 5)
+
+
+class AdaptiveChunksTest(TestCase):
+
+    def test_initial(self):
+        chunks = Map.AdaptiveChunks(initial=2)
+        chunks.start(1000, 4)
+        self.assertEquals([ chunks.next_chunk(1000) for i in range(3) ], [2, 2, 2])
+        self.assertEquals(chunks.next_chunk(1), 1)
+
+    def test_target(self):
+        """chunks grow toward the target, but not too fast"""
+        chunks = Map.AdaptiveChunks(target=0.1, growth=4)
+        chunks.start(100000, 2)
+        chunks.next_chunk(100000)
+        chunks.record(1, 0.001, 0.)
+        self.assertEquals(chunks.next_chunk(100000), 4)
+        for i in range(10):
+            n = chunks.next_chunk(100000)
+            chunks.record(n, n*0.001, 0.)
+        self.assertEquals(chunks.next_chunk(100000), 100)
+
+    def test_overhead(self):
+        """high overhead makes chunks longer than the target"""
+        chunks = Map.AdaptiveChunks(target=0.1, growth=1000)
+        chunks.start(100000, 2)
+        chunks.next_chunk(100000)
+        chunks.record(1, 0.001, 0.05)
+        self.assertEquals(chunks.next_chunk(100000), 500)
+
+    def test_tail(self):
+        """near the end, chunks shrink as with GuidedChunks"""
+        chunks = Map.AdaptiveChunks(target=1, growth=1000)
+        chunks.start(100, 2)
+        chunks.next_chunk(100)
+        chunks.record(1, 0.001, 0.)
+        self.assertEquals(chunks.next_chunk(40), 10)
+        self.assertEquals(chunks.next_chunk(3), 1)
+
@@ -13,9 +13,12 @@
 
 from unittest import TestCase
 
+import zmq
+
 from IPython.testing.decorators import parametric
 from IPython.utils import newserialized as ns
-from IPython.utils.pickleutil import can, uncan, CannedObject, CannedFunction
+from IPython.utils.pickleutil import can, uncan, CannedObject, CannedFunction, Reference
+from IPython.parallel import error, util
 from IPython.parallel.tests.clienttest import skip_without
 
 
@@ -94,6 +97,55 @@ class CanningTestCase(TestCase):
         a[2] = 1e9
         self.assertTrue((a==final).all())
     
+    @skip_without('numpy')
+    def test_noncontiguous_ndarray(self):
+        """Fortran-ordered and strided arrays are sent without copying"""
+        import numpy
+        big = numpy.arange(400000.).reshape(4, 100000)
+        for a in (numpy.asfortranarray(big), big.T, big[::2], big[::2].T):
+            ser = ns.serialize(a)
+            bufs = ser.getData()
+            if not isinstance(bufs, list):
+                bufs = [bufs]
+            self.assertEquals(len(bufs), ser.getMetadata().get('frames', 1))
+            for buf in bufs:
+                self.assertTrue(numpy.may_share_memory(numpy.frombuffer(buf), a))
+            final = ns.unserialize(ser)
+            self.assertEquals(final.shape, a.shape)
+            self.assertTrue((final == a).all())
+    
+    @skip_without('numpy')
+    def test_small_frames_copied(self):
+        """strided arrays with blocks under min_frame_bytes are copied"""
+        import numpy
+        big = numpy.arange(400000.).reshape(4, 100000)
+        for a in (big[:, ::2], numpy.asfortranarray(big)[:, ::2]):
+            ser = ns.serialize(a)
+            md = ser.getMetadata()
+            self.assertFalse('frames' in md)
+            self.assertFalse('order' in md)
+            buf = ser.getData()
+            self.assertFalse(isinstance(buf, list))
+            self.assertFalse(numpy.may_share_memory(numpy.frombuffer(buf), a))
+            final = ns.unserialize(ser)
+            self.assertEquals(final.shape, a.shape)
+            self.assertTrue((final == a).all())
+        # the threshold can be lowered, by argument or for the module
+        a = big[:, ::2]
+        ser = ns.serialize(a, min_frame_bytes=0)
+        self.assertEquals(ser.getMetadata()['frames'], a.size)
+        self.assertTrue((ns.unserialize(ser) == a).all())
+        a = big[:2, ::1000]
+        saved = ns.min_frame_bytes
+        ns.min_frame_bytes = 8
+        try:
+            ser = ns.serialize(a)
+        finally:
+            ns.min_frame_bytes = saved
+        self.assertEquals(len(ser.getData()), a.size)
+        self.assertTrue(numpy.may_share_memory(numpy.frombuffer(ser.getData()[0]), a))
+        self.assertTrue((ns.unserialize(ser) == a).all())
+    
     def test_uncan_function_globals(self):
         """test that uncanning a module function restores it into its module"""
         from re import search
@@ -105,4 +157,124 @@ class CanningTestCase(TestCase):
         self.assertEqual(csearch.__module__, search.__module__)
         self.assertNotEqual(csearch('asd', 'asdf'), None)
         
-        
\ No newline at end of file
+        
+
+
+class SerializeObjectTestCase(TestCase):
+    
+    def test_small_items_packed(self):
+        """small items of a sequence are pickled together, in one frame"""
+        obj = [ (i, 'x'*100, float(i)) for i in range(1000) ]
+        pmd, bufs = util.serialize_object(obj)
+        self.assertEquals(bufs, [])
+        self.assertEquals(util.unserialize_object([pmd]), (obj, []))
+        obj = tuple(obj)
+        pmd, bufs = util.serialize_object(obj)
+        self.assertEquals(util.unserialize_object([pmd])[0], obj)
+    
+    def test_large_items_separate(self):
+        big = 'y'*100000
+        obj = [1, big, buffer(big), 'z']
+        pmd, bufs = util.serialize_object(obj)
+        self.assertEquals(len(bufs), 2)
+        self.assertTrue(bufs[0] is big)
+        self.assertEquals(util.unserialize_object([pmd]+bufs+['extra'])[1], ['extra'])
+        obj2 = util.unserialize_object([pmd]+bufs)[0]
+        self.assertEquals(obj2[:2], obj[:2])
+        self.assertEquals(str(obj2[2]), big)
+    
+    @skip_without('numpy')
+    def test_ndarrays(self):
+        import numpy
+        a = numpy.arange(1000.)
+        small = numpy.arange(3)
+        objects = numpy.array([None, 'a'], dtype=object)
+        pmd, bufs = util.serialize_object([a, small, objects, numpy.float64(2.5)])
+        self.assertEquals(len(bufs), 1)
+        obj = util.unserialize_object([pmd]+bufs)[0]
+        self.assertTrue((obj[0] == a).all())
+        self.assertTrue((obj[1] == small).all())
+        self.assertEquals(list(obj[2]), [None, 'a'])
+        self.assertEquals(obj[3], 2.5)
+    
+    def test_canned_items(self):
+        """items that need canning are still uncanned"""
+        obj = [1, (2, lambda x: 2*x)]
+        pmd, bufs = util.serialize_object(obj)
+        obj2 = util.unserialize_object([pmd]+bufs)[0]
+        self.assertEquals(obj2[1][1](3), 6)
+        msg = util.pack_apply_message(len, (Reference('a'), 1), {})
+        self.assertEquals(util.unpack_apply_message(msg, dict(a=5))[1], (5, 1))
+    
+    @skip_without('numpy')
+    def test_zero_copy(self):
+        """arrays received in Messages are read-only views of them"""
+        import numpy
+        a = numpy.arange(1000.)
+        pmd, bufs = util.serialize_object([a, 'b'])
+        msgs = map(zmq.Message, [pmd]+bufs)
+        a2 = util.unserialize_object(msgs, copy=False)[0][0]
+        self.assertTrue((a2 == a).all())
+        self.assertFalse(a2.flags.writeable)
+        self.assertTrue(isinstance(a2.base, buffer))
+        msg = util.pack_apply_message(len, (a,), dict(x=a))
+        for writeable in (False, True):
+            f, args, kwargs = util.unpack_apply_message(map(zmq.Message, msg),
+                                        copy=False, writeable=writeable)
+            self.assertEquals(args[0].flags.writeable, writeable)
+            self.assertEquals(kwargs['x'].flags.writeable, writeable)
+            self.assertTrue((kwargs['x'] == a).all())
+    
+    @skip_without('numpy')
+    def test_strided_frames(self):
+        """each contiguous block of a strided array is its own frame"""
+        import numpy
+        big = numpy.arange(400000.).reshape(4, 100000)
+        a = big[::2]
+        pmd, bufs = util.serialize_object([a, 'b', a.T])
+        self.assertEquals(len(bufs), 4)
+        msgs = map(zmq.Message, [pmd]+bufs+['extra'])
+        obj, rest = util.unserialize_object(msgs, copy=False)
+        self.assertTrue((obj[0] == a).all())
+        self.assertTrue((obj[2] == a.T).all())
+        self.assertEquals(len(rest), 1)
+        msg = util.pack_apply_message(len, (a,), dict(x=a.T))
+        f, args, kwargs = util.unpack_apply_message(msg)
+        self.assertTrue((args[0] == a).all())
+        self.assertTrue((kwargs['x'] == a.T).all())
+    
+    def test_cached_function(self):
+        """functions sent by digest come from the FunctionCache"""
+        f = lambda x: x+1
+        buf, digest, digest_buf = util.pack_function(f)
+        self.assertTrue(len(digest_buf) < len(buf))
+        self.assertEquals(util.pack_function(len)[1:], (None, None))
+        functions = util.FunctionCache()
+        msg = util.pack_apply_message(f, (1,), {}, fbuf=buf)
+        f2 = util.unpack_apply_message(msg, functions=functions)[0]
+        self.assertEquals(f2(1), 2)
+        msg[0] = digest_buf
+        self.assertTrue(util.unpack_apply_message(msg, functions=functions)[0] is f2)
+        self.assertRaises(error.FunctionCacheMiss, util.unpack_apply_message, msg,
+                    functions=util.FunctionCache())
+    
+    def test_function_cache_lru(self):
+        functions = util.FunctionCache(2)
+        functions.put('a', 1)
+        functions.put('b', 2)
+        functions.get('a')
+        functions.put('c', 3)
+        self.assertEquals(len(functions), 2)
+        self.assertFalse('b' in functions)
+        self.assertEquals(functions.get('a'), 1)
+    
+    def test_apply_message(self):
+        f = lambda *a, **kw: None
+        args = (5, 'x'*100000, range(10))
+        kwargs = dict(a=1, b='y'*100)
+        msg = util.pack_apply_message(f, args, kwargs)
+        for copy in (True, False):
+            bufs = msg if copy else map(zmq.Message, msg)
+            f2, args2, kwargs2 = util.unpack_apply_message(bufs, copy=copy)
+            self.assertEquals(tuple(args2), args)
+            self.assertEquals(kwargs2, kwargs)
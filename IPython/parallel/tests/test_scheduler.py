@@ -0,0 +1,542 @@
+"""test the engine selection structures of the TaskScheduler"""
+
+#-------------------------------------------------------------------------------
+#  Copyright (C) 2011  The IPython Development Team
+#
+#  Distributed under the terms of the BSD License.  The full license is in
+#  the file COPYING, distributed as part of this software.
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Imports
+#-------------------------------------------------------------------------------
+
+import time
+from datetime import datetime
+from random import randint, random
+from unittest import TestCase
+
+from IPython.parallel.controller import scheduler as sched
+from IPython.parallel.util import ISO8601
+
+
+class FenwickTreeTest(TestCase):
+
+    def test_total(self):
+        weights = [ random() for i in range(37) ]
+        tree = sched.FenwickTree(weights)
+        self.assertAlmostEquals(tree.total(), sum(weights))
+        tree[5] = 10
+        tree.append(2.5)
+        self.assertAlmostEquals(tree.total(), sum(weights)-weights[5]+12.5)
+
+    def test_find(self):
+        tree = sched.FenwickTree([1., 0., 2., 0., 0., 3.])
+        self.assertEquals([ tree.find(x) for x in (0, 0.5, 1, 2.9, 3, 5.9) ],
+                        [0, 0, 2, 2, 5, 5])
+
+    def test_sample_skips_zero(self):
+        tree = sched.FenwickTree([0.]*10)
+        self.assertEquals(tree.sample(), None)
+        tree[7] = 1.
+        for i in range(10):
+            self.assertEquals(tree.sample(), 7)
+
+
+class SelectorTest(TestCase):
+
+    uids = [ 'engine-%i'%i for i in range(8) ]
+
+    def make(self, scheme, hwm=0):
+        selector = sched.make_selector(scheme, hwm)
+        for uid in self.uids:
+            selector.add_engine(uid)
+        return selector
+
+    def test_make_selector(self):
+        self.assertTrue(isinstance(self.make(sched.leastload), sched.LeastLoadSelector))
+        self.assertTrue(isinstance(self.make(sched.weighted), sched.WeightedSelector))
+        custom = lambda loads: len(loads)-1
+        selector = self.make(custom)
+        self.assertEquals(type(selector), sched.EngineSelector)
+        # new engines go to the head of the line, so the first one registered is last
+        self.assertEquals(selector.choose(), self.uids[0])
+
+    def test_indexed_matches_scan(self):
+        """indexed selectors agree with the chooser functions"""
+        for scheme in (sched.leastload, sched.lru):
+            indexed = self.make(scheme)
+            scan = self.make(scheme)
+            scan.__class__ = sched.EngineSelector
+            for i in range(200):
+                uid = indexed.choose()
+                self.assertEquals(uid, scan.choose())
+                if random() < 0.3:
+                    busy = [ u for u in self.uids if indexed.loads[u] ]
+                    if busy:
+                        done = busy[randint(0, len(busy)-1)]
+                        indexed.finish_job(done)
+                        scan.finish_job(done)
+                indexed.add_job(uid)
+                scan.add_job(uid)
+
+    def test_hwm(self):
+        for scheme in sched.selectors:
+            selector = self.make(scheme, hwm=2)
+            chosen = []
+            for i in range(2*len(self.uids)):
+                uid = selector.choose()
+                self.assertFalse(uid is None)
+                chosen.append(uid)
+                selector.add_job(uid)
+            self.assertEquals(sorted(chosen), sorted(self.uids*2))
+            self.assertFalse(selector.has_room())
+            self.assertEquals(selector.choose(), None)
+            selector.finish_job(self.uids[3])
+            self.assertTrue(selector.has_room())
+            self.assertEquals(selector.choose(), self.uids[3])
+
+    def test_exclude(self):
+        for scheme in sched.selectors:
+            selector = self.make(scheme)
+            exclude = set(self.uids[1:])
+            for i in range(10):
+                self.assertEquals(selector.choose(exclude), self.uids[0])
+            self.assertEquals(selector.choose(set(self.uids)), None)
+
+    def test_remove_engine(self):
+        for scheme in sched.selectors:
+            selector = self.make(scheme)
+            for uid in self.uids[1:]:
+                selector.remove_engine(uid)
+            for i in range(10):
+                uid = selector.choose()
+                self.assertEquals(uid, self.uids[0])
+                selector.add_job(uid)
+            selector.add_engine('new')
+            self.assertTrue(selector.choose() in ('new', self.uids[0]))
+
+
+class PacerTest(TestCase):
+
+    def test_limit(self):
+        pacer = sched.Pacer(initial=2, maximum=16)
+        self.assertEquals(pacer.limit('a'), 2)
+        # short tasks, long round trips
+        pacer.finished('a', 0.001, 0.0045)
+        self.assertEquals(pacer.limit('a'), 5)
+        pacer.finished('b', 0., 0.001)
+        self.assertEquals(pacer.limit('b'), 16)
+        # long tasks are not prefetched
+        pacer.finished('c', 10., 10.01)
+        self.assertEquals(pacer.limit('c'), 1)
+        # without a round trip, the duration alone changes nothing
+        pacer.finished('d', 1.)
+        self.assertEquals(pacer.limit('d'), 2)
+        pacer.remove_engine('a')
+        self.assertEquals(pacer.limit('a'), 2)
+
+    def test_average(self):
+        pacer = sched.Pacer()
+        pacer.finished('a', 1., 2.)
+        for i in range(50):
+            pacer.finished('a', 0.01)
+        self.assertAlmostEquals(pacer.durations['a'], 0.01, 3)
+        self.assertEquals(pacer.limit('a'), 32)
+
+    def test_selector_limits(self):
+        selector = sched.make_selector(sched.leastload, hwm=0)
+        for uid in 'ab':
+            selector.add_engine(uid)
+        selector.set_limit('a', 1)
+        selector.add_job('a')
+        self.assertTrue(selector.full('a'))
+        self.assertEquals(selector.choose(), 'b')
+        for i in range(10):
+            selector.add_job('b')
+        self.assertFalse(selector.full('b'))
+        selector.set_limit('a', 2)
+        self.assertEquals(selector.choose(), 'a')
+
+
+class SpeculatorTest(TestCase):
+    
+    def test_threshold(self):
+        spec = sched.Speculator(90)
+        for i in range(9):
+            spec.finished('a', i+1)
+        # too few to tell
+        self.assertEquals(spec.threshold('a'), None)
+        spec.finished('a', 10)
+        self.assertEquals(spec.threshold('a'), 9)
+        self.assertEquals(spec.threshold('b'), None)
+        for i in range(spec.window):
+            spec.finished('a', 0.5)
+        self.assertEquals(spec.threshold('a'), 0.5)
+    
+
+class HoldingsTest(TestCase):
+
+    def make(self, limit=1000):
+        holdings = sched.Holdings(limit)
+        for uid in ('a', 'b'):
+            holdings.add_engine(uid)
+        return holdings
+
+    def test_held(self):
+        holdings = self.make()
+        holdings.add('a', 'x', 100)
+        holdings.add('a', 'y', 200)
+        holdings.add('b', 'y')
+        self.assertEquals(holdings.holders['y'], set(['a', 'b']))
+        affinity = dict(x=0, y=0, z=50)
+        self.assertEquals(holdings.held('a', affinity), 300)
+        self.assertEquals(holdings.held('b', affinity), 200)
+        holdings.remove_engine('a')
+        self.assertFalse('x' in holdings.sizes)
+        self.assertEquals(holdings.holders['y'], set(['b']))
+
+    def test_lru(self):
+        holdings = self.make()
+        for m in 'uvw':
+            holdings.add('a', m, 400)
+        # u was the least recently used
+        self.assertEquals(holdings.held('a', dict(u=0, v=0, w=0)), 800)
+        holdings.add('a', 'v')
+        holdings.add('a', 'x', 400)
+        self.assertEquals(holdings.held('a', dict(v=0, w=0, x=0)), 800)
+        self.assertFalse('w' in holdings.holders)
+        # too big to keep
+        holdings.add('b', 'big', 2000)
+        self.assertFalse('big' in holdings.holders)
+
+
+class JobTest(TestCase):
+
+    def test_full_header(self):
+        header = dict(msg_id='abc', msg_type='apply_request', session='s',
+                    after=dict(dependencies=['x'], all=False, success=True, failure=True),
+                    follow=[], targets=['e'], timeout=None, retries=2)
+        after = sched.Dependency(header['after'])
+        job = sched.Job('abc', [], ['client'], header, set(['e']), after,
+                    sched.MET, None, retries=2)
+        for key in sched.DIRECTIVES:
+            self.assertFalse(key in job.header)
+        full = job.full_header()
+        self.assertEquals(full['affinity'], {})
+        self.assertEquals(full['after'], header['after'])
+        self.assertEquals(full['targets'], ['e'])
+        self.assertEquals(full['retries'], 2)
+        self.assertEquals(full['priority'], 0)
+        self.assertEquals(full['msg_id'], 'abc')
+
+    def test_dependency_flags(self):
+        dep = sched.Dependency(['a'], all=False, failure=True)
+        self.assertFalse(dep.all)
+        self.assertTrue(dep.success)
+        self.assertTrue(dep.failure)
+        dep = sched.Dependency(['a'])
+        self.assertEquals((dep.all, dep.success, dep.failure), (True, True, False))
+
+
+
+class QueueTest(TestCase):
+    """drive a TaskScheduler in-process, with a fake engine"""
+
+    engine = 'engine-0'
+
+    def setUp(self):
+        import zmq
+        from zmq.eventloop import ioloop
+        from zmq.eventloop.zmqstream import ZMQStream
+        self.zmq = zmq
+        self.context = zmq.Context()
+        loop = ioloop.IOLoop()
+        streams = {}
+        for name,kind in [('client_stream', zmq.XREP), ('engine_stream', zmq.XREP),
+                        ('mon_stream', zmq.PUB), ('notifier_stream', zmq.SUB),
+                        ('control_stream', zmq.XREQ)]:
+            s = self.context.socket(kind)
+            s.setsockopt(zmq.LINGER, 0)
+            streams[name] = ZMQStream(s, loop)
+        self.streams = streams.values()
+        self.scheduler = sched.TaskScheduler(scheme=sched.leastload, loop=loop, hwm=2,
+                                            preempt=True, **streams)
+        self.scheduler._register_engine(self.engine)
+
+    def tearDown(self):
+        for s in self.streams:
+            s.socket.close()
+        self.context.term()
+
+    def submit(self, priority=0, client='client', username='user', **directives):
+        session = self.scheduler.session
+        msg = session.msg('apply_request', {}, subheader=dict(priority=priority,
+                                                username=username, **directives))
+        raw = map(self.zmq.Message, session.serialize(msg, ident=client))
+        self.scheduler.dispatch_submission(raw)
+        return msg['header']['msg_id']
+
+    def reply(self, msg_id, status='ok', client='client', engine=None, cached=True, kept=False):
+        session = self.scheduler.session
+        parent = dict(msg_id=msg_id, session=session.session, username=session.username)
+        started = datetime.now().strftime(ISO8601)
+        msg = session.msg('apply_reply', {}, parent=parent,
+                            subheader=dict(status=status, started=started, function_cached=cached,
+                                            kept=kept))
+        raw = map(self.zmq.Message, session.serialize(msg, ident=[engine or self.engine, client]))
+        self.scheduler.dispatch_result(raw)
+
+    def running(self):
+        return set(self.scheduler.pending[self.engine])
+
+    def test_priority_order(self):
+        self.scheduler.preempt = False
+        first, second = self.submit(), self.submit()
+        low = [ self.submit(-1) for i in range(3) ]
+        normal = self.submit()
+        high = self.submit(5)
+        self.assertEquals(len(self.scheduler.waiting), 5)
+        self.reply(first)
+        self.assertEquals(self.running(), set([second, high]))
+        self.reply(second)
+        self.assertEquals(self.running(), set([high, normal]))
+        self.reply(high)
+        self.assertEquals(self.running(), set([normal, low[0]]))
+
+    def test_preempt(self):
+        first, second = self.submit(), self.submit()
+        high = self.submit(5)
+        # the first is taken to be running, the second is aborted for high
+        self.assertEquals(self.running(), set([first, high]))
+        self.assertEquals(self.scheduler.preempted.keys(), [second])
+        self.assertEquals(self.scheduler.selector.loads[self.engine], 2)
+        # no more to preempt for equal priority
+        other = self.submit(5)
+        self.assertEquals(self.running(), set([first, high]))
+        self.reply(second, 'aborted')
+        self.assertFalse(self.scheduler.preempted)
+        self.reply(first)
+        self.assertEquals(self.running(), set([high, other]))
+        self.reply(high)
+        self.assertEquals(self.running(), set([other, second]))
+
+    def test_preempted_stranded(self):
+        scheduler = self.scheduler
+        first, second = self.submit(), self.submit()
+        high = self.submit(5)
+        self.reply(first)
+        self.reply(high)
+        self.assertEquals(scheduler.preempted.keys(), [second])
+        # the engine dies before acknowledging the abort
+        scheduler._register_engine('engine-1')
+        scheduler._unregister_engine(self.engine)
+        scheduler.handle_stranded_tasks(self.engine)
+        self.assertFalse(scheduler.preempted)
+        self.assertEquals(scheduler.pending['engine-1'].keys(), [second])
+
+    def test_preempt_too_late(self):
+        first, second = self.submit(), self.submit()
+        high = self.submit(5)
+        self.reply(first)
+        # second was already running when the abort arrived
+        self.reply(second)
+        self.assertFalse(self.scheduler.preempted)
+        self.assertTrue(second in self.scheduler.all_completed)
+        self.assertEquals(self.running(), set([high]))
+        self.assertEquals(self.scheduler.selector.loads[self.engine], 1)
+
+    def test_holdings_kept(self):
+        """only the results an engine says it kept are held there"""
+        holdings = self.scheduler.holdings
+        dropped, kept = self.submit(), self.submit()
+        self.reply(dropped)
+        self.reply(kept, kept=True)
+        self.assertFalse(dropped in holdings.holders)
+        self.assertEquals(holdings.holders[kept], set([self.engine]))
+    
+    def test_function_miss(self):
+        scheduler = self.scheduler
+        session = scheduler.session
+        msg = session.msg('apply_request', {})
+        msg_id = msg['header']['msg_id']
+        def send():
+            raw = map(self.zmq.Message, session.serialize(msg, ident='client'))
+            scheduler.dispatch_submission(raw)
+        send()
+        self.reply(msg_id, 'error', cached=False)
+        # neither done nor failed, until it is sent again in full
+        self.assertFalse(msg_id in scheduler.all_done)
+        self.assertEquals(scheduler.missed.keys(), [msg_id])
+        self.assertFalse(self.running())
+        self.assertFalse(scheduler.inflight)
+        send()
+        self.assertFalse(scheduler.missed)
+        self.assertEquals(self.running(), set([msg_id]))
+        self.reply(msg_id)
+        self.assertTrue(msg_id in scheduler.all_completed)
+        self.assertFalse(msg_id in scheduler.all_failed)
+    
+    def test_held_for_targets(self):
+        """a job that can't run on its targets is only retried when they reply"""
+        scheduler = self.scheduler
+        scheduler.preempt = False
+        scheduler._register_engine('engine-1')
+        first, second = [ self.submit(targets=[self.engine]) for i in range(2) ]
+        target = self.submit(targets=[self.engine])
+        self.assertEquals(self.running(), set([first, second]))
+        self.assertFalse(scheduler.waiting)
+        self.assertEquals(scheduler.blocked[self.engine].keys(), [target])
+        tried = []
+        maybe_run = scheduler.maybe_run
+        def counted(job):
+            tried.append(job.msg_id)
+            return maybe_run(job)
+        scheduler.maybe_run = counted
+        other = self.submit()
+        self.assertTrue(other in scheduler.pending['engine-1'])
+        self.reply(other, engine='engine-1')
+        self.assertFalse(target in tried)
+        self.reply(first)
+        self.assertEquals(self.running(), set([second, target]))
+        self.assertFalse(scheduler.blocked)
+    
+    def test_rescan(self):
+        """a failure in run_waiting asks for another pass, instead of a nested one"""
+        scheduler = self.scheduler
+        scheduler.preempt = False
+        scheduler._register_engine('engine-1')
+        for i in range(2):
+            self.submit(targets=['engine-1'])
+        doomed = self.submit(targets=['engine-1'])
+        self.assertEquals(scheduler.blocked['engine-1'].keys(), [doomed])
+        passes = []
+        scan = scheduler._scan_waiting
+        def watched():
+            # never inside another pass
+            self.assertFalse(passes and passes[-1] is None)
+            passes.append(None)
+            scan()
+            passes[-1] = True
+        scheduler._scan_waiting = watched
+        scheduler._unregister_engine('engine-1')
+        self.assertFalse(scheduler.blocked)
+        scheduler.run_waiting()
+        self.assertTrue(doomed in scheduler.all_failed)
+        # the failure asked for a second pass, after the first
+        self.assertEquals(passes, [True, True])
+        self.assertFalse(scheduler._scanning)
+    
+    def test_fair_share(self):
+        scheduler = self.scheduler
+        scheduler.hwm = scheduler.selector.hwm = 1
+        scheduler.shares = dict(big=2)
+        msg_id, client = self.submit(client='a'), 'a'
+        for i in range(6):
+            self.submit(client='a')
+            self.submit(client='c', username='big')
+        turns = []
+        for i in range(9):
+            self.reply(msg_id, client=client)
+            job, = scheduler.pending[self.engine].values()
+            msg_id, client = job.msg_id, job.idents[0]
+            turns.append(client)
+        # c has twice the share, so it gets twice the turns
+        self.assertEquals(turns[:2], ['c', 'c'])
+        self.assertEquals(turns.count('c'), 6)
+
+    def test_forget_vtimes(self):
+        scheduler = self.scheduler
+        scheduler.hwm = scheduler.selector.hwm = 1
+        vtimes = scheduler.waiting.vtimes
+        # clients that come and go are forgotten
+        for i in range(100):
+            self.submit(client='c%i'%i)
+            self.submit(client='c%i'%i)
+            while scheduler.pending[self.engine]:
+                job, = scheduler.pending[self.engine].values()
+                self.reply(job.msg_id, client=job.idents[0])
+        self.assertTrue(len(vtimes) <= 2 * scheduler.waiting.kept)
+        self.assertTrue(len(vtimes) < 50)
+        # but not while they have jobs waiting
+        self.submit(client='a')
+        self.submit(client='b')
+        scheduler.waiting.prune()
+        self.assertEquals(set(vtimes), set(['b']))
+    
+    def test_client_hwm(self):
+        scheduler = self.scheduler
+        scheduler.hwm = scheduler.selector.hwm = 0
+        scheduler.client_hwm = 2
+        flood = [ self.submit(client='a') for i in range(10) ]
+        self.assertEquals(self.running(), set(flood[:2]))
+        other = self.submit(client='b')
+        self.assertEquals(self.running(), set(flood[:2] + [other]))
+        self.reply(flood[0])
+        self.assertEquals(self.running(), set(flood[1:3] + [other]))
+        self.assertEquals(len(scheduler.waiting), 7)
+
+    def test_adaptive_hwm(self):
+        scheduler = self.scheduler
+        scheduler.hwm = scheduler.selector.hwm = 0
+        scheduler.preempt = False
+        scheduler.adaptive_hwm = True
+        scheduler.pacer = sched.Pacer(initial=2, maximum=8)
+        scheduler.selector.set_limit(self.engine, 2)
+        jobs = [ self.submit() for i in range(20) ]
+        self.assertEquals(self.running(), set(jobs[:2]))
+        scheduler.pacer.finished(self.engine, 0.001, 0.01)
+        self.reply(jobs[0])
+        # the first reply is for a job sent to an idle engine
+        self.assertEquals(scheduler.selector.limit(self.engine), 8)
+        self.assertEquals(len(self.running()), 8)
+    
+    def straggle(self):
+        """submit a job, and have it run long enough to get a backup"""
+        scheduler = self.scheduler
+        scheduler.preempt = False
+        scheduler.speculator = sched.Speculator(90)
+        scheduler._register_engine('engine-1')
+        for i in range(10):
+            scheduler.speculator.finished('client', 0.01)
+        msg_id = self.submit()
+        engine, = [ uid for uid,jobs in scheduler.pending.items() if msg_id in jobs ]
+        backup, = set(scheduler.targets).difference([engine])
+        scheduler.busy[engine] = time.time()
+        scheduler.back_up_stragglers()
+        self.assertFalse(scheduler.copies)
+        scheduler.busy[engine] -= 1
+        scheduler.back_up_stragglers()
+        self.assertEquals(scheduler.copies[msg_id], set([engine, backup]))
+        self.assertTrue(msg_id in scheduler.pending[backup])
+        return msg_id, engine, backup
+    
+    def test_speculate(self):
+        scheduler = self.scheduler
+        msg_id, engine, backup = self.straggle()
+        # the backup wins, and the straggler's reply is dropped
+        self.reply(msg_id, engine=backup)
+        self.assertTrue(msg_id in scheduler.all_completed)
+        self.assertEquals(scheduler.destinations[msg_id], backup)
+        self.assertFalse(scheduler.copies)
+        self.assertEquals(scheduler.losers[msg_id], set([engine]))
+        self.assertFalse(msg_id in scheduler.pending[engine])
+        self.assertEquals(scheduler.selector.loads, {engine : 1, backup : 0})
+        self.reply(msg_id, engine=engine)
+        self.assertFalse(scheduler.losers)
+        self.assertEquals(scheduler.selector.loads, {engine : 0, backup : 0})
+        self.assertFalse(scheduler.inflight)
+    
+    def test_speculate_failure(self):
+        scheduler = self.scheduler
+        msg_id, engine, backup = self.straggle()
+        # a failed copy leaves the other to finish
+        self.reply(msg_id, 'error', engine=backup)
+        self.assertFalse(msg_id in scheduler.all_done)
+        self.assertEquals(scheduler.copies[msg_id], set([engine]))
+        self.assertFalse(scheduler.pending[backup])
+        self.reply(msg_id, engine=engine)
+        self.assertTrue(msg_id in scheduler.all_completed)
+        self.assertFalse(scheduler.copies)
+        self.assertFalse(scheduler.losers)
+        self.assertEquals(scheduler.selector.loads, {engine : 0, backup : 0})
@@ -22,6 +22,7 @@ from IPython import parallel  as pmod
 from IPython.parallel import error
 from IPython.parallel import AsyncResult, AsyncHubResult, AsyncMapResult
 from IPython.parallel import DirectView
+from IPython.parallel import util
 from IPython.parallel.util import interactive
 
 from IPython.parallel.tests import add_engines
@@ -170,6 +171,33 @@ class TestView(ClusterTestCase):
         ar._tracker.wait()
         self.assertTrue(ar.sent)
         
+    def test_apply_broadcast(self):
+        """test that apply on many engines only packs the message once"""
+        view = self.client[:]
+        packed = []
+        pack = util.pack_apply_message
+        def counting_pack(*args, **kwargs):
+            packed.append(args)
+            return pack(*args, **kwargs)
+        util.pack_apply_message = counting_pack
+        try:
+            ar = view.apply_async(lambda x: x, 'x'*1024)
+        finally:
+            util.pack_apply_message = pack
+        self.assertEquals(len(packed), 1)
+        self.assertEquals(len(set(ar.msg_ids)), len(view.targets))
+        self.assertEquals(ar.get(), ['x'*1024]*len(view.targets))
+    
+    @skip_without('numpy')
+    def test_apply_broadcast_numpy(self):
+        """test broadcasting an array argument to many engines"""
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[:]
+        a = numpy.arange(1024)
+        for b in view.apply_sync(lambda x: x, a):
+            assert_array_equal(b, a)
+    
     def test_push_tracked(self):
         t = self.client.ids[-1]
         ns = dict(x='x'*1024*1024)
@@ -224,7 +252,183 @@ class TestView(ClusterTestCase):
         view.scatter('a', a)
         b = view.gather('a', block=True)
         assert_array_equal(b, a)
+
+    @skip_without('numpy')
+    def test_scatter_gather_numpy_round_robin(self):
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[:]
+        a = numpy.arange(300, dtype=numpy.int32).reshape(100, 3)
+        view.scatter('a', a, dist='r')
+        self.assertEquals(view.pull('a', targets=view.targets[0], block=True).shape[1], 3)
+        b = view.gather('a', dist='r', block=True)
+        self.assertEquals(b.dtype, a.dtype)
+        assert_array_equal(b, a)
+
+    def test_tree(self):
+        """binomial trees reach every rank once, with contiguous subtrees"""
+        from IPython.parallel.engine.peers import tree_parent, tree_children
+        def subtree(rank, n):
+            ranks = [rank]
+            for child in tree_children(rank, n):
+                self.assertEquals(tree_parent(child), rank)
+                ranks.extend(subtree(child, n))
+            return ranks
+        for n in range(1, 20):
+            self.assertEquals(tree_parent(0), None)
+            self.assertEquals(subtree(0, n), range(n))
+
+    def test_broadcast(self):
+        view = self.client[:]
+        view.broadcast('b', dict(a=range(10)), block=True)
+        self.assertEquals(view.pull('b', block=True), [dict(a=range(10))]*len(view.targets))
+
+    @skip_without('numpy')
+    def test_broadcast_numpy(self):
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[:]
+        a = numpy.arange(100000)
+        view.broadcast('a', a, block=True)
+        for b in view.pull('a', block=True):
+            assert_array_equal(b, a)
+        # arrays received from other engines are writeable
+        view.execute('a[0] = -1', block=True)
+
+    def test_reduce(self):
+        """reduce folds the values in the order of the engines"""
+        view = self.client[:]
+        view.scatter('s', range(len(view.targets)), flatten=True, block=True)
+        view.execute('s = str(s)', block=True)
+        ranks = map(str, range(len(view.targets)))
+        self.assertEquals(view.reduce(lambda a,b: a+b, 's', block=True), ''.join(ranks))
+        targets = view.targets[::-1]
+        self.assertEquals(view.reduce(lambda a,b: a+b, 's', targets=targets, block=True),
+                        ''.join(ranks[::-1]))
+
+    def test_allreduce(self):
+        view = self.client[:]
+        view.scatter('n', range(len(view.targets)), flatten=True, block=True)
+        expected = sum(range(len(view.targets)))
+        self.assertEquals(view.allreduce(lambda a,b: a+b, 'n', 'total', block=True), expected)
+        self.assertEquals(view.pull('total', block=True), [expected]*len(view.targets))
+
+    @skip_without('numpy')
+    def test_sendrecv(self):
+        """engines exchange arrays with their neighbors in a ring"""
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[:]
+        view['ids'] = view.targets
+        @interactive
+        def exchange(n):
+            import numpy
+            from IPython.parallel.engine.peers import communicator
+            com = communicator()
+            i = ids.index(com.id)
+            right, left = ids[(i+1)%len(ids)], ids[i-1]
+            a = numpy.arange(n, dtype=numpy.int32).reshape(-1, 2) * com.id
+            # a strided array, and a small one sent to ourself
+            com.send(right, a[::2], tag='strided')
+            com.send(com.id, a[:2], tag='self')
+            halo = com.sendrecv(right, a, source=left, tag='halo')
+            return halo, com.recv(left, tag='strided'), com.recv(com.id, tag='self')
+        targets = view.targets
+        for n in (8, 200000):
+            for i, (halo, strided, own) in enumerate(view.apply_sync(exchange, n)):
+                a = numpy.arange(n, dtype=numpy.int32).reshape(-1, 2)
+                left = targets[i-1]
+                self.assertEquals(halo.dtype, numpy.int32)
+                assert_array_equal(halo, a * left)
+                assert_array_equal(strided, a[::2] * left)
+                assert_array_equal(own, a[:2] * targets[i])
+
+    def test_send_objects(self):
+        """objects other than arrays are serialized, in the order sent"""
+        view = self.client[:2]
+        view['ids'] = view.targets
+        @interactive
+        def ping():
+            from IPython.parallel.engine.peers import communicator
+            com = communicator()
+            other = ids[1] if com.id == ids[0] else ids[0]
+            for i in range(3):
+                com.send(other, dict(i=i, frm=com.id), tag='obj')
+            return [ com.recv(other, tag='obj') for i in range(3) ]
+        a, b = view.targets
+        self.assertEquals(view.apply_sync(ping),
+            [ [dict(i=i, frm=b) for i in range(3)], [dict(i=i, frm=a) for i in range(3)] ])
+
+    def test_drop_invalid(self):
+        """messages to an engine without the session key are dropped"""
+        view = self.client[-1]
+        @interactive
+        def forge():
+            import zmq
+            from IPython.parallel import error
+            from IPython.parallel.engine.peers import communicator
+            com = communicator()
+            s = com.context.socket(zmq.PUSH)
+            s.connect(com.url)
+            envelope = com.session.pack(dict(key='wrong', status='ok', sender=com.id, tag='forged'))
+            s.send_multipart([envelope] + com._pack('forged')[1])
+            s.send('ok %i 6 forged'%com.id)
+            timeout, com.timeout = com.timeout, 1
+            try:
+                com.recv(com.id, tag='forged')
+            except error.TimeoutError:
+                return True
+            finally:
+                com.timeout = timeout
+                s.close()
+            return False
+        self.assertTrue(view.apply_sync(forge))
     
+    def test_send_unknown_engine(self):
+        view = self.client[-1]
+        @interactive
+        def send():
+            from IPython.parallel.engine.peers import communicator
+            communicator().send(-5, 'x')
+        self.assertRaisesRemote(error.InvalidEngineID, view.apply_sync, send)
+
+    def test_reduce_error(self):
+        """a failure on any engine is raised by reduce and allreduce"""
+        view = self.client[:]
+        view.push(dict(x=1), block=True)
+        view.execute('del x', targets=view.targets[0], block=True)
+        self.assertRaisesRemote(NameError, view.reduce, lambda a,b: a+b, 'x', block=True)
+        self.assertRaisesRemote(NameError, view.allreduce, lambda a,b: a+b, 'x', block=True)
+        # failures elsewhere reach the first engine as RemoteErrors
+        view.push(dict(x=1), block=True)
+        view.execute('del x', targets=view.targets[-1], block=True)
+        for f in (view.reduce, view.allreduce):
+            try:
+                f(lambda a,b: a+b, 'x', block=True)
+            except error.RemoteError as e:
+                self.assertEquals(e.ename, 'RemoteError')
+                self.assertTrue(e.evalue.startswith('NameError'), e.evalue)
+            else:
+                self.fail("should have raised a RemoteError")
+        view.push(dict(x=1), block=True)
+        self.assertRaisesRemote(ZeroDivisionError, view.reduce, lambda a,b: a/0, 'x', block=True)
+        # and every engine can go on to the next
+        self.assertEquals(view.apply_sync(lambda : 1), [1]*len(view.targets))
+
+    @skip_without('numpy')
+    def test_push_noncontiguous_numpy(self):
+        """pushed strided and Fortran arrays arrive intact and writeable"""
+        import numpy
+        from numpy.testing.utils import assert_array_equal
+        view = self.client[-1]
+        big = numpy.arange(400000.).reshape(4, 100000)
+        ns = dict(a=big[::2], b=numpy.asfortranarray(big), c=big[:, ::2])
+        view.push(ns, block=True)
+        for key, value in ns.iteritems():
+            assert_array_equal(view.pull(key, block=True), value)
+        view.execute('a[0,0] = b[0,0] = -1', block=True)
+        self.assertEquals(view.pull(['a', 'b'], block=True)[0][0,0], -1)
+
     def test_map(self):
         view = self.client[:]
         def f(x):
@@ -11,12 +11,14 @@
 #-----------------------------------------------------------------------------
 
 # Standard library imports.
+import hashlib
 import logging
 import os
 import re
 import stat
 import socket
 import sys
+from collections import deque
 from datetime import datetime
 from signal import signal, SIGINT, SIGABRT, SIGTERM
 try:
@@ -32,13 +34,20 @@ except:
     import pickle
 
 # System library imports
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import zmq
 from zmq.log import handlers
 
 # IPython imports
-from IPython.utils.pickleutil import can, uncan, canSequence, uncanSequence
+from IPython.utils.pickleutil import (can, uncan, canSequence, uncanSequence,
+                                      CannedFunction)
 from IPython.utils.newserialized import serialize, unserialize
 from IPython.zmq.log import EnginePUBHandler
+from IPython.parallel import error
 
 # globals
 ISO8601="%Y-%m-%dT%H:%M:%S.%f"
@@ -65,6 +74,35 @@ class Namespace(dict):
         self[key] = value
     
 
+class PackedSequence(object):
+    """A list or tuple pickled in one pass, by serialize_object.
+    
+    Large arrays and buffers are left out of `items`, and sent as separate
+    frames.  `serialized` has the index in `items` and the data-less
+    Serialized wrapper of each of them.  `canned` is whether any item had
+    to be canned, so the receiver can skip uncanning when none did.
+    """
+    
+    def __init__(self, kind, items, serialized, canned=True):
+        self.kind = kind
+        self.items = items
+        self.serialized = serialized
+        self.canned = canned
+    
+    def unpack(self, bufs, g=None, copy=True, writeable=False):
+        """Put the separate frames popped from `bufs` back in their places,
+        returning the uncanned sequence."""
+        items = self.items
+        for index, s in self.serialized:
+            _set_data(s, bufs, copy)
+            items[index] = _unserialize(s, writeable)
+        if self.kind is not list:
+            items = self.kind(items)
+        if self.canned:
+            items = uncanSequence(items, g)
+        return items
+
+
 class ReverseDict(dict):
     """simple double-keyed subset of dict methods."""
     
@@ -179,6 +217,24 @@ def disambiguate_ip_address(ip, location=None):
             return location
     return ip
 
+def local_interface(url):
+    """The tcp interface that this machine reaches the zmq url `url` from,
+    such as tcp://10.0.0.2, for binding sockets the same peers can reach.
+    
+    Non-tcp urls are on this machine, so they are reached from localhost."""
+    try:
+        proto,ip,port = split_url(url)
+    except AssertionError:
+        return 'tcp://127.0.0.1'
+    ip = disambiguate_ip_address(ip)
+    # connecting a udp socket sends nothing, but picks the route
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((ip, int(port)))
+        return 'tcp://%s'%s.getsockname()[0]
+    finally:
+        s.close()
+
 def disambiguate_url(url, location=None):
     """turn multi-ip interfaces '0.0.0.0' and '*' into connectable
     ones, based on the location (default interpretation is localhost).
@@ -217,16 +273,140 @@ def rekey(dikt):
             dikt[nk] = dikt.pop(k)
     return dikt
 
-def serialize_object(obj, threshold=64e-6):
+
+class CachedFunction(object):
+    """The function of an apply message, with the digest of its pickled
+    CannedFunction, so that engines can keep it in a FunctionCache.
+    
+    `canned` is the CannedFunction, or None if the engine should already
+    have it.
+    """
+    
+    def __init__(self, digest, canned=None):
+        self.digest = digest
+        self.canned = canned
+
+
+class FunctionCache(object):
+    """Uncanned functions by digest, forgetting the least recently used
+    ones beyond `size`."""
+    
+    def __init__(self, size=1024):
+        self.size = size
+        self.clear()
+    
+    def __len__(self):
+        return len(self._functions)
+    
+    def __contains__(self, digest):
+        return digest in self._functions
+    
+    def clear(self):
+        self._functions = {}
+        self._stamps = {}
+        self._uses = deque()
+        self._clock = 0
+    
+    def _use(self, digest):
+        self._clock += 1
+        self._stamps[digest] = self._clock
+        self._uses.append((self._clock, digest))
+    
+    def get(self, digest):
+        f = self._functions.get(digest)
+        if f is not None:
+            self._use(digest)
+        return f
+    
+    def put(self, digest, f):
+        self._functions[digest] = f
+        self._use(digest)
+        uses = self._uses
+        stamps = self._stamps
+        while len(self._functions) > self.size:
+            stamp, old = uses.popleft()
+            if stamps.get(old) == stamp:
+                del self._functions[old]
+                del stamps[old]
+        if len(uses) > 2*len(stamps) + 64:
+            # drop the stale entries
+            self._uses = deque(sorted( (stamp, d) for d, stamp in stamps.iteritems() ))
+
+# the types that serialize_object may send as separate frames
+_frame_types = set([str, buffer])
+if numpy is not None:
+    _frame_types.add(numpy.ndarray)
+
+def _separate(obj, threshold, bytes_threshold):
+    """Whether an item of a sequence should be sent as its own frame."""
+    if isinstance(obj, buffer):
+        return len(obj) > threshold*1e6
+    elif isinstance(obj, str):
+        return len(obj) > bytes_threshold*1e6
+    elif numpy is not None and isinstance(obj, numpy.ndarray):
+        return obj.shape != () and not obj.dtype.hasobject and obj.nbytes > threshold*1e6
+    return False
+
+def _get_data(s, databuffers):
+    """Move the data of Serialized `s` to the end of `databuffers`.
+    
+    A strided array has one frame per contiguous block."""
+    data = s.getData()
+    if isinstance(data, list):
+        databuffers.extend(data)
+    else:
+        databuffers.append(data)
+    s.data = None
+
+def _set_data(s, bufs, copy=True):
+    """Give Serialized `s` its data from the received frames `bufs`,
+    popping as many as it was sent in.
+    
+    Arrays and buffers get a read-only view of the frame, whether it is
+    bytes or a zmq Message, so their data is never copied.  This uses the
+    old buffer protocol, since numpy on Python 2 can't build an array on
+    the memoryview of a Message.
+    """
+    frames = s.getMetadata().get('frames', 1)
+    if frames > 1:
+        s.data = [ buffer(bufs.pop(0)) for i in range(frames) ]
+        return
+    m = bufs.pop(0)
+    if s.getTypeDescriptor() in ('buffer', 'ndarray'):
+        s.data = buffer(m)
+    elif copy:
+        s.data = m
+    else:
+        s.data = m.bytes
+
+def _unserialize(s, writeable=False):
+    """unserialize `s`, copying an array if it has to be `writeable`."""
+    obj = unserialize(s)
+    if writeable and s.getTypeDescriptor() == 'ndarray' and \
+            not isinstance(s.getData(), list):
+        obj = obj.copy()
+    return obj
+
+def serialize_object(obj, threshold=64e-6, bytes_threshold=1e-2):
     """Serialize an object into a list of sendable buffers.
     
+    The items of a list or tuple are pickled together in one pass, as a
+    PackedSequence, except for arrays and buffers larger than `threshold`
+    and strings larger than `bytes_threshold`, which are sent as separate
+    frames without copying.  Strided arrays are sent as one frame per
+    contiguous block, unless those would be smaller than
+    `IPython.utils.newserialized.min_frame_bytes` (64kB), in which case
+    the array is copied into one frame.
+    
     Parameters
     ----------
     
     obj : object
         The object to be serialized
     threshold : float
-        The threshold for not double-pickling the content.
+        The size in MB above which arrays and buffers are not pickled.
+    bytes_threshold : float
+        The size in MB above which strings in a sequence are not pickled.
         
     
     Returns
@@ -237,57 +417,95 @@ def serialize_object(obj, threshold=64e-6):
     """
     databuffers = []
     if isinstance(obj, (list, tuple)):
-        clist = canSequence(obj)
-        slist = map(serialize, clist)
-        for s in slist:
-            if s.typeDescriptor in ('buffer', 'ndarray') or s.getDataSize() > threshold:
-                databuffers.append(s.getData())
-                s.data = None
-        return pickle.dumps(slist,-1), databuffers
+        canned = canSequence(obj)
+        items = list(canned)
+        slist = []
+        frame_types = _frame_types
+        for index, item in enumerate(items):
+            if type(item) in frame_types and _separate(item, threshold, bytes_threshold):
+                s = serialize(item)
+                _get_data(s, databuffers)
+                slist.append((index, s))
+                items[index] = None
+        packed = PackedSequence(type(obj), items, slist, canned is not obj)
+        return pickle.dumps(packed,-1), databuffers
     elif isinstance(obj, dict):
         sobj = {}
         for k in sorted(obj.iterkeys()):
             s = serialize(can(obj[k]))
             if s.typeDescriptor in ('buffer', 'ndarray') or s.getDataSize() > threshold:
-                databuffers.append(s.getData())
-                s.data = None
+                _get_data(s, databuffers)
             sobj[k] = s
         return pickle.dumps(sobj,-1),databuffers
     else:
         s = serialize(can(obj))
         if s.typeDescriptor in ('buffer', 'ndarray') or s.getDataSize() > threshold:
-            databuffers.append(s.getData())
-            s.data = None
+            _get_data(s, databuffers)
         return pickle.dumps(s,-1),databuffers
             
         
-def unserialize_object(bufs):
-    """reconstruct an object serialized by serialize_object from data buffers."""
+def unserialize_object(bufs, copy=True):
+    """reconstruct an object serialized by serialize_object from data buffers.
+    
+    With copy=False, `bufs` are zmq Messages, and arrays in the object are
+    read-only views of them."""
     bufs = list(bufs)
-    sobj = pickle.loads(bufs.pop(0))
-    if isinstance(sobj, (list, tuple)):
+    pmd = bufs.pop(0)
+    sobj = pickle.loads(pmd if copy else pmd.bytes)
+    if isinstance(sobj, PackedSequence):
+        return sobj.unpack(bufs, copy=copy), bufs
+    elif isinstance(sobj, (list, tuple)):
         for s in sobj:
             if s.data is None:
-                s.data = bufs.pop(0)
+                _set_data(s, bufs, copy)
         return uncanSequence(map(unserialize, sobj)), bufs
     elif isinstance(sobj, dict):
         newobj = {}
         for k in sorted(sobj.iterkeys()):
             s = sobj[k]
             if s.data is None:
-                s.data = bufs.pop(0)
+                _set_data(s, bufs, copy)
             newobj[k] = uncan(unserialize(s))
         return newobj, bufs
     else:
         if sobj.data is None:
-            sobj.data = bufs.pop(0)
+            _set_data(sobj, bufs, copy)
         return uncan(unserialize(sobj)), bufs
 
-def pack_apply_message(f, args, kwargs, threshold=64e-6):
+def pack_function(f):
+    """Pickle `f` for the first buffer of an apply message.
+    
+    Returns (buf, digest, digest_buf).  Plain functions are sent as a
+    CachedFunction: in full in `buf`, then only as `digest_buf` to engines
+    that have it.  For other callables, digest and digest_buf are None.
+    """
+    canned = can(f)
+    if not isinstance(canned, CannedFunction):
+        return pickle.dumps(canned,-1), None, None
+    digest = hashlib.sha1(pickle.dumps(canned,-1)).hexdigest()
+    return (pickle.dumps(CachedFunction(digest, canned),-1), digest,
+            pickle.dumps(CachedFunction(digest),-1))
+
+def _cached_function(cf, g, functions):
+    """The function of CachedFunction `cf`, from `functions` if it was
+    sent by digest alone."""
+    if cf.canned is None:
+        f = None if functions is None else functions.get(cf.digest)
+        if f is None:
+            raise error.FunctionCacheMiss(cf.digest)
+        return f
+    f = uncan(cf.canned, g)
+    if functions is not None:
+        functions.put(cf.digest, f)
+    return f
+
+def pack_apply_message(f, args, kwargs, threshold=64e-6, fbuf=None):
     """pack up a function, args, and kwargs to be sent over the wire
     as a series of buffers. Any object whose data is larger than `threshold`
-    will not have their data copied (currently only numpy arrays support zero-copy)"""
-    msg = [pickle.dumps(can(f),-1)]
+    will not have their data copied (currently only numpy arrays support zero-copy)
+    
+    `fbuf` is `f` already pickled by pack_function, if it was."""
+    msg = [pickle.dumps(can(f),-1) if fbuf is None else fbuf]
     databuffers = [] # for large objects
     sargs, bufs = serialize_object(args,threshold)
     msg.append(sargs)
@@ -298,8 +516,17 @@ def pack_apply_message(f, args, kwargs, threshold=64e-6):
     msg.extend(databuffers)
     return msg
 
-def unpack_apply_message(bufs, g=None, copy=True):
+def unpack_apply_message(bufs, g=None, copy=True, writeable=False, functions=None):
     """unpack f,args,kwargs from buffers packed by pack_apply_message()
+    
+    With copy=False, `bufs` are zmq Messages.  Arrays sent as their own
+    frames are read-only views of them, unless `writeable`, in which case
+    they are copied.
+    
+    Functions sent in full are kept in the FunctionCache `functions`, and
+    functions sent by digest are looked up there.  FunctionCacheMiss is
+    raised if one isn't found.
+    
     Returns: original f,args,kwargs"""
     bufs = list(bufs) # allow us to pop
     assert len(bufs) >= 3, "not enough buffers!"
@@ -307,48 +534,28 @@ def unpack_apply_message(bufs, g=None, copy=True):
         for i in range(3):
             bufs[i] = bufs[i].bytes
     cf = pickle.loads(bufs.pop(0))
-    sargs = list(pickle.loads(bufs.pop(0)))
+    sargs = pickle.loads(bufs.pop(0))
     skwargs = dict(pickle.loads(bufs.pop(0)))
     # print sargs, skwargs
-    f = uncan(cf, g)
-    for sa in sargs:
-        if sa.data is None:
-            m = bufs.pop(0)
-            if sa.getTypeDescriptor() in ('buffer', 'ndarray'):
-                # always use a buffer, until memoryviews get sorted out
-                sa.data = buffer(m)
-                # disable memoryview support
-                # if copy:
-                #     sa.data = buffer(m)
-                # else:
-                #     sa.data = m.buffer
-            else:
-                if copy:
-                    sa.data = m
-                else:
-                    sa.data = m.bytes
+    if isinstance(cf, CachedFunction):
+        f = _cached_function(cf, g, functions)
+    else:
+        f = uncan(cf, g)
+    if isinstance(sargs, PackedSequence):
+        args = sargs.unpack(bufs, g, copy, writeable)
+    else:
+        sargs = list(sargs)
+        for sa in sargs:
+            if sa.data is None:
+                _set_data(sa, bufs, copy)
+        args = uncanSequence([ _unserialize(sa, writeable) for sa in sargs ], g)
     
-    args = uncanSequence(map(unserialize, sargs), g)
     kwargs = {}
     for k in sorted(skwargs.iterkeys()):
         sa = skwargs[k]
         if sa.data is None:
-            m = bufs.pop(0)
-            if sa.getTypeDescriptor() in ('buffer', 'ndarray'):
-                # always use a buffer, until memoryviews get sorted out
-                sa.data = buffer(m)
-                # disable memoryview support
-                # if copy:
-                #     sa.data = buffer(m)
-                # else:
-                #     sa.data = m.buffer
-            else:
-                if copy:
-                    sa.data = m
-                else:
-                    sa.data = m.bytes
-
-        kwargs[k] = uncan(unserialize(sa), g)
+            _set_data(sa, bufs, copy)
+        kwargs[k] = uncan(_unserialize(sa, writeable), g)
     
     return f,args,kwargs
 
@@ -365,8 +572,20 @@ def interactive(f):
     return f
 
 @interactive
-def _push(ns):
-    """helper method for implementing `client.push` via `client.apply`"""
+def _push(**ns):
+    """helper method for implementing `client.push` via `client.apply`
+    
+    The values arrive as keyword arguments, so arrays are sent as their own
+    frames rather than pickled.  Arrays that arrive as read-only views of
+    those frames are copied, as pushed names have always been writeable.
+    """
+    try:
+        from numpy import ndarray
+    except ImportError:
+        ndarray = ()
+    for key, value in ns.iteritems():
+        if isinstance(value, ndarray) and not value.flags.writeable:
+            ns[key] = value.copy()
     globals().update(ns)
 
 @interactive
@@ -383,6 +602,51 @@ def _pull(keys):
             raise NameError("name '%s' is not defined"%keys)
         return user_ns.get(keys)
 
+@interactive
+def _broadcast(name, ids, tag, obj=None):
+    """helper method for implementing `DirectView.broadcast` via `client.apply`
+    
+    Engine ids[0] is sent `obj`, and sends it on to the others.
+    """
+    from IPython.parallel.engine.peers import communicator
+    try:
+        from numpy import ndarray
+    except ImportError:
+        ndarray = ()
+    obj = communicator().broadcast(ids, tag, obj)
+    if isinstance(obj, ndarray) and not obj.flags.writeable:
+        obj = obj.copy()
+    globals()[name] = obj
+
+@interactive
+def _reduce(f, name, ids, tag, dest=None):
+    """helper method for implementing `DirectView.reduce` and `allreduce`
+    via `client.apply`
+    
+    The result is returned by engine ids[0], and also stored as `dest` on
+    every engine if it is given.
+    """
+    from IPython.parallel.engine.peers import communicator
+    user_ns = globals()
+    obj = failure = None
+    if user_ns.has_key(name):
+        obj = user_ns[name]
+    else:
+        failure = NameError("name '%s' is not defined"%name)
+    com = communicator()
+    if dest is None:
+        return com.reduce(ids, tag, f, obj, failure)
+    try:
+        from numpy import ndarray
+    except ImportError:
+        ndarray = ()
+    result = com.allreduce(ids, tag, f, obj, failure)
+    if isinstance(result, ndarray) and not result.flags.writeable:
+        result = result.copy()
+    user_ns[dest] = result
+    if ids[0] == com.id:
+        return result
+
 @interactive
 def _execute(code):
     """helper method for implementing `client.execute` via `client.apply`"""
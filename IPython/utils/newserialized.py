@@ -90,7 +90,7 @@ class SerializeIt(object):
     
     # implements(ISerialized)
     
-    def __init__(self, unSerialized):
+    def __init__(self, unSerialized, min_frame_bytes=None):
         self.data = None
         self.obj = unSerialized.getObject()
         if globals().has_key('numpy') and isinstance(self.obj, numpy.ndarray):
@@ -98,10 +98,14 @@ class SerializeIt(object):
                 self.typeDescriptor = 'pickle'
                 self.metadata = {}
             else:
-                self.obj = numpy.ascontiguousarray(self.obj, dtype=None)
                 self.typeDescriptor = 'ndarray'
                 self.metadata = {'shape':self.obj.shape,
                                  'dtype':self.obj.dtype.str}
+                self.obj, order, frames = array_layout(self.obj, min_frame_bytes)
+                if order == 'F':
+                    self.metadata['order'] = 'F'
+                if frames > 1:
+                    self.metadata['frames'] = frames
         elif isinstance(self.obj, str):
             self.typeDescriptor = 'bytes'
             self.metadata = {}
@@ -115,7 +119,11 @@ class SerializeIt(object):
     
     def _generateData(self):
         if self.typeDescriptor == 'ndarray':
-            self.data = numpy.getbuffer(self.obj)
+            frames = self.metadata.get('frames', 1)
+            if frames > 1:
+                self.data = [ numpy.getbuffer(b) for b in _blocks(self.obj) ]
+            else:
+                self.data = numpy.getbuffer(self.obj)
         elif self.typeDescriptor in ('bytes', 'buffer'):
             self.data = self.obj
         elif self.typeDescriptor == 'pickle':
@@ -128,6 +136,8 @@ class SerializeIt(object):
         return self.data
         
     def getDataSize(self, units=10.0**6):
+        if isinstance(self.data, list):
+            return 1.0*sum(map(len, self.data))/units
         return 1.0*len(self.data)/units
         
     def getTypeDescriptor(self):
@@ -147,13 +157,27 @@ class UnSerializeIt(UnSerialized):
     def getObject(self):
         typeDescriptor = self.serialized.getTypeDescriptor()
         if globals().has_key('numpy') and typeDescriptor == 'ndarray':
+                md = self.serialized.metadata
                 buf = self.serialized.getData()
-                if isinstance(buf, (str, buffer)):
-                    result = numpy.frombuffer(buf, dtype = self.serialized.metadata['dtype'])
+                order = md.get('order', 'C')
+                shape = md['shape']
+                if order == 'F':
+                    # the data are the C-ordered transpose
+                    shape = shape[::-1]
+                if isinstance(buf, list):
+                    # strided: one frame per contiguous block
+                    result = numpy.empty(shape, dtype=md['dtype'])
+                    blocks = result.reshape(len(buf), -1)
+                    for block, b in zip(blocks, buf):
+                        block[:] = numpy.frombuffer(b, dtype=md['dtype'])
+                elif isinstance(buf, (str, buffer)):
+                    result = numpy.frombuffer(buf, dtype = md['dtype'])
                 else:
                     # memoryview
-                    result = numpy.array(buf, dtype = self.serialized.metadata['dtype'])
-                result.shape = self.serialized.metadata['shape']
+                    result = numpy.array(buf, dtype = md['dtype'])
+                result.shape = shape
+                if order == 'F':
+                    result = result.T
         elif typeDescriptor == 'pickle':
             result = pickle.loads(self.serialized.getData())
         elif typeDescriptor in ('bytes', 'buffer'):
@@ -162,8 +186,68 @@ class UnSerializeIt(UnSerialized):
             raise SerializationError("Really wierd serialization error.")
         return result
 
-def serialize(obj):
-    return SerializeIt(UnSerialized(obj))
+# strided arrays are sent as several frames if each is at least this big,
+# and copied to one contiguous frame otherwise.  Set it to 0 to never copy,
+# however many frames that takes, or pass min_frame_bytes to serialize.
+min_frame_bytes = 1<<16
+
+def _contiguous_axis(a):
+    """The first axis k such that each a[i,j,...,:,:] over axes k and
+    later is C-contiguous."""
+    size = a.itemsize
+    k = a.ndim
+    while k > 0:
+        n, stride = a.shape[k-1], a.strides[k-1]
+        if n > 1 and stride != size:
+            break
+        size *= n
+        k -= 1
+    return k
+
+def _blocks(a):
+    """The C-contiguous blocks of `a`, in order."""
+    k = _contiguous_axis(a)
+    # with Ellipsis, single items are 0-d views rather than scalar copies
+    return [ a[idx + (Ellipsis,)] for idx in numpy.ndindex(*a.shape[:k]) ]
+
+def array_layout(a, min_frame_bytes=None):
+    """How to send array `a` without copying it, if we can.
+    
+    Returns (b, order, frames), where `b` is C-contiguous in `frames`
+    equal blocks along its leading axes, and is `a` (order 'C') or its
+    transpose (order 'F').  If the blocks would be smaller than
+    `min_frame_bytes` [default: the module's min_frame_bytes, 64kB],
+    `b` is a contiguous copy of `a` in one frame.
+    """
+    if min_frame_bytes is None:
+        min_frame_bytes = globals()['min_frame_bytes']
+    if a.flags.c_contiguous:
+        return a, 'C', 1
+    elif a.size == 0:
+        return numpy.ascontiguousarray(a), 'C', 1
+    elif a.flags.f_contiguous:
+        return a.T, 'F', 1
+    best = None
+    for b, order in ((a, 'C'), (a.T, 'F')):
+        k = _contiguous_axis(b)
+        frames = int(numpy.prod(b.shape[:k]))
+        if best is None or frames < best[2]:
+            best = (b, order, frames)
+    b, order, frames = best
+    if b.nbytes // frames < min_frame_bytes:
+        return numpy.ascontiguousarray(a), 'C', 1
+    return b, order, frames
+
+def serialize(obj, min_frame_bytes=None):
+    """Serialize `obj`, as a SerializeIt.
+    
+    Arrays are sent without copying, as one frame per contiguous block if
+    they are strided.  A strided array whose blocks would be smaller than
+    `min_frame_bytes` [default: the module's min_frame_bytes, 64kB] is
+    copied into one contiguous frame instead, since many tiny frames cost
+    more than the copy.  A column slice of a C-ordered array is one such.
+    """
+    return SerializeIt(UnSerialized(obj), min_frame_bytes)
     
 def unserialize(serialized):
     return UnSerializeIt(serialized).getObject()
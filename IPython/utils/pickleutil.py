@@ -60,6 +60,30 @@ class Reference(CannedObject):
             raise NameError("name %r is not defined"%self.name)
     
 
+class ResultReference(object):
+    """object for wrapping the results of tasks by msg_id, as stored in the Hub.
+    
+    Engines replace it with the results, which they fetch from the Hub.
+    `single` is whether it stands for one result rather than a list, and
+    `mapObject` joins the results of a map.
+    """
+    def __init__(self, msg_ids, single=True, mapObject=None):
+        self.msg_ids = list(msg_ids)
+        self.single = single
+        self.mapObject = mapObject
+    
+    def __repr__(self):
+        return "<ResultReference: %r>"%self.msg_ids
+    
+    def join(self, results):
+        """Turn the results of our msg_ids into what they stand for."""
+        if self.mapObject is not None:
+            return self.mapObject.joinPartitions(results)
+        elif self.single:
+            return results[0]
+        return results
+    
+
 class CannedFunction(CannedObject):
     
     def __init__(self, f):
@@ -91,18 +115,27 @@ class CannedFunction(CannedObject):
 # Functions
 #-------------------------------------------------------------------------------
 
+# types that never need canning, checked first since most objects are these
+_primitives = frozenset([int, long, float, complex, bool, str, unicode, type(None)])
+
 def can(obj):
+    if type(obj) in _primitives:
+        return obj
+    elif isinstance(obj, (list,tuple)):
+        return canSequence(obj)
+    elif isinstance(obj,dict):
+        return canDict(obj)
     # import here to prevent module-level circular imports
-    from IPython.parallel import dependent
+    from IPython.parallel import dependent, AsyncResult, AsyncMapResult
     if isinstance(obj, dependent):
         keys = ('f','df')
         return CannedObject(obj, keys=keys)
+    elif isinstance(obj, AsyncMapResult):
+        return ResultReference(obj.msg_ids, False, obj._mapObject)
+    elif isinstance(obj, AsyncResult):
+        return ResultReference(obj.msg_ids, obj._single_result)
     elif isinstance(obj, FunctionType):
         return CannedFunction(obj)
-    elif isinstance(obj,dict):
-        return canDict(obj)
-    elif isinstance(obj, (list,tuple)):
-        return canSequence(obj)
     else:
         return obj
 
@@ -115,20 +148,39 @@ def canDict(obj):
     else:
         return obj
 
+def allPrimitive(seq):
+    """Whether no item of `seq` could need canning."""
+    primitives = _primitives
+    for i in seq:
+        if type(i) not in primitives:
+            return False
+    return True
+
 def canSequence(obj):
+    """Can the items of a list or tuple.
+    
+    If none of them needed canning, `obj` itself is returned."""
     if isinstance(obj, (list, tuple)):
-        t = type(obj)
-        return t([can(i) for i in obj])
+        if allPrimitive(obj):
+            return obj
+        canned = [can(i) for i in obj]
+        for i, c in zip(obj, canned):
+            # objects that were canned already still need uncanning
+            if c is not i or isinstance(c, CannedObject):
+                return type(obj)(canned)
+        return obj
     else:
         return obj
 
 def uncan(obj, g=None):
-    if isinstance(obj, CannedObject):
+    if type(obj) in _primitives:
+        return obj
+    elif isinstance(obj, (list,tuple)):
+        return uncanSequence(obj, g)
+    elif isinstance(obj, CannedObject):
         return obj.getObject(g)
     elif isinstance(obj,dict):
         return uncanDict(obj, g)
-    elif isinstance(obj, (list,tuple)):
-        return uncanSequence(obj, g)
     else:
         return obj
 
@@ -143,6 +195,8 @@ def uncanDict(obj, g=None):
 
 def uncanSequence(obj, g=None):
     if isinstance(obj, (list, tuple)):
+        if allPrimitive(obj):
+            return obj
         t = type(obj)
         return t([uncan(i,g) for i in obj])
     else:
@@ -0,0 +1,59 @@
+"""Time a stream of short tasks, and a batch of uneven long ones.
+
+Short tasks keep engines busy only if more are waiting on them, to cover the
+round trip of each result and the next task, so they do well with no hwm.
+Uneven long tasks are balanced only if they wait in the scheduler, so they
+do well with hwm=1.  Run this against a controller with each of::
+
+    c.TaskScheduler.hwm = 0
+    c.TaskScheduler.hwm = 1
+    c.TaskScheduler.adaptive_hwm = True
+
+in ipcontroller_config.py, started by::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python adaptive_hwm.py -n 2000
+"""
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client
+
+def work(t):
+    import time
+    time.sleep(t)
+    return t
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=2000, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of short tasks')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    n = len(rc.ids)
+
+    tic = time.time()
+    view.map_sync(work, [0]*opts.n)
+    toc = time.time() - tic
+    print "%i short tasks:   %.2f s (%.0f tasks/s)"%(opts.n, toc, opts.n/toc)
+
+    # one long task in each round of n, which all land on one engine if
+    # they are handed out in turn as they are submitted
+    durations = ([1.] + [0.05]*(n-1)) * 8
+    tic = time.time()
+    view.map_sync(work, durations)
+    toc = time.time() - tic
+    print "%i uneven tasks:  %.2f s (%.2f s at best)"%(len(durations), toc,
+                                                    sum(durations)/n)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure client-side cost of a broadcast apply as the number of engines grows.
+
+DirectView.apply packs f, args and kwargs a single time, and sends the same
+buffers to every engine, so client CPU time should stay roughly flat as more
+engines are targeted.  To run, start a cluster with several engines::
+
+    ipclusterz start -n 16
+
+and then::
+
+    python broadcast_apply.py -s 200
+"""
+import time
+from optparse import OptionParser
+
+import numpy as np
+from IPython.parallel import Client
+
+def echo_shape(a):
+    return a.shape
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=64, trials=3, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the array argument, in MB')
+    parser.add_option("-t", type='int', dest='trials',
+        help='the number of trials for each engine count')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    ids = rc.ids
+    a = np.random.random(opts.size*(1<<20)/8)
+    print "broadcasting a %i MB array"%opts.size
+    print "%8s %12s %12s"%('engines', 'cpu (s)', 'wall (s)')
+    n = 1
+    while n <= len(ids):
+        view = rc[ids[:n]]
+        cpu = wall = 0
+        for i in range(opts.trials):
+            tic = time.time()
+            ctic = time.clock()
+            ar = view.apply_async(echo_shape, a)
+            cpu += time.clock() - ctic
+            ar.get()
+            wall += time.time() - tic
+        print "%8i %12.4f %12.4f"%(n, cpu/opts.trials, wall/opts.trials)
+        n *= 2
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Compare pushing an array with broadcasting it, and pulling partial sums
+with reducing them.
+
+A push sends the array to every engine, while a broadcast sends it to one,
+and the engines send it on to each other over a binomial tree.  A reduce
+adds up the partial sums on the engines, up the same tree, and only the
+total comes back.  Start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python collectives.py -s 64
+"""
+import time
+from operator import add
+from optparse import OptionParser
+
+import numpy
+from numpy.testing import assert_array_almost_equal
+
+from IPython.parallel import Client
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=64, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the array, in MB')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc[:]
+    view.block = True
+    n = len(rc.ids)
+    a = numpy.random.random(opts.size * 2**20 / 8)
+
+    tic = time.time()
+    view.push(dict(a=a))
+    toc = time.time() - tic
+    print "push %.0f MB to %i engines:      %.2f s"%(a.nbytes/1e6, n, toc)
+
+    tic = time.time()
+    view.broadcast('a', a)
+    toc = time.time() - tic
+    print "broadcast %.0f MB to %i engines: %.2f s"%(a.nbytes/1e6, n, toc)
+
+    tic = time.time()
+    total = reduce(add, view.pull('a'))
+    toc = time.time() - tic
+    print "pull and add:          %.2f s"%toc
+
+    tic = time.time()
+    reduced = view.reduce(add, 'a')
+    toc = time.time() - tic
+    print "reduce on the engines: %.2f s"%toc
+    # the tree adds in a different grouping, so rounding may differ
+    assert_array_almost_equal(reduced, total)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
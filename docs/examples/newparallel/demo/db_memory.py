@@ -0,0 +1,70 @@
+"""Watch the memory of a Hub's DictDB over a long run of tasks.
+
+This replays the Hub's db calls for many tasks with buffers of a given size,
+and prints the process RSS every so often.  With no limit, RSS grows with
+every task.  With a record_limit or size_limit, it should level off once the
+limit is reached::
+
+    python db_memory.py -n 200000 -b 10000
+    python db_memory.py -n 200000 -b 10000 --size-limit 100000000
+    python db_memory.py -n 200000 -b 10000 --size-limit 100000000 --spill
+"""
+import os
+import resource
+import tempfile
+from datetime import datetime
+from optparse import OptionParser
+
+from IPython.config.loader import Config
+from IPython.parallel import streamsession as ss
+from IPython.parallel.controller.dictdb import DictDB
+from IPython.parallel.controller.hub import init_record
+
+def rss():
+    """current resident set size, in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        # no /proc, use the peak instead
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=100000, nbytes=10000, record_limit=0, size_limit=0,
+                        spill=False, every=10000)
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of tasks')
+    parser.add_option("-b", type='int', dest='nbytes',
+        help='the bytes of buffers in each request and each result')
+    parser.add_option("--record-limit", type='int', dest='record_limit',
+        help='DictDB.record_limit [default: no limit]')
+    parser.add_option("--size-limit", type='int', dest='size_limit',
+        help='DictDB.size_limit [default: no limit]')
+    parser.add_option("--spill", action='store_true', dest='spill',
+        help='move culled records to an SQLiteDB in a temporary dir')
+    parser.add_option("--every", type='int', dest='every',
+        help='print RSS after this many tasks')
+    (opts, args) = parser.parse_args()
+
+    config = Config()
+    config.SQLiteDB.location = tempfile.mkdtemp()
+    session = ss.StreamSession()
+    db = DictDB(record_limit=opts.record_limit, size_limit=opts.size_limit,
+                spill=opts.spill, session=session.session, config=config)
+    print "%10s %10s %10s"%('tasks', 'in memory', 'RSS (MB)')
+    for i in xrange(opts.n):
+        msg = session.msg('apply_request', content=dict(bound=False))
+        msg['buffers'] = [os.urandom(opts.nbytes)]
+        msg_id = msg['msg_id']
+        db.add_record(msg_id, init_record(msg))
+        db.update_record(msg_id, dict(engine_uuid='engine'))
+        db.update_record(msg_id, dict(completed=datetime.now(),
+                            result_content=dict(status='ok'),
+                            result_buffers=[os.urandom(opts.nbytes)]))
+        if (i+1) % opts.every == 0:
+            print "%10i %10i %10.1f"%(i+1, len(db._records), rss())
+
+if __name__ == '__main__':
+    main()
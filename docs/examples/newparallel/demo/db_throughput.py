@@ -0,0 +1,72 @@
+"""Benchmark the Hub's task record backends.
+
+This replays the calls the Hub makes on its db for each task: a lookup of
+the new msg_id, then an add when the request arrives, and updates for the
+destination and the result.  It reports the records per second that the
+Hub's loop can sustain, and the total including the final write to disk::
+
+    python db_throughput.py -n 20000
+"""
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+from IPython.parallel import streamsession as ss
+from IPython.parallel.controller.dictdb import DictDB
+from IPython.parallel.controller.sqlitedb import SQLiteDB
+from IPython.parallel.controller.hub import init_record
+
+def make_messages(session, n):
+    msgs = []
+    for i in xrange(n):
+        msg = session.msg('apply_request', content=dict(bound=False))
+        msg['buffers'] = ['x'*64]
+        msgs.append(msg)
+    return msgs
+
+def replay(db, msgs):
+    """The Hub's db calls for each message, as in save_task_request,
+    save_task_destination and save_task_result."""
+    for msg in msgs:
+        msg_id = msg['msg_id']
+        try:
+            db.get_record(msg_id)
+        except KeyError:
+            db.add_record(msg_id, init_record(msg))
+        db.update_record(msg_id, dict(engine_uuid='engine'))
+        db.update_record(msg_id, dict(started=datetime.now(),
+                            completed=datetime.now(),
+                            result_header=msg['header'],
+                            result_content=dict(status='ok'),
+                            result_buffers=['y'*64]))
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=10000, synchronous='NORMAL')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of task records')
+    parser.add_option("-s", type='str', dest='synchronous',
+        help='PRAGMA synchronous for SQLiteDB [default: NORMAL]')
+    (opts, args) = parser.parse_args()
+
+    session = ss.StreamSession()
+    msgs = make_messages(session, opts.n)
+    location = tempfile.mkdtemp()
+    backends = [
+        ('DictDB', lambda : DictDB()),
+        ('SQLiteDB', lambda : SQLiteDB(location=location, synchronous=opts.synchronous)),
+    ]
+    print "%10s %14s %14s"%('backend', 'loop rec/s', 'total rec/s')
+    for name, factory in backends:
+        db = factory()
+        tic = time.time()
+        replay(db, msgs)
+        loop = time.time() - tic
+        if hasattr(db, 'flush'):
+            db.flush()
+        total = time.time() - tic
+        print "%10s %14.1f %14.1f"%(name, opts.n/loop, opts.n/total)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""One client floods the task queue while another submits a few tasks.
+
+Without limits, the flood is sent to the engines at once, and the other
+client's tasks wait behind all of it.  With a limit on the tasks each client
+may have out, the rest wait in the scheduler, where clients take turns, so
+the other client's tasks start as soon as one of the flood's finishes.
+Start a cluster, with this in ipcontroller_config.py::
+
+    c.TaskScheduler.client_hwm = 4
+
+by::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python fairshare.py -n 200 -t 0.05
+
+This also prints the statistics the Hub keeps for each client.
+"""
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client
+
+def work(t):
+    import time
+    time.sleep(t)
+    return t
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=200, t=0.05, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of tasks in the flood')
+    parser.add_option("-t", type='float', dest='t',
+        help='the duration of each task, in seconds')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    flooder = Client(profile=opts.profile)
+    other = Client(profile=opts.profile)
+    flood = flooder.load_balanced_view().map_async(work, [opts.t]*opts.n)
+    time.sleep(0.5)
+    view = other.load_balanced_view()
+    tic = time.time()
+    for i in range(4):
+        view.apply_sync(work, opts.t)
+    toc = time.time() - tic
+    print "4 tasks behind a flood of %i: %.2f s"%(opts.n, toc)
+    tic = time.time()
+    flood.get()
+    print "the rest of the flood:       %.2f s"%(time.time() - tic)
+    for client, name in ((flooder, 'flood'), (other, 'other')):
+        stats = other.queue_status()['clients'][client.session.session]
+        print "%-6s %4i tasks, mean wait %.2f s, max %.2f s"%(name, stats['completed'],
+                                                stats['wait'], stats['max_wait'])
+    flooder.close()
+    other.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Measure the rate of many small tasks, with functions sent by digest.
+
+After an engine has run a function, the client sends only its digest, and
+the engine uses the function it already uncanned.  This submits many
+small tasks of one function with a sizeable body, and reports the rate,
+and the size of the function in the first and in later requests.  Start
+a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python function_cache.py -n 5000
+"""
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client, util
+
+def task(x, scale=1.0, offset=0.0):
+    """a function with a body of some size, like most real ones"""
+    total = 0.0
+    for i, c in enumerate(str(x)):
+        if c in '0123456789':
+            total += int(c) * scale
+        elif c == '-':
+            total = -total
+        else:
+            raise ValueError("not a number: %r"%x)
+    if total > 1e6:
+        total = 1e6
+    elif total < -1e6:
+        total = -1e6
+    return (total + offset, len(str(x)), x % 7, x // 7, abs(x), hex(x))
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=5000, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of tasks')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    fbuf, digest, digest_buf = util.pack_function(task)
+    print "function: %i bytes in full, %i bytes by digest"%(len(fbuf), len(digest_buf))
+    # let every engine see it once
+    rc[:].apply_sync(task, 1)
+    tic = time.time()
+    ars = [ view.apply_async(task, i) for i in xrange(opts.n) ]
+    rc.wait(ars)
+    toc = time.time() - tic
+    print "%i tasks: %.2f s, %.0f tasks/s"%(opts.n, toc, opts.n/toc)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
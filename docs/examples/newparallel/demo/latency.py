@@ -0,0 +1,62 @@
+"""Measure the round-trip latency of small tasks.
+
+Each trial is a single apply_sync of a trivial function, so the time is
+dominated by messaging and by how quickly the client notices the reply.
+Client CPU time is reported as well, since waiting should not spin.  The
+last line is the client CPU used while waiting on tasks that sleep.  To run,
+start a cluster::
+
+    ipclusterz start -n 1
+
+and then::
+
+    python latency.py -n 1000
+"""
+import time
+from optparse import OptionParser
+
+import numpy as np
+from IPython.parallel import Client
+
+def noop():
+    pass
+
+def nap(t):
+    import time
+    time.sleep(t)
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=1000, profile='default', nap=0.1)
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of round trips')
+    parser.add_option("-s", type='float', dest='nap',
+        help='the length of the sleeping tasks, in seconds')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    for name, view in [('direct', rc[rc.ids[0]]), ('load-balanced', rc.load_balanced_view())]:
+        view.apply_sync(noop)
+        times = np.empty(opts.n)
+        ctic = time.clock()
+        for i in xrange(opts.n):
+            tic = time.time()
+            view.apply_sync(noop)
+            times[i] = time.time() - tic
+        cpu = time.clock() - ctic
+        times *= 1e3
+        print "%s: median %.3f ms, mean %.3f ms, min %.3f ms, client cpu %.1f%%"%(
+            name, np.median(times), times.mean(), times.min(), 100*cpu/(times.sum()/1e3))
+    view = rc[rc.ids[0]]
+    tic = time.time()
+    ctic = time.clock()
+    for i in range(10):
+        view.apply_sync(nap, opts.nap)
+    cpu = time.clock() - ctic
+    print "waiting on %.3fs tasks: client cpu %.1f%%"%(opts.nap, 100*cpu/(time.time()-tic))
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Repeated passes over partitioned data, placed by data affinity.
+
+The partitions are put in the Hub, and each pass submits one task per
+partition.  The first pass fetches each partition to some engine, and the
+scheduler sends later passes to the engines that already hold them.  This
+reports the time of each pass, and how many tasks ran where their partition
+ran in the pass before.  Start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python locality.py -s 32 -n 16 --passes 4
+"""
+import time
+from optparse import OptionParser
+
+import numpy
+
+from IPython.parallel import Client
+
+def norm(a):
+    import numpy
+    return float(numpy.sqrt((a*a).sum()))
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=32, n=16, passes=4, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of each partition, in MB')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of partitions')
+    parser.add_option("--passes", type='int', dest='passes',
+        help='the number of passes over the partitions')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    parts = [ rc.put(numpy.random.random(opts.size * 2**20 / 8)) for i in range(opts.n) ]
+    where = None
+    for p in range(opts.passes):
+        tic = time.time()
+        ars = [ view.apply_async(norm, part) for part in parts ]
+        [ ar.get() for ar in ars ]
+        toc = time.time() - tic
+        engines = [ ar.engine_id for ar in ars ]
+        if where is None:
+            stayed = 0
+        else:
+            stayed = sum( a == b for a,b in zip(where, engines) )
+        where = engines
+        print "pass %i: %.2f s, %i/%i tasks where their partition was"%(
+            p, toc, stayed, opts.n)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Compare chunk sizes for a load-balanced map of many small tasks.
+
+With chunksize=1, every item is a task, and the time is dominated by
+messaging.  A large fixed chunksize keeps overhead down, but can leave
+engines idle at the end when items vary in cost.  'guided' and 'auto'
+should do well in both cases.  To run, start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python map_chunks.py -n 2000 -t 0.001
+"""
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client
+
+def work(t):
+    import time
+    time.sleep(t)
+    return t
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=2000, t=0.001, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of items')
+    parser.add_option("-t", type='float', dest='t',
+        help='the mean time of each item, in seconds')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    # the second half of the items take three times as long
+    times = [ opts.t*(1 + 2*(i >= opts.n/2)) for i in range(opts.n) ]
+    serial = sum(times)
+    big = max(1, opts.n/len(rc.ids))
+    print "%10s %10s %10s %10s"%('chunksize', 'tasks', 'seconds', 'speedup')
+    for chunksize in (1, 10, big, 'guided', 'auto'):
+        tic = time.time()
+        ar = view.map_async(work, times, chunksize=chunksize)
+        assert ar.get() == times
+        toc = time.time() - tic
+        print "%10s %10i %10.3f %10.2f"%(chunksize, len(ar.msg_ids), toc, serial/toc)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Compare passing a large array to many tasks by value and by reference.
+
+By value, the client sends the array with every task.  By reference, the
+client puts it in the Hub once, and each engine fetches it the first time
+one of its tasks needs it.  Start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python object_store.py -s 64 -n 32
+"""
+import time
+from optparse import OptionParser
+
+import numpy
+
+from IPython.parallel import Client
+
+def norm(a, i):
+    return float(abs(a[i::1024]).sum())
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=64, n=32, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the array, in MB')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of tasks')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    a = numpy.random.random(opts.size * 2**20 / 8)
+
+    tic = time.time()
+    ars = [ view.apply_async(norm, a, i) for i in xrange(opts.n) ]
+    by_value = [ ar.get() for ar in ars ]
+    toc = time.time() - tic
+    print "by value:     %i tasks: %.2f s"%(opts.n, toc)
+
+    tic = time.time()
+    ref = rc.put(a)
+    ars = [ view.apply_async(norm, ref, i) for i in xrange(opts.n) ]
+    by_ref = [ ar.get() for ar in ars ]
+    toc = time.time() - tic
+    print "by reference: %i tasks: %.2f s"%(opts.n, toc)
+    assert by_ref == by_value
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Measure the client memory of pushing and scattering non-contiguous arrays.
+
+Fortran-ordered arrays, their transposes, and slices made of large
+contiguous blocks should be sent without a contiguous copy on the client.
+This pushes (or scatters) one such array and reports the client's peak RSS
+over its RSS before sending.  Peak RSS only grows, so run one layout per
+process.  Start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python push_strided.py -s 512 -l fortran
+    python push_strided.py -s 512 -l rows --scatter
+"""
+import resource
+import time
+from optparse import OptionParser
+
+import numpy
+
+from IPython.parallel import Client
+
+layouts = dict(
+    contiguous = lambda a: a,
+    fortran = numpy.asfortranarray,
+    transpose = lambda a: a.T,
+    rows = lambda a: a[::2],
+)
+
+def peak_rss():
+    """peak resident set size, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=512, layout='fortran', scatter=False, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the base array, in MB')
+    parser.add_option("-l", type='choice', dest='layout', choices=sorted(layouts),
+        help='the layout of the array: %s'%', '.join(sorted(layouts)))
+    parser.add_option("--scatter", action='store_true', dest='scatter',
+        help='scatter the array instead of pushing it to one engine')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc[:] if opts.scatter else rc[rc.ids[0]]
+    view.block = True
+    base = numpy.ones((16, opts.size * 2**20 / 128))
+    a = layouts[opts.layout](base)
+    mb = a.nbytes / 1e6
+    before = peak_rss()
+    tic = time.time()
+    if opts.scatter:
+        view.scatter('a', a)
+    else:
+        view.push(dict(a=a))
+    toc = time.time() - tic
+    print "%s %s %.0f MB: %.2f s, client peak RSS +%.0f MB"%(
+        'scatter' if opts.scatter else 'push', opts.layout, mb, toc,
+        peak_rss() - before)
+    rc.close()
+
+if __name__ == '__main__':
+    main()
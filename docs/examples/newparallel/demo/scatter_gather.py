@@ -0,0 +1,51 @@
+"""Time scattering and gathering an array, block and round-robin.
+
+Partitions are views of the array, sent as they are packed, and gathered
+partitions are copied once, into one array allocated for them.  Start a
+cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python scatter_gather.py -s 256 -d b
+    python scatter_gather.py -s 256 -d r
+"""
+import time
+from optparse import OptionParser
+
+import numpy
+from numpy.testing import assert_array_equal
+
+from IPython.parallel import Client
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=256, dist='b', profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the array, in MB')
+    parser.add_option("-d", type='choice', dest='dist', choices=['b', 'r'],
+        help="the distribution: 'b' for blocks, 'r' for round-robin")
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc[:]
+    view.block = True
+    # rows of 64kB, so round-robin partitions are sent row by row
+    a = numpy.arange(opts.size * 2**20 / 8, dtype=numpy.int64).reshape(-1, 2**13)
+    tic = time.time()
+    view.scatter('a', a, dist=opts.dist)
+    toc = time.time() - tic
+    print "scatter %.0f MB to %i engines: %.2f s"%(a.nbytes/1e6, len(rc.ids), toc)
+    tic = time.time()
+    b = view.gather('a', dist=opts.dist)
+    toc = time.time() - tic
+    print "gather: %.2f s"%toc
+    assert_array_equal(a, b)
+    assert b.dtype == a.dtype
+    rc.close()
+
+if __name__ == '__main__':
+    main()
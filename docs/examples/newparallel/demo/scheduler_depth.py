@@ -0,0 +1,100 @@
+"""Microbenchmark of TaskScheduler throughput as a function of queue depth.
+
+This drives a TaskScheduler in-process, with no controller or engines:
+tasks are fed straight into dispatch_submission, and fake replies into
+dispatch_result.  `depth` tasks are queued behind a single gate task, and
+each engine may only have `hwm` tasks outstanding, so most of the queue is
+waiting when results come in.  Throughput should not depend on the depth,
+or on the number of engines::
+
+    python scheduler_depth.py -e 4 --hwm 1
+    python scheduler_depth.py -e 1000 --hwm 1 -s weighted
+"""
+import time
+from optparse import OptionParser
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+
+from IPython.parallel.controller import scheduler as sched
+
+def make_scheduler(ctx, loop, hwm, scheme):
+    streams = {}
+    for name,kind in [('client_stream', zmq.XREP), ('engine_stream', zmq.XREP),
+                    ('mon_stream', zmq.PUB), ('notifier_stream', zmq.SUB)]:
+        s = ctx.socket(kind)
+        s.setsockopt(zmq.LINGER, 0)
+        streams[name] = ZMQStream(s, loop)
+    scheduler = sched.TaskScheduler(scheme=getattr(sched, scheme), loop=loop,
+                                    hwm=hwm, **streams)
+    return scheduler
+
+def submit(scheduler, client, **subheader):
+    session = scheduler.session
+    msg = session.msg('apply_request', {}, subheader=subheader)
+    raw = map(zmq.Message, session.serialize(msg, ident=client))
+    scheduler.dispatch_submission(raw)
+    return msg['header']
+
+def reply(scheduler, engine, client, msg_id):
+    session = scheduler.session
+    parent = dict(msg_id=msg_id, session=session.session, username=session.username)
+    msg = session.msg('apply_reply', {}, parent=parent,
+                        subheader=dict(status='ok', dependencies_met=True))
+    raw = map(zmq.Message, session.serialize(msg, ident=[engine, client]))
+    scheduler.dispatch_result(raw)
+
+def run(ctx, depth, engines, hwm, scheme):
+    loop = ioloop.IOLoop()
+    scheduler = make_scheduler(ctx, loop, hwm, scheme)
+    for i in range(engines):
+        scheduler._register_engine('engine-%i'%i)
+    client = 'client'
+
+    # the gate task occupies one engine until we reply to it
+    gate = submit(scheduler, client)['msg_id']
+    for i in xrange(depth):
+        submit(scheduler, client, after=[gate], timeout=3600)
+
+    tic = time.time()
+    done = 0
+    while True:
+        busy = [ (e,p) for e,p in scheduler.pending.iteritems() if p ]
+        if not busy:
+            break
+        for engine,pending in busy:
+            msg_id = iter(pending).next()
+            reply(scheduler, engine, client, msg_id)
+            done += 1
+        if done % 1000 < len(busy):
+            scheduler.audit_timeouts()
+    toc = time.time()
+    assert not scheduler.depending, "%i tasks never ran"%len(scheduler.depending)
+    for s in (scheduler.client_stream, scheduler.engine_stream,
+                scheduler.mon_stream, scheduler.notifier_stream):
+        # the loop never runs, so close the sockets directly
+        s.socket.close()
+    return done/(toc-tic)
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(engines=4, hwm=1, depths='100,1000,10000', scheme='leastload')
+    parser.add_option("-e", type='int', dest='engines',
+        help='the number of fake engines')
+    parser.add_option("--hwm", type='int', dest='hwm',
+        help='the TaskScheduler.hwm value (0 for no limit)')
+    parser.add_option("-d", type='str', dest='depths',
+        help='comma-separated list of queue depths')
+    parser.add_option("-s", type='str', dest='scheme',
+        help='the scheduler scheme [default: leastload]')
+    (opts, args) = parser.parse_args()
+
+    ctx = zmq.Context()
+    print "%8s %14s"%('depth', 'tasks/sec')
+    for depth in map(int, opts.depths.split(',')):
+        print "%8i %14.1f"%(depth, run(ctx, depth, opts.engines, opts.hwm, opts.scheme))
+    ctx.term()
+
+if __name__ == '__main__':
+    main()
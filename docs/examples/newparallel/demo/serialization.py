@@ -0,0 +1,52 @@
+"""Benchmark serialize_object on small and large payloads.
+
+This times a round trip through util.serialize_object and
+util.unserialize_object, as for the result of a task, and through
+pack_apply_message and unpack_apply_message, as for its arguments::
+
+    python serialization.py -n 100000
+"""
+import time
+from optparse import OptionParser
+
+import numpy
+
+from IPython.parallel import util
+
+def payloads(n):
+    small = [ (i, 'abc', float(i)) for i in xrange(n) ]
+    large = [ numpy.random.random(125000) for i in range(10) ]
+    mixed = small[:n/2] + large + small[n/2:]
+    return [('small', small), ('large', large), ('mixed', mixed)]
+
+def timeit(f, *args):
+    """best of three, in ms"""
+    best = None
+    for i in range(3):
+        tic = time.time()
+        f(*args)
+        toc = time.time() - tic
+        best = toc if best is None else min(best, toc)
+    return 1e3*best
+
+def result_roundtrip(obj):
+    pmd, bufs = util.serialize_object(obj)
+    util.unserialize_object([pmd]+bufs)
+
+def apply_roundtrip(obj):
+    msg = util.pack_apply_message(len, obj, {})
+    util.unpack_apply_message(msg)
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=100000)
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of small items')
+    (opts, args) = parser.parse_args()
+
+    print "%10s %14s %14s"%('payload', 'result (ms)', 'apply (ms)')
+    for name, obj in payloads(opts.n):
+        print "%10s %14.1f %14.1f"%(name, timeit(result_roundtrip, obj), timeit(apply_roundtrip, obj))
+
+if __name__ == '__main__':
+    main()
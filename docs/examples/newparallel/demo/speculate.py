@@ -0,0 +1,56 @@
+"""Time a map where one engine runs every task slowly.
+
+With hwm=1, the map waits at the end for the last task on the slow engine.
+With speculation, that task gets a copy on an idle engine, which finishes
+first.  Run this against a controller with each of::
+
+    c.TaskScheduler.hwm = 1
+
+    c.TaskScheduler.hwm = 1
+    c.TaskScheduler.speculate = True
+
+in ipcontroller_config.py, started by::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python speculate.py -n 100 -t 0.05 -s 40
+"""
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client
+
+def work(t):
+    import time
+    time.sleep(t*slowness)
+    return t
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=100, t=0.05, s=40, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of tasks')
+    parser.add_option("-t", type='float', dest='t',
+        help='the duration of each task, in seconds')
+    parser.add_option("-s", type='float', dest='s',
+        help='how many times slower the slow engine is')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    rc[:]['slowness'] = 1
+    rc[rc.ids[0]]['slowness'] = opts.s
+    view = rc.load_balanced_view()
+    for i in range(3):
+        tic = time.time()
+        view.map_sync(work, [opts.t]*opts.n)
+        toc = time.time() - tic
+        print "%i tasks: %.2f s (%.2f s at best)"%(opts.n, toc,
+                                                opts.n*opts.t/(len(rc.ids)-1))
+    rc.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Map over a long stream of items with constant client memory.
+
+view.imap reads items from any iterator a chunk at a time, keeps at most
+`window` chunks submitted but not consumed, and lets go of each result once
+it has been yielded.  This prints the client's RSS as the stream goes by,
+which should level off, while view.map has to hold the whole input and
+every result.  To run, start a cluster::
+
+    ipclusterz start -n 4
+
+and then::
+
+    python stream_map.py -n 200000 -c 1000
+"""
+import resource
+import time
+from optparse import OptionParser
+
+from IPython.parallel import Client
+
+def rss():
+    """current resident set size, in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def lines(n, size):
+    """a stand-in for the lines of a large file"""
+    for i in xrange(n):
+        yield ('%i '%i) * (size/8)
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(n=200000, chunksize=1000, size=1000, profile='default')
+    parser.add_option("-n", type='int', dest='n',
+        help='the number of items')
+    parser.add_option("-c", type='int', dest='chunksize',
+        help='the number of items in each task')
+    parser.add_option("-s", type='int', dest='size',
+        help='the bytes in each item')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc.load_balanced_view()
+    tic = time.time()
+    total = 0
+    for i, r in enumerate(view.imap(len, lines(opts.n, opts.size), chunksize=opts.chunksize)):
+        total += r
+        if (i+1) % (opts.n/10) == 0:
+            print "%10i items %8.1f MB RSS"%(i+1, rss())
+    print "%.1f items/s"%(opts.n/(time.time()-tic))
+    rc.close()
+
+if __name__ == '__main__':
+    main()
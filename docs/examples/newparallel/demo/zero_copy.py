@@ -0,0 +1,73 @@
+"""Measure the memory and time of sending large arrays to and from an engine.
+
+Arrays should arrive on the engine, and come back to the client, as views
+of the received message, so that neither side holds a second copy.  This
+sends one array of the given size to an engine and reports the engine's
+RSS while the function runs, then echoes the array back and reports the
+client's RSS growth, and its peak over the client's RSS before the echo.  Use a fresh cluster with one engine::
+
+    ipclusterz start -n 1
+
+and then::
+
+    python zero_copy.py -s 1024
+"""
+import resource
+import time
+from optparse import OptionParser
+
+import numpy
+
+from IPython.parallel import Client
+
+def rss():
+    """current resident set size, in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def engine_rss(a=None):
+    """the engine's RSS and peak RSS, in MB"""
+    import resource
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1e6, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def echo(a):
+    return a
+
+def main():
+    parser = OptionParser()
+    parser.set_defaults(size=1024, profile='default')
+    parser.add_option("-s", type='int', dest='size',
+        help='the size of the array, in MB')
+    parser.add_option("-p", '--profile', type='str', dest='profile',
+        help="the cluster profile [default: 'default']")
+    (opts, args) = parser.parse_args()
+
+    rc = Client(profile=opts.profile)
+    view = rc[rc.ids[0]]
+    view.block = True
+    a = numpy.ones(opts.size * 2**20 / 8)
+    mb = a.nbytes / 1e6
+    base, peak = view.apply(engine_rss)
+    tic = time.time()
+    during, peak = view.apply(engine_rss, a)
+    toc = time.time() - tic
+    print "send %.0f MB: %.2f s, engine RSS +%.0f MB (peak +%.0f MB)"%(
+            mb, toc, during-base, peak-base)
+    before = rss()
+    tic = time.time()
+    b = view.apply(echo, a)
+    toc = time.time() - tic
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    print "echo %.0f MB: %.2f s, client RSS +%.0f MB (peak +%.0f MB)"%(
+            mb, toc, rss()-before, peak-before)
+    assert b.shape == a.shape
+    rc.close()
+
+if __name__ == '__main__':
+    main()